@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# Micro-benchmark for utils.plan on generated dependency graphs.
+#
+#   python benchmarks/bench_order.py [nodes]
+
+import sys, os, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from maestro import utils
+
+def chain(nodes):
+  templates = {'node_0': {}}
+  for i in range(1, nodes):
+    templates['node_%d' % i] = {'require': {'node_%d' % (i - 1): {'port': '80'}}}
+  return templates
+
+def wide(nodes):
+  templates = {'root': {}}
+  for i in range(1, nodes):
+    templates['node_%d' % i] = {'require': {'root': {'port': '80'}}}
+  return templates
+
+def layered(nodes, fan_in=3):
+  # Every node requires up to fan_in random nodes generated before it
+  random.seed(nodes)
+  templates = {}
+  for i in range(nodes):
+    requires = {}
+    for j in random.sample(range(i), min(i, fan_in)):
+      requires['node_%d' % j] = {'port': '80'}
+    templates['node_%d' % i] = {'require': requires} if requires else {}
+  return templates
+
+def bench(name, templates, runs=5):
+  best = None
+  for _ in range(runs):
+    start = time.time()
+    ordered, levels = utils.plan(templates)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+
+  print '{0:<10}{1:>8} nodes{2:>8} levels{3:>10.1f} ms'.format(name, len(ordered), len(levels), best * 1000)
+
+if __name__ == '__main__':
+  nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  bench('chain', chain(nodes))
+  bench('wide', wide(nodes))
+  bench('layered', layered(nodes))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Compares cold (YAML parse and planning) with warm (cached plan) startup for a generated maestro.yml.
+#
+#   python benchmarks/bench_plan.py [templates]
+
+import sys, os, time, shutil, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from maestro import cache, utils
+
+def generate(filename, count):
+  templates = {}
+  for i in range(count):
+    templates['template_%d' % i] = {
+      'base_image': 'ubuntu',
+      'count': 3,
+      'config': {
+        'command': '/bin/bash -c "while true; do echo hello world; sleep 60; done;"',
+        'ports': ['8080'],
+        'environment': ['ENV_VAR=testing'],
+        'detach': True
+      }
+    }
+    if i > 0:
+      templates['template_%d' % i]['require'] = {'template_%d' % (i / 2): {'port': '8080'}}
+
+  with open(filename, 'w') as output_file:
+    output_file.write(utils.dumpYaml({'templates': templates}))
+
+def best(func, runs=5):
+  result = None
+  for _ in range(runs):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    result = elapsed if result is None else min(result, elapsed)
+  return result * 1000
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+  work = tempfile.mkdtemp()
+  os.environ['MAESTRO_CACHE_DIR'] = os.path.join(work, 'cache')
+  filename = os.path.join(work, 'maestro.yml')
+  generate(filename, count)
+
+  def cold():
+    shutil.rmtree(os.environ['MAESTRO_CACHE_DIR'], True)
+    cache.loadPlan(filename)
+
+  print 'templates: %d  libyaml: %s' % (count, utils.yamlLoader().__name__ == 'CLoader')
+  print '{0:<8}{1:>10.1f} ms'.format('cold', best(cold))
+  cache.loadPlan(filename)
+  print '{0:<8}{1:>10.1f} ms'.format('warm', best(lambda: cache.loadPlan(filename)))
+
+  shutil.rmtree(work)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Measures maestro's own overhead for whole commands against the fake daemon in fakedocker.py. Each scenario
+# runs in a fresh process and reports wall time, Docker API calls and peak memory per operation. Where the
+# peak can't be reset between operations (anything but Linux) the memory column is the peak so far.
+#
+#   python benchmarks/bench_service.py [-l seconds] [-b threads|async] [scenario ...]
+#
+# Scenarios are chain (a deep require chain), replicas (a template with count 1000 and a consumer of all of
+# them) and fanout (one service required by many templates). -l sets the latency of every endpoint.
+
+import sys, os, time, json, resource, shutil, tempfile, subprocess, optparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+SCENARIOS = ['chain', 'replicas', 'fanout']
+OPERATIONS = ['build', 'save', 'load', 'ps', 'stop', 'start', 'destroy']
+
+def template(port, requires=None, count=1):
+  config = {
+    'base_image': 'ubuntu',
+    'count': count,
+    'config': {
+      'command': '/bin/bash -c "while true; do echo hello world; sleep 60; done;"',
+      'ports': [str(port)],
+      'environment': ['ENV_VAR=testing'],
+      'detach': True
+    }
+  }
+  if requires:
+    config['require'] = dict((name, {'port': str(port), 'count': required_count})
+      for name, required_count in requires.items())
+  return config
+
+def generate(scenario, port, size=None):
+  templates = {}
+  if scenario == 'chain':
+    size = size or 50
+    templates['node_0'] = template(port)
+    for i in range(1, size):
+      templates['node_%d' % i] = template(port, {'node_%d' % (i - 1): 1})
+  elif scenario == 'replicas':
+    size = size or 1000
+    templates['worker'] = template(port, count=size)
+    templates['frontend'] = template(port, {'worker': size})
+  elif scenario == 'fanout':
+    size = size or 200
+    templates['root'] = template(port)
+    for i in range(size):
+      templates['leaf_%d' % i] = template(port, {'root': 1})
+  return {'templates': templates}
+
+def resetPeak():
+  # Linux can reset the high water mark so each operation reports its own peak
+  try:
+    with open('/proc/self/clear_refs', 'w') as output_file:
+      output_file.write('5')
+    return True
+  except IOError:
+    return False
+
+def peakMemory():
+  try:
+    with open('/proc/self/status') as input_file:
+      for line in input_file:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 1024.0
+  except IOError:
+    pass
+  # ru_maxrss is in kilobytes on Linux and bytes on OS X and never goes down
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / 1024.0 if sys.platform != 'darwin' else peak / 1048576.0
+
+def runScenario(scenario, latency, backend, size=None):
+  # Runs in its own process so peak memory belongs to this scenario alone
+  from maestro import service, py_backend, utils
+  import fakedocker
+
+  work = tempfile.mkdtemp()
+  # maestro.log is written to the working directory
+  cwd = os.getcwd()
+  os.chdir(work)
+  os.environ['MAESTRO_CACHE_DIR'] = os.path.join(work, 'cache')
+  os.environ['MAESTRO_LOG_DIR'] = os.path.join(work, 'logs')
+  os.environ['MAESTRO_REGISTRY'] = os.path.join(work, 'environments.json')
+  daemon = fakedocker.FakeDocker(os.path.join(work, 'docker.sock'), default_latency=latency).start()
+  py_backend.configure(base_url='unix://' + daemon.path, backend=backend)
+  utils.setQuiet(True)
+
+  conf = os.path.join(work, 'maestro.yml')
+  with open(conf, 'w') as output_file:
+    output_file.write(utils.dumpYaml(generate(scenario, daemon.service_port, size)))
+  environment = os.path.join(work, 'environment.yml')
+
+  state = {}
+  def build():
+    state['service'] = service.Service(conf)
+    state['service'].build()
+  def save():
+    state['service'].save(environment)
+  def load():
+    state['service'] = service.Service(environment=environment)
+  def ps():
+    state['service'].ps()
+  def stop():
+    state['service'].stop()
+  def start():
+    state['service'].start()
+  def destroy():
+    state['service'].destroy()
+
+  results = []
+  try:
+    for name, operation in zip(OPERATIONS, [build, save, load, ps, stop, start, destroy]):
+      daemon.resetCalls()
+      per_operation = resetPeak()
+      began = time.time()
+      operation()
+      results.append({'operation': name, 'seconds': time.time() - began, 'calls': daemon.totalCalls(),
+        'peak_mb': peakMemory(), 'per_operation': per_operation})
+  finally:
+    daemon.stop()
+    os.chdir(cwd)
+    shutil.rmtree(work, True)
+
+  return results
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser()
+  parser.add_option('-l', '--latency', type='float', default=0.0, help='Seconds added to every API call')
+  parser.add_option('-b', '--backend', choices=['threads', 'async'], default='threads')
+  parser.add_option('-s', '--size', type='int', help='Override the size of each scenario')
+  parser.add_option('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+  opts, scenarios = parser.parse_args()
+
+  if opts.child:
+    print json.dumps(runScenario(scenarios[0], opts.latency, opts.backend, opts.size))
+    sys.stdout.flush()
+    # Skip waiting on the threads still talking to the daemon that just went away
+    os._exit(0)
+
+  print 'latency: %.3fs  backend: %s' % (opts.latency, opts.backend)
+  print '{0:<10}{1:<10}{2:>12}{3:>10}{4:>14}'.format('scenario', 'operation', 'wall (s)', 'calls',
+    'peak (MB)' if resetPeak() else 'peak so far (MB)')
+  for scenario in scenarios or SCENARIOS:
+    command = [sys.executable, __file__, '--child', '-l', str(opts.latency), '-b', opts.backend, scenario]
+    if opts.size:
+      command.extend(['-s', str(opts.size)])
+    output = subprocess.check_output(command)
+    for result in json.loads(output.strip().splitlines()[-1]):
+      print '{0:<10}{1:<10}{2:>12.3f}{3:>10}{4:>14.1f}'.format(scenario, result['operation'], result['seconds'],
+        result['calls'], result['peak_mb'])
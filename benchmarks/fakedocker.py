@@ -0,0 +1,334 @@
+# An in-process stand in for the parts of the Docker remote API maestro uses. State is kept in memory,
+# every endpoint can be given a latency to simulate a loaded daemon and calls are counted per endpoint.
+#
+#   daemon = FakeDocker('/tmp/docker.sock', latency={'containers.start': 0.01})
+#   daemon.start()
+#   py_backend.configure(base_url='unix://' + daemon.path)
+
+import os, sys, re, json, time, threading, socket, urlparse, Queue
+import SocketServer, BaseHTTPServer
+
+class FakeDocker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+  request_queue_size = 512
+
+  def __init__(self, path, latency=None, default_latency=0):
+    if os.path.exists(path):
+      os.remove(path)
+    SocketServer.UnixStreamServer.__init__(self, path, Handler)
+    self.path = path
+    self.latency = latency or {}
+    self.default_latency = default_latency
+    self.lock = threading.Lock()
+    self.calls = {}
+    self.images = {}
+    self.tags = {}
+    self.containers = {}
+    self.subscribers = []
+    self.next_id = 0
+
+    # Every container "listens" on this port of 127.0.0.1 so require probes succeed
+    self.service = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.service.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.service.bind(('127.0.0.1', 0))
+    self.service.listen(1024)
+    self.service_port = self.service.getsockname()[1]
+
+    self.addImage('ubuntu:latest')
+
+  def start(self):
+    for target in (self.serve_forever, self._accept):
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+    return self
+
+  def stop(self):
+    # Lets the event streams finish
+    with self.lock:
+      for subscriber in self.subscribers:
+        subscriber.put(None)
+    self.shutdown()
+    self.server_close()
+    self.service.close()
+    os.remove(self.path)
+
+  def get_request(self):
+    # BaseHTTPRequestHandler expects a client address
+    request, address = SocketServer.UnixStreamServer.get_request(self)
+    return request, ('local', 0)
+
+  def handle_error(self, request, client_address):
+    # Clients hanging up on a stream is expected
+    if not isinstance(sys.exc_info()[1], socket.error):
+      SocketServer.UnixStreamServer.handle_error(self, request, client_address)
+
+  def totalCalls(self):
+    with self.lock:
+      return sum(self.calls.values())
+
+  def resetCalls(self):
+    with self.lock:
+      calls, self.calls = self.calls, {}
+    return calls
+
+  def newId(self):
+    with self.lock:
+      self.next_id += 1
+      return '%064x' % (0xabc0000000000000 + self.next_id)
+
+  def addImage(self, name=None, size=1024 * 1024, parent=''):
+    image_id = self.newId()
+    self.images[image_id] = {'id': image_id, 'parent': parent, 'author': '', 'Size': size, 'created': time.time()}
+    if name:
+      self.tags[_qualify(name)] = image_id
+    return image_id
+
+  def findImage(self, name):
+    image_id = self.tags.get(_qualify(name))
+    if image_id:
+      return self.images[image_id]
+    return _byPrefix(self.images, name)
+
+  def findContainer(self, name):
+    return _byPrefix(self.containers, name)
+
+  def publish(self, status, container_id):
+    event = json.dumps({'status': status, 'id': container_id, 'time': int(time.time())})
+    with self.lock:
+      for subscriber in self.subscribers:
+        subscriber.put(event)
+
+  def _accept(self):
+    while True:
+      try:
+        connection, address = self.service.accept()
+        connection.close()
+      except socket.error:
+        return
+
+def _qualify(name):
+  return name if ':' in name.split('/')[-1] else name + ':latest'
+
+def _byPrefix(items, prefix):
+  if prefix in items:
+    return items[prefix]
+  for key in items:
+    if key.startswith(prefix):
+      return items[key]
+  return None
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  ROUTES = [
+    ('GET', r'/version$', 'version'),
+    ('GET', r'/events$', 'events'),
+    ('GET', r'/images/json$', 'images.list'),
+    ('GET', r'/images/(?P<name>.+)/json$', 'images.inspect'),
+    ('POST', r'/images/create$', 'images.pull'),
+    ('POST', r'/images/(?P<name>.+)/tag$', 'images.tag'),
+    ('DELETE', r'/images/(?P<name>.+)$', 'images.remove'),
+    ('POST', r'/build$', 'images.build'),
+    ('POST', r'/commit$', 'containers.commit'),
+    ('GET', r'/containers/json$', 'containers.list'),
+    ('POST', r'/containers/create$', 'containers.create'),
+    ('GET', r'/containers/(?P<id>[^/]+)/json$', 'containers.inspect'),
+    ('POST', r'/containers/(?P<id>[^/]+)/(?P<action>start|stop|kill|restart)$', 'containers.'),
+    ('DELETE', r'/containers/(?P<id>[^/]+)$', 'containers.remove')
+  ]
+
+  def do_GET(self):
+    self._dispatch('GET')
+
+  def do_POST(self):
+    self._dispatch('POST')
+
+  def do_DELETE(self):
+    self._dispatch('DELETE')
+
+  def _dispatch(self, method):
+    url = urlparse.urlparse(self.path)
+    path = re.sub(r'^/v[0-9.]+', '', url.path)
+    self.params = dict(urlparse.parse_qsl(url.query))
+    length = int(self.headers.get('Content-Length') or 0)
+    self.body = self.rfile.read(length) if length else ''
+
+    for route_method, pattern, endpoint in self.ROUTES:
+      match = re.match(pattern, path)
+      if route_method == method and match:
+        args = match.groupdict()
+        if endpoint.endswith('.'):
+          endpoint += args['action']
+
+        server = self.server
+        with server.lock:
+          server.calls[endpoint] = server.calls.get(endpoint, 0) + 1
+        latency = server.latency.get(endpoint, server.default_latency)
+        if latency:
+          time.sleep(latency)
+
+        getattr(self, '_' + endpoint.replace('.', '_'))(**args)
+        return
+
+    self._reply(404, 'Unknown endpoint %s %s' % (method, path))
+
+  def _reply(self, status, body='', content_type='text/plain'):
+    if not isinstance(body, basestring):
+      body = json.dumps(body)
+      content_type = 'application/json'
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _version(self):
+    self._reply(200, {'Version': '0.7.0', 'GoVersion': 'go1.2'})
+
+  def _events(self):
+    events = Queue.Queue()
+    with self.server.lock:
+      self.server.subscribers.append(events)
+
+    self.send_response(200)
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+    try:
+      while True:
+        event = events.get()
+        if event is None:
+          self.wfile.write('0\r\n\r\n')
+          break
+        self.wfile.write('%x\r\n%s\r\n' % (len(event), event))
+        self.wfile.flush()
+    except socket.error:
+      pass
+    finally:
+      with self.server.lock:
+        self.server.subscribers.remove(events)
+      self.close_connection = 1
+
+  ## Images
+
+  def _images_list(self):
+    result = []
+    for tag, image_id in self.server.tags.items():
+      repository, name = tag.rsplit(':', 1)
+      image = self.server.images[image_id]
+      result.append({'Repository': repository, 'Tag': name, 'Id': image_id, 'Size': image['Size'],
+        'VirtualSize': image['Size'], 'Created': int(image['created'])})
+    self._reply(200, result)
+
+  def _images_inspect(self, name):
+    image = self.server.findImage(name)
+    if not image:
+      return self._reply(404, 'No such image: ' + name)
+    self._reply(200, image)
+
+  def _images_pull(self):
+    name = self.params['fromImage']
+    if self.params.get('tag'):
+      name += ':' + self.params['tag']
+    self.server.addImage(name)
+    # Progress is streamed chunked like the real daemon does
+    self.send_response(200)
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+    for message in ['{"status":"Pulling repository %s"}\r\n' % name, '{"status":"Download complete"}\r\n']:
+      self.wfile.write('%x\r\n%s\r\n' % (len(message), message))
+    self.wfile.write('0\r\n\r\n')
+
+  def _images_tag(self, name):
+    image = self.server.findImage(name)
+    if not image:
+      return self._reply(404, 'No such image: ' + name)
+    self.server.tags['%s:%s' % (self.params['repo'], self.params.get('tag') or 'latest')] = image['id']
+    self._reply(201)
+
+  def _images_remove(self, name):
+    server = self.server
+    if _qualify(name) in server.tags:
+      image_id = server.tags.pop(_qualify(name))
+      if image_id in server.tags.values():
+        return self._reply(200, [{'Untagged': name}])
+    else:
+      image = server.findImage(name)
+      if not image:
+        return self._reply(404, 'No such image: ' + name)
+      image_id = image['id']
+
+    server.images.pop(image_id, None)
+    self._reply(200, [{'Deleted': image_id}])
+
+  def _images_build(self):
+    # The context isn't looked at. The base image the Dockerfile names would have to exist already.
+    image_id = self.server.addImage(size=2 * 1024 * 1024)
+    self._reply(200, 'Step 1 : FROM ubuntu\nSuccessfully built %s\n' % image_id[:12])
+
+  ## Containers
+
+  def _containers_commit(self):
+    container = self.server.findContainer(self.params['container'])
+    if not container:
+      return self._reply(404, 'No such container')
+    self._reply(201, {'Id': self.server.addImage(parent=container['Image'])})
+
+  def _containers_list(self):
+    result = []
+    for container in self.server.containers.values():
+      result.append({'Id': container['ID'], 'Image': container['Image'], 'Command': ' '.join(container['Config'].get('Cmd') or []),
+        'Created': int(container['Created']), 'Ports': [],
+        'Status': 'Up 1 seconds' if container['State']['Running'] else 'Exit 0'})
+    self._reply(200, result)
+
+  def _containers_create(self):
+    config = json.loads(self.body)
+    image = self.server.findImage(config['Image'])
+    if not image:
+      return self._reply(404, 'No such image: ' + config['Image'])
+
+    container_id = self.server.newId()
+    self.server.containers[container_id] = {'ID': container_id, 'Image': image['id'], 'Config': config,
+      'Created': time.time(), 'State': {'Running': False, 'ExitCode': 0},
+      'NetworkSettings': {'IPAddress': '', 'Ports': {}}, 'Volumes': {}}
+    self.server.publish('create', container_id)
+    self._reply(201, {'Id': container_id})
+
+  def _containers_inspect(self, id):
+    container = self.server.findContainer(id)
+    if not container:
+      return self._reply(404, 'No such container: ' + id)
+    self._reply(200, container)
+
+  def _containers_start(self, id, action):
+    self._setRunning(id, True, 'start')
+
+  def _containers_restart(self, id, action):
+    self._setRunning(id, True, 'restart')
+
+  def _containers_stop(self, id, action):
+    self._setRunning(id, False, 'die')
+
+  def _containers_kill(self, id, action):
+    self._setRunning(id, False, 'kill')
+
+  def _containers_remove(self, id):
+    container = self.server.findContainer(id)
+    if not container:
+      return self._reply(404, 'No such container: ' + id)
+    del self.server.containers[container['ID']]
+    self.server.publish('destroy', container['ID'])
+    self._reply(204)
+
+  def _setRunning(self, id, running, status):
+    container = self.server.findContainer(id)
+    if not container:
+      return self._reply(404, 'No such container: ' + id)
+    container['State']['Running'] = running
+    container['NetworkSettings']['IPAddress'] = '127.0.0.1' if running else ''
+    self.server.publish(status, container['ID'])
+    self._reply(204)
+
+  def log_message(self, *args):
+    pass
@@ -0,0 +1,617 @@
+import socket, select, errno, os, fcntl, threading, json, urllib, shlex, re, time, sys, Queue
+from collections import deque
+import py_backend, tracing, metrics
+from exceptions import MaestroError
+from logs import demux
+
+# The API version docker-py talks, so both backends see the same responses
+API_VERSION = '1.6'
+
+# Calls are counted under the name of the PyBackend method that makes them so metrics match across backends
+METHODS = {
+  'POST /containers/create': 'create_container',
+  'POST /containers/{id}/start': 'start_container',
+  'POST /containers/{id}/stop': 'stop_container',
+  'POST /containers/{id}/kill': 'kill_container',
+  'DELETE /containers/{id}': 'remove_container',
+  'GET /containers/json': 'list_containers',
+  'GET /containers/{id}/json': 'inspect_container',
+  'POST /commit': 'commit_container',
+  'POST /containers/{id}/attach': 'attach_container',
+  'POST /build': 'build_image',
+  'DELETE /images/{id}': 'remove_image',
+  'GET /images/{id}/json': 'inspect_image',
+  'GET /images/json': 'images',
+  'POST /images/{id}/tag': 'tag_image',
+  'POST /images/create': 'pull_image'
+}
+ACTIONS = ('json', 'start', 'stop', 'kill', 'restart', 'attach', 'wait', 'tag', 'push', 'history')
+
+class Future:
+  # The eventual result of a call to the daemon
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+    self.callbacks = []
+    self.lock = threading.Lock()
+
+  def result(self, timeout=None):
+    if not self.done.wait(timeout):
+      raise MaestroError('Timed out waiting for the Docker daemon')
+    if self.error:
+      raise self.error[0], self.error[1], self.error[2]
+    return self.value
+
+  def then(self, func):
+    # A future for func applied to this one's result. When func returns a future that one is waited on instead.
+    chained = Future()
+    def resolve(future):
+      if future.error:
+        chained.fail(future.error)
+        return
+      try:
+        value = func(future.value)
+      except Exception:
+        chained.fail(sys.exc_info())
+        return
+      if isinstance(value, Future):
+        value.subscribe(lambda inner: chained.fail(inner.error) if inner.error else chained.succeed(inner.value))
+      else:
+        chained.succeed(value)
+
+    self.subscribe(resolve)
+    return chained
+
+  def subscribe(self, callback):
+    with self.lock:
+      if not self.done.is_set():
+        self.callbacks.append(callback)
+        return
+    callback(self)
+
+  def succeed(self, value):
+    self.value = value
+    self._finish()
+
+  def fail(self, exc_info):
+    self.error = exc_info
+    self._finish()
+
+  def _finish(self):
+    with self.lock:
+      self.done.set()
+      callbacks, self.callbacks = self.callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+def gather(futures):
+  # Waits for every future and then raises the first failure, if any, so nothing is left running
+  results = []
+  error = None
+  for future in futures:
+    try:
+      results.append(future.result())
+    except Exception:
+      results.append(None)
+      error = error or sys.exc_info()
+  if error:
+    raise error[0], error[1], error[2]
+  return results
+
+class Loop:
+  """
+  Drives any number of HTTP requests to the daemon's unix socket from a single thread using non-blocking
+  sockets. Requests beyond max_requests wait their turn.
+  """
+  def __init__(self, path, timeout=60, max_requests=256):
+    self.path = path
+    self.timeout = timeout
+    self.max_requests = max_requests
+    self.pending = deque()
+    self.active = []
+    self.lock = threading.Lock()
+    self.thread = None
+    self.wake_read, self.wake_write = os.pipe()
+    for fd in (self.wake_read, self.wake_write):
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+  def submit(self, exchange):
+    with self.lock:
+      self.pending.append(exchange)
+      if not self.thread:
+        self.thread = threading.Thread(target=self._run, name='docker-loop')
+        self.thread.daemon = True
+        self.thread.start()
+    self.wake()
+    return exchange.future
+
+  def wake(self):
+    try:
+      os.write(self.wake_write, 'x')
+    except OSError:
+      # Already full of wake ups
+      pass
+
+  def _run(self):
+    while True:
+      backlog = False
+      with self.lock:
+        while self.pending and len(self.active) < self.max_requests:
+          exchange = self.pending.popleft()
+          connected = exchange.connect(self.path, self.timeout)
+          if connected is None:
+            # The daemon's listen backlog is full so try again shortly
+            self.pending.appendleft(exchange)
+            backlog = True
+            break
+          if connected:
+            self.active.append(exchange)
+
+      poller = select.poll()
+      poller.register(self.wake_read, select.POLLIN)
+      for exchange in self.active:
+        if exchange.outgoing:
+          poller.register(exchange.sock, select.POLLOUT)
+        elif not (exchange.paused and exchange.paused()):
+          poller.register(exchange.sock, select.POLLIN)
+
+      events = dict(poller.poll(10 if backlog else 1000))
+      if self.wake_read in events:
+        try:
+          os.read(self.wake_read, 4096)
+        except OSError:
+          pass
+
+      now = time.time()
+      for exchange in list(self.active):
+        event = events.get(exchange.sock.fileno())
+        if event:
+          exchange.handle(event)
+        elif exchange.deadline and now > exchange.deadline:
+          exchange.abort(MaestroError('Timed out waiting for the Docker daemon: %s %s' % (exchange.method, exchange.path)))
+
+        if exchange.finished:
+          self.active.remove(exchange)
+
+class Exchange:
+  # One request and its response. With on_data the body is handed over as it arrives instead of collected
+  # and the socket isn't read while paused() says the receiver is behind.
+  def __init__(self, method, path, body=None, headers=None, timeout=True, on_data=None, paused=None):
+    self.method = method
+    self.path = path
+    self.body = body or ''
+    self.headers = headers or {}
+    self.timeout = timeout
+    self.on_data = on_data
+    self.paused = paused
+    self.future = Future()
+    self.finished = False
+    self.sock = None
+    self.outgoing = ''
+    self.deadline = None
+    self.response = _Response(self._data)
+    self.chunks = []
+
+  def connect(self, path, timeout):
+    head = ['%s /v%s%s HTTP/1.1' % (self.method, API_VERSION, self.path), 'Host: docker', 'Connection: close',
+      'Content-Length: %d' % len(self.body)]
+    head.extend('%s: %s' % header for header in self.headers.items())
+    self.outgoing = '\r\n'.join(head) + '\r\n\r\n' + self.body
+
+    if self.timeout and not self.deadline:
+      self.deadline = time.time() + (self.timeout if self.timeout is not True else timeout)
+
+    # Returns None when the connection should be attempted again
+    try:
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.sock.setblocking(0)
+      result = self.sock.connect_ex(path)
+      if result == errno.EAGAIN:
+        self.sock.close()
+        if self.deadline and time.time() > self.deadline:
+          raise MaestroError('Timed out connecting to the Docker daemon')
+        return None
+      if result not in (0, errno.EINPROGRESS):
+        raise socket.error(result, os.strerror(result))
+      return True
+    except Exception:
+      self.abort(sys.exc_info()[1])
+      return False
+
+  def handle(self, event):
+    try:
+      if self.outgoing and event & select.POLLOUT:
+        sent = self.sock.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+      elif event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+        data = self.sock.recv(65536)
+        if data:
+          self.response.feed(data)
+        else:
+          self.response.eof()
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+        self.abort(e)
+        return
+    except Exception, e:
+      self.abort(e)
+      return
+
+    if self.response.complete:
+      self._complete()
+
+  def abort(self, error):
+    try:
+      raise error
+    except Exception:
+      self._close()
+      self.future.fail(sys.exc_info())
+
+  def _data(self, chunk):
+    if self.on_data and self.response.status < 400:
+      self.on_data(chunk)
+    else:
+      self.chunks.append(chunk)
+
+  def _complete(self):
+    self._close()
+    body = ''.join(self.chunks)
+    if self.response.status >= 400:
+      from requests.exceptions import HTTPError
+      # Worded like the errors docker-py raises
+      message = '%d %s Error: %s' % (self.response.status, 'Client' if self.response.status < 500 else 'Server',
+        self.response.reason)
+      if body.strip():
+        message += ' ("%s")' % body.strip()
+      self.future.fail(_exc_info(HTTPError(message)))
+    else:
+      self.future.succeed(body)
+
+  def _close(self):
+    self.finished = True
+    if self.sock:
+      self.sock.close()
+
+class _Response:
+  # Incremental HTTP/1.1 response parser. Bodies can be sized, chunked or run until the connection closes.
+  def __init__(self, emit):
+    self.emit = emit
+    self.buffer = ''
+    self.status = None
+    self.reason = None
+    self.headers = None
+    self.length = None
+    self.received = 0
+    self.chunked = False
+    self.remaining = None
+    self.complete = False
+
+  def feed(self, data):
+    self.buffer += data
+    if self.headers is None:
+      end = self.buffer.find('\r\n\r\n')
+      if end == -1:
+        return
+      lines = self.buffer[:end].split('\r\n')
+      self.buffer = self.buffer[end + 4:]
+      status = lines[0].split(' ', 2)
+      self.status = int(status[1])
+      self.reason = status[2] if len(status) > 2 else ''
+      self.headers = dict((name.strip().lower(), value.strip()) for name, value in
+        (line.split(':', 1) for line in lines[1:] if ':' in line))
+      self.chunked = self.headers.get('transfer-encoding', '').lower() == 'chunked'
+      if 'content-length' in self.headers:
+        self.length = int(self.headers['content-length'])
+      if self.status in (204, 304) or self.length == 0:
+        self.complete = True
+        return
+
+    while not self.complete:
+      if self.chunked:
+        if self.remaining is None:
+          end = self.buffer.find('\r\n')
+          if end == -1:
+            return
+          size = int(self.buffer[:end].split(';')[0], 16)
+          self.buffer = self.buffer[end + 2:]
+          if size == 0:
+            self.complete = True
+            return
+          self.remaining = size
+
+        if len(self.buffer) < self.remaining + 2:
+          return
+        self.emit(self.buffer[:self.remaining])
+        self.buffer = self.buffer[self.remaining + 2:]
+        self.remaining = None
+      else:
+        if self.buffer:
+          self.emit(self.buffer)
+          self.received += len(self.buffer)
+          self.buffer = ''
+        if self.length is not None and self.received >= self.length:
+          self.complete = True
+        return
+
+  def eof(self):
+    if self.headers is None or self.chunked or (self.length is not None and self.received < self.length):
+      raise MaestroError('Connection to the Docker daemon closed mid response')
+    self.complete = True
+
+def _exc_info(error):
+  try:
+    raise error
+  except Exception:
+    return sys.exc_info()
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def loop():
+  global _loop
+  with _loop_lock:
+    if not _loop:
+      base_url = py_backend.settings['base_url']
+      if not base_url.startswith('unix:'):
+        raise MaestroError('The async backend only talks to the daemon over a unix socket, not ' + base_url)
+      _loop = Loop('/' + base_url[len('unix:'):].lstrip('/'), py_backend.settings['timeout'],
+        py_backend.settings['max_requests'])
+    return _loop
+
+class AsyncBackend:
+  """
+  Same calls as PyBackend but every request goes through one event loop thread instead of blocking a thread
+  per request. Each call has an _async form that returns a Future so hundreds can be in flight at once.
+  """
+  def __init__(self, loop=None):
+    self.loop = loop
+
+  def request(self, method, path, params=None, body=None, headers=None, timeout=True, on_data=None, paused=None):
+    if params:
+      query = dict((key, int(value) if isinstance(value, bool) else value) for key, value in params.items()
+        if value is not None)
+      if query:
+        path += '?' + urllib.urlencode(query)
+
+    token = tracing.begin('%s %s' % (method, path.split('?')[0]), 'docker')
+    name = _endpoint(method, path)
+    began = time.time()
+    future = (self.loop or loop()).submit(Exchange(method, path, body, headers, timeout, on_data, paused))
+    future.subscribe(lambda future: metrics.observe(name, time.time() - began, future.error is not None))
+    if token:
+      future.subscribe(lambda future: tracing.end(token))
+    return future
+
+  def request_json(self, method, path, params=None, data=None, timeout=True):
+    body = None
+    headers = None
+    if data is not None:
+      # Go <1.1 can't unserialize null to a string
+      body = json.dumps(dict((key, value) for key, value in data.items() if value is not None))
+      headers = {'Content-Type': 'application/json'}
+    return self.request(method, path, params, body, headers, timeout).then(lambda body: json.loads(body) if body else None)
+
+  ## Container management
+
+  def create_container_async(self, image_id, config):
+    return self.request_json('POST', '/containers/create', data=_containerConfig(image_id, config)).then(
+      lambda result: result['Id'])
+
+  def run_container_async(self, image_id, config):
+    return self.create_container_async(image_id, config).then(
+      lambda container_id: self.start_container_async(container_id).then(lambda ignored: container_id))
+
+  def start_container_async(self, container_id, mounts=None):
+    start_config = {'LxcConf': None}
+    if mounts:
+      start_config['Binds'] = ['%s:%s' % (host, dest) for host, dest in mounts.items()]
+    return self.request_json('POST', '/containers/%s/start' % container_id, data=start_config)
+
+  def stop_container_async(self, container_id, timeout=10):
+    return self.request('POST', '/containers/%s/stop' % container_id, {'t': timeout},
+      timeout=max(timeout, py_backend.settings['timeout']))
+
+  def kill_container_async(self, container_id):
+    return self.request('POST', '/containers/%s/kill' % container_id)
+
+  def remove_container_async(self, container_id, timeout=None):
+    if timeout is not None:
+      return self.stop_container_async(container_id, timeout).then(
+        lambda ignored: self.remove_container_async(container_id))
+    return self.request('DELETE', '/containers/' + container_id, {'v': False, 'link': False})
+
+  def list_containers_async(self):
+    return self.request_json('GET', '/containers/json', {'all': 1, 'trunc_cmd': 0, 'limit': -1})
+
+  def inspect_container_async(self, container_id):
+    return self.request_json('GET', '/containers/%s/json' % container_id)
+
+  def commit_container_async(self, container_id):
+    return self.request_json('POST', '/commit', {'container': container_id}, data={})
+
+  def create_container(self, image_id, config):
+    return self.create_container_async(image_id, config).result()
+
+  def run_container(self, image_id, config):
+    return self.run_container_async(image_id, config).result()
+
+  def start_container(self, container_id, mounts=None):
+    self.start_container_async(container_id, mounts).result()
+
+  def stop_container(self, container_id, timeout=10):
+    self.stop_container_async(container_id, timeout).result()
+
+  def kill_container(self, container_id):
+    self.kill_container_async(container_id).result()
+
+  def remove_container(self, container_id, timeout=None):
+    self.remove_container_async(container_id, timeout).result()
+
+  def list_containers(self):
+    return self.list_containers_async().result()
+
+  def inspect_container(self, container_id):
+    return self.inspect_container_async(container_id).result()
+
+  def commit_container(self, container_id):
+    return self.commit_container_async(container_id).result()
+
+  def attach_container(self, container_id, logs=False):
+    output = self.stream('POST', '/containers/%s/attach' % container_id,
+      {'stdout': 1, 'stderr': 1, 'stream': 1, 'logs': logs})
+    return demux(output) if logs else output
+
+  def container_logs_async(self, container_id):
+    return self.request('POST', '/containers/%s/attach' % container_id, 
+      {'stdout': 1, 'stderr': 1, 'logs': 1}).then(lambda output: ''.join(demux([output])))
+
+  def container_logs(self, container_id):
+    return self.container_logs_async(container_id).result()
+
+  def stream(self, method, path, params=None, body=None, headers=None, buffer=64):
+    # Output is handed over as it arrives. Once the reader is buffer chunks behind the daemon isn't read
+    # until it catches up, the same backpressure a blocking socket gives.
+    chunks = Queue.Queue()
+    future = self.request(method, path, params, body, headers, timeout=None, on_data=chunks.put,
+      paused=lambda: chunks.qsize() >= buffer)
+    future.subscribe(lambda future: chunks.put(None))
+    while True:
+      behind = chunks.qsize() >= buffer
+      chunk = chunks.get()
+      if behind:
+        (self.loop or loop()).wake()
+      if chunk is None:
+        break
+      yield chunk
+    future.result()
+
+  ## Image management
+
+  def build_image_async(self, fileobj=None, path=None, nocache=False):
+    def parse(output):
+      match = re.search(r'Successfully built ([0-9a-f]+)', output)
+      return (match.group(1) if match else None), output
+    return self.request('POST', '/build', *self._build_request(fileobj, path, nocache), timeout=None).then(parse)
+
+  def _build_request(self, fileobj, path, nocache):
+    # The params, body and headers of a build
+    params = {'nocache': nocache, 'q': False, 'rm': False}
+    body = None
+    headers = None
+    if fileobj is not None:
+      from docker.utils import mkbuildcontext
+      context = mkbuildcontext(fileobj)
+      body = context.read()
+      context.close()
+      headers = {'Content-Type': 'application/tar'}
+    else:
+      params['remote'] = path
+    return params, body, headers
+
+  def remove_image_async(self, image_id):
+    return self.request('DELETE', '/images/' + image_id)
+
+  def inspect_image_async(self, image_id):
+    return self.request_json('GET', '/images/%s/json' % image_id)
+
+  def images_async(self, name=None):
+    return self.request_json('GET', '/images/json', {'filter': name, 'only_ids': 0, 'all': 0})
+
+  def tag_image_async(self, image_id, name, tag):
+    return self.request('POST', '/images/%s/tag' % image_id, {'repo': name, 'tag': tag, 'force': 0})
+
+  def pull_image_async(self, name):
+    return self.request('POST', '/images/create', self._pull_params(name), timeout=None)
+
+  def _pull_params(self, name):
+    tag = None
+    if name.split('/')[-1].count(':') == 1:
+      name, tag = name.rsplit(':', 1)
+    return {'fromImage': name, 'tag': tag}
+
+  def build_image(self, fileobj=None, path=None, nocache=False, stream=False):
+    if stream:
+      return self.stream('POST', '/build', *self._build_request(fileobj, path, nocache))
+    return self.build_image_async(fileobj, path, nocache).result()
+
+  def remove_image(self, image_id):
+    self.remove_image_async(image_id).result()
+
+  def inspect_image(self, image_id):
+    return self.inspect_image_async(image_id).result()
+
+  def images(self, name=None):
+    return self.images_async(name).result()
+
+  def tag_image(self, image_id, name, tag):
+    self.tag_image_async(image_id, name, tag).result()
+
+  def pull_image(self, name, stream=False):
+    if stream:
+      return self.stream('POST', '/images/create', self._pull_params(name))
+    return self.pull_image_async(name).result()
+
+  def gather(self, futures):
+    return gather(futures)
+
+  ## Events
+
+  def monitor(self):
+    return py_backend.monitor()
+
+  ## Helpers
+
+  def get_ip_address(self, container_id):
+    return py_backend.address(container_id, lambda container_id:
+      self.inspect_container(container_id)['NetworkSettings']['IPAddress'])
+
+def _endpoint(method, path):
+  # Ids and image names are left out so every call to the same endpoint is counted together
+  parts = path.split('?')[0].strip('/').split('/')
+  if parts[0] in ('containers', 'images') and len(parts) > 1 and parts[1] not in ('create', 'json'):
+    # Image names can have slashes in them
+    action = parts[-1:] if len(parts) > 2 and parts[-1] in ACTIONS else []
+    parts = [parts[0], '{id}'] + action
+  endpoint = '%s /%s' % (method, '/'.join(parts))
+  return METHODS.get(endpoint, endpoint)
+
+def _containerConfig(image_id, config):
+  # The create payload docker-py would send for the same keyword arguments
+  command = config.get('command')
+  if isinstance(command, basestring):
+    command = shlex.split(str(command))
+  environment = config.get('environment')
+  if isinstance(environment, dict):
+    environment = ['%s=%s' % item for item in environment.items()]
+  ports = config.get('ports')
+  if ports and isinstance(ports, list):
+    exposed = {}
+    for port in ports:
+      if isinstance(port, tuple):
+        port = '%s/%s' % port if len(port) == 2 else port[0]
+      exposed[str(port)] = {}
+    ports = exposed
+  volumes = config.get('volumes')
+  if volumes and isinstance(volumes, list):
+    volumes = dict((volume, {}) for volume in volumes)
+  detach = config.get('detach', False)
+
+  return {
+    'Hostname': config.get('hostname'),
+    'ExposedPorts': ports,
+    'User': config.get('user'),
+    'Tty': config.get('tty', False),
+    'OpenStdin': config.get('stdin_open', False),
+    'Memory': config.get('mem_limit', 0),
+    'AttachStdin': not detach and config.get('stdin_open', False),
+    'AttachStdout': not detach,
+    'AttachStderr': not detach,
+    'Env': environment,
+    'Cmd': command,
+    'Dns': config.get('dns'),
+    'Image': image_id,
+    'Volumes': volumes,
+    'VolumesFrom': config.get('volumes_from'),
+    'Privileged': config.get('privileged', False)
+  }
@@ -0,0 +1,115 @@
+import os, hashlib, marshal, tempfile, json, threading
+import utils
+
+# Bump whenever the layout of a cached plan changes
+PLAN_FORMAT = 1
+
+def cacheDir():
+  # Kept out of ~/.maestro where every directory is a named environment
+  path = os.environ.get('MAESTRO_CACHE_DIR') or os.path.join(os.environ.get('XDG_CACHE_HOME') or
+    os.path.expanduser(os.path.join('~', '.cache')), 'maestro')
+  if not os.path.exists(path):
+    try:
+      os.makedirs(path)
+    except OSError:
+      # Someone else may have just created it
+      if not os.path.isdir(path):
+        raise
+  return path
+
+def loadPlan(filename):
+  # Returns the parsed config along with its start order and dependency levels. The result is cached
+  # in a compact binary form keyed by a hash of the file contents so unchanged files skip YAML parsing
+  # and planning altogether.
+  with open(filename, 'rb') as input_file:
+    data = input_file.read()
+  digest = hashlib.sha1(data).hexdigest()
+
+  path = None
+  try:
+    path = _planPath(filename)
+    with open(path, 'rb') as input_file:
+      plan_format, plan_digest, config, start_order, levels = marshal.load(input_file)
+    if plan_format == PLAN_FORMAT and plan_digest == digest:
+      return config, start_order, levels
+  except (OSError, IOError, EOFError, ValueError, TypeError):
+    pass
+
+  config = utils.loadYaml(data)
+  start_order, levels = utils.plan(config['templates'])
+  if path:
+    _store(path, (PLAN_FORMAT, digest, config, start_order, levels))
+
+  return config, start_order, levels
+
+def storePlan(filename, data, config, start_order, levels):
+  # Lets a command that just wrote the file seed the cache for the next command that reads it
+  try:
+    path = _planPath(filename)
+  except OSError:
+    return
+  _store(path, (PLAN_FORMAT, hashlib.sha1(data).hexdigest(), config, start_order, levels))
+
+def buildKey(*inputs):
+  return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+_builds = None
+_builds_lock = threading.Lock()
+
+def buildCache():
+  global _builds
+  with _builds_lock:
+    if not _builds:
+      _builds = BuildCache(os.path.join(cacheDir(), 'builds.json'))
+    return _builds
+
+class BuildCache:
+  # Maps the hash of everything that goes into a template build to the image it produced
+  def __init__(self, filename):
+    self.filename = filename
+    self.lock = threading.Lock()
+    self.entries = None
+
+  def get(self, key):
+    with self.lock:
+      if self.entries is None:
+        self.entries = self._read()
+      return self.entries.get(key)
+
+  def put(self, key, image_id):
+    with self.lock:
+      # Merge with whatever other processes have written in the meantime
+      self.entries = self._read()
+      self.entries[key] = image_id
+      _write(self.filename, json.dumps(self.entries))
+
+  def _read(self):
+    try:
+      with open(self.filename, 'r') as input_file:
+        return json.load(input_file)
+    except (IOError, ValueError):
+      return {}
+
+def _planPath(filename):
+  # One cache entry per file so entries don't pile up as the file changes
+  return os.path.join(cacheDir(), hashlib.sha1(os.path.abspath(filename)).hexdigest() + '.plan')
+
+def _store(path, value):
+  try:
+    serialized = marshal.dumps(value)
+  except ValueError:
+    # The config holds something marshal can't represent so it just doesn't get cached
+    return
+
+  _write(path, serialized)
+
+def _write(path, data):
+  # Write to a temporary file first so other processes never see a partial entry. A cache that
+  # can't be written is not an error.
+  try:
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as output_file:
+      output_file.write(data)
+    os.rename(temp, path)
+  except (OSError, IOError):
+    pass
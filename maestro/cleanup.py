@@ -0,0 +1,231 @@
+import os, glob, re, json, time, tempfile, fcntl, logging
+import utils, store, scheduler, py_backend
+
+# Images built from a generated Dockerfile carry the template's service.name:version as their maintainer
+MAESTRO_AUTHOR = re.compile(r'^service\.\S+:\S+$')
+
+def registryPath():
+  # Every environment ever saved is recorded here so gc can find local ones in any directory
+  return os.environ.get('MAESTRO_REGISTRY') or os.path.expanduser(os.path.join('~', '.local', 'share', 'maestro',
+    'environments.json'))
+
+def register(filename):
+  # Called on every save. The file is only rewritten the first time an environment is seen.
+  filename = os.path.abspath(filename)
+  path = registryPath()
+  try:
+    if filename in _readRegistry(path)['environments']:
+      return
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path + '.lock', 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      registry = _readRegistry(path)
+      if filename not in registry['environments']:
+        registry['environments'].append(filename)
+        registry.setdefault('since', time.time())
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as output_file:
+          json.dump(registry, output_file)
+        os.rename(temp, path)
+  except (OSError, IOError), e:
+    logging.getLogger('maestro').warning('Unable to record environment %s for gc: %s', filename, e)
+
+def trackedSince():
+  # When environments started being recorded. Anything older may belong to an environment gc can't see.
+  return _readRegistry(registryPath()).get('since') or time.time()
+
+def environments(extra=None):
+  # Every environment maestro knows about: the local one, the named ones, every one that was ever saved and
+  # any given explicitly
+  candidates = [os.path.join(os.getcwd(), '.maestro', 'environment.yml')]
+  for path in ['/var/lib/maestro', os.path.expanduser(os.path.join('~', '.maestro'))]:
+    candidates.extend(sorted(glob.glob(os.path.join(path, '*', 'environment.yml'))))
+  candidates.extend(_readRegistry(registryPath())['environments'])
+  candidates.extend(extra or [])
+
+  result = []
+  for candidate in candidates:
+    candidate = os.path.abspath(candidate)
+    if os.path.exists(candidate) and candidate not in result:
+      result.append(candidate)
+  return result
+
+def references(filenames):
+  # The image and container ids used by environments that haven't been destroyed
+  images = set()
+  containers = set()
+  for filename in filenames:
+    env = _loadEnvironment(filename)
+    if env.get('state') == 'destroyed':
+      continue
+
+    for config in (env.get('templates') or {}).values():
+      if config.get('image_id'):
+        images.add(_short(config['image_id']))
+    for state in (env.get('containers') or {}).values():
+      if state.get('image_id'):
+        images.add(_short(state['image_id']))
+      if state.get('container_id'):
+        containers.add(_short(state['container_id']))
+
+  return images, containers
+
+def collect(filenames, dry_run=False, jobs=8, backend=None, since=None):
+  """
+  Removes the images and stopped containers maestro created that none of the environments in filenames
+  still use. Containers and images created before since are kept, there's no telling which environment
+  they belong to. Returns a report of what was (or with dry_run would be) removed.
+  """
+  backend = backend or py_backend.shared()
+  used_images, used_containers = references(filenames)
+  images = _maestroImages(backend, jobs)
+
+  report = {'containers': [], 'images': [], 'skipped': [], 'errors': [], 'reclaimed': 0}
+
+  # Stopped containers running a maestro image that no environment knows about
+  names = _imageNames(images)
+  orphans = []
+  for entry in backend.list_containers():
+    container_id = _short(entry['Id'])
+    image = names.get(entry['Image'], _short(entry['Image']))
+    if image not in images or container_id in used_containers:
+      # Whatever image a remaining container runs has to stay
+      used_images.add(image)
+      continue
+
+    if entry.get('Status', '').startswith('Up'):
+      report['skipped'].append({'id': container_id, 'image': entry['Image'], 'reason': 'running'})
+      used_images.add(image)
+      continue
+    if since is not None and entry.get('Created', 0) < since:
+      report['skipped'].append({'id': container_id, 'image': entry['Image'], 'reason': 'untracked'})
+      used_images.add(image)
+      continue
+    orphans.append({'id': container_id, 'image': entry['Image']})
+
+  if since is not None:
+    used_images.update(image_id for image_id, image in images.items() if image['created'] < since)
+
+  # Anything an image that stays is built on has to stay too
+  keep = set()
+  for image_id in used_images:
+    while image_id in images and image_id not in keep:
+      keep.add(image_id)
+      image_id = images[image_id]['parent']
+
+  # Images built on other unused images go first
+  removable = [image for image_id, image in images.items() if image_id not in keep]
+  waves = {}
+  for image in removable:
+    waves.setdefault(_depth(images, image['id']), []).append(image)
+
+  if dry_run:
+    report['containers'] = orphans
+    report['images'] = sorted(removable, key=lambda image: image['id'])
+    report['reclaimed'] = sum(image['size'] for image in removable)
+    return report
+
+  def remove(action, item):
+    try:
+      action(item)
+      return True
+    except Exception, e:
+      report['errors'].append({'id': item['id'], 'error': str(e)})
+      return False
+
+  removed = scheduler.parallel(lambda container: remove(lambda item: backend.remove_container(item['id']), container),
+    orphans, jobs)
+  report['containers'] = [container for container, ok in zip(orphans, removed) if ok]
+
+  for depth in sorted(waves, reverse=True):
+    removed = scheduler.parallel(lambda image: remove(lambda item: _removeImage(backend, item), image), waves[depth], jobs)
+    for image, ok in zip(waves[depth], removed):
+      if ok:
+        report['images'].append(image)
+        report['reclaimed'] += image['size']
+
+  return report
+
+def _maestroImages(backend, jobs):
+  # Top level images keyed by short id. Tagged ones are maestro's when tagged service.*, untagged ones when
+  # a generated Dockerfile made them or they were committed from a container running one of maestro's.
+  images = {}
+  for entry in backend.images():
+    image_id = _short(entry.get('Id') or entry.get('id'))
+    image = images.setdefault(image_id, {'id': image_id, 'tags': [], 'size': entry.get('Size', 0), 'parent': None,
+      'created': entry.get('Created', 0)})
+    tags = entry.get('RepoTags') or []
+    if 'Repository' in entry:
+      tags = ['%s:%s' % (entry['Repository'], entry['Tag'])]
+    image['tags'].extend(tag for tag in tags if not tag.startswith('<none>'))
+
+  def inspect(image_id):
+    details = backend.inspect_image(image_id)
+    return _field(details, 'parent'), _field(details, 'author')
+
+  details = dict(zip(images, scheduler.parallel(inspect, images, jobs)))
+  maestro = set()
+  for image_id, image in images.items():
+    parent, author = details[image_id]
+    image['parent'] = _short(parent) if parent else None
+    if any(tag.startswith('service.') for tag in image['tags']) or MAESTRO_AUTHOR.match(author or ''):
+      maestro.add(image_id)
+
+  # Commits of maestro containers
+  changed = True
+  while changed:
+    changed = False
+    for image_id, image in images.items():
+      if image_id not in maestro and not image['tags'] and image['parent'] in maestro:
+        maestro.add(image_id)
+        changed = True
+
+  return dict((image_id, images[image_id]) for image_id in maestro)
+
+def _imageNames(images):
+  names = {}
+  for image_id, image in images.items():
+    for tag in image['tags']:
+      names[tag] = image_id
+      if tag.endswith(':latest'):
+        names[tag[:-len(':latest')]] = image_id
+  return names
+
+def _removeImage(backend, image):
+  # Removing the last tag removes the image
+  if image['tags']:
+    for tag in image['tags']:
+      backend.remove_image(tag)
+  else:
+    backend.remove_image(image['id'])
+
+def _depth(images, image_id):
+  depth = 0
+  while images[image_id]['parent'] in images:
+    image_id = images[image_id]['parent']
+    depth += 1
+  return depth
+
+def _field(details, name):
+  return details.get(name, details.get(name.capitalize()))
+
+def _short(image_id):
+  return image_id[:12]
+
+def _readRegistry(path):
+  try:
+    with open(path, 'r') as input_file:
+      return json.load(input_file)
+  except (OSError, IOError, ValueError):
+    return {'environments': []}
+
+def _loadEnvironment(filename):
+  if store.isStore(filename):
+    db = store.SqliteStore(filename)
+    env = {'state': db.state(), 'templates': db.templates(), 'containers': db.containers()}
+    db.close()
+    return env
+
+  with open(filename, 'r') as input_file:
+    return utils.loadYaml(input_file) or {}
@@ -1,6 +1,6 @@
 import sys, os
 import cmdln
-from . import service
+from . import service, store, cleanup, tracing, metrics
 
 class MaestroCli(cmdln.Cmdln):
     """Usage:
@@ -19,12 +19,31 @@ class MaestroCli(cmdln.Cmdln):
       cmdln.Cmdln.__init__(self, *args, **kwargs)
       cmdln.Cmdln.do_help.aliases.append("h")
 
+    def get_optparser(self):
+      parser = cmdln.Cmdln.get_optparser(self)
+      parser.add_option("--metrics-file", default=os.environ.get('MAESTRO_METRICS_FILE'),
+                        help='Write Prometheus metrics for the Docker calls made to this file when the command finishes, '
+                             'for the node exporter textfile collector. Defaults to $MAESTRO_METRICS_FILE')
+      return parser
+
+    def postoptparse(self):
+      if self.options.metrics_file:
+        metrics.writeOnExit(self.options.metrics_file)
+
     @cmdln.option("-f", "--maestro_file",
                   help='path to the maestro file to use')
     @cmdln.option("-e", "--environment_file",
                   help='path to the environment file to use to save the state of running containers')
     @cmdln.option("-n", "--name",
                   help='Create a global named environment using the provided name')
+    @cmdln.option("-j", "--build-jobs", type="int", default=4,
+                  help='Number of templates to build concurrently')
+    @cmdln.option("-l", "--launch-jobs", type="int", default=16,
+                  help='Number of replicas of a template to launch concurrently')
+    @cmdln.option("--no-cache", action="store_true", default=False,
+                  help='Rebuild every template instead of reusing images from identical earlier builds')
+    @cmdln.option("--trace",
+                  help='Write a Chrome trace-event file of where the time went to this path')
     def do_build(self, subcmd, opts, *args):
       """Setup and start a set of Docker containers.
 
@@ -33,19 +52,13 @@ class MaestroCli(cmdln.Cmdln):
         
         ${cmd_option_list}
       """
-      config = opts.maestro_file
-      if not config:
-        config = os.path.join(os.getcwd(), 'maestro.yml')
+      if opts.trace:
+        tracing.enable(opts.trace)
 
-      if not config.startswith('/'):
-        config = os.path.join(os.getcwd(), config)
-
-      if not os.path.exists(config):
-        sys.stderr.write("No maestro configuration found {0}\n".format(config))
-        exit(1)
+      config = self._verify_config(opts)
             
       containers = service.Service(config)
-      containers.build()
+      containers.build(build_jobs=opts.build_jobs, launch_jobs=opts.launch_jobs, use_cache=not opts.no_cache)
 
       environment = opts.environment_file
       name = opts.name      
@@ -59,10 +72,92 @@ class MaestroCli(cmdln.Cmdln):
       print "Launched."
    
 
+    @cmdln.option("-f", "--maestro_file",
+                  help='path to the maestro file to use')
+    @cmdln.option("-e", "--environment_file",
+                  help='path to the environment file to use to save the state of running containers')
+    @cmdln.option("-n", "--name",
+                  help='Create a global named environment using the provided name')
+    @cmdln.option("-j", "--build-jobs", type="int", default=4,
+                  help='Number of templates to build concurrently')
+    @cmdln.option("-l", "--launch-jobs", type="int", default=16,
+                  help='Number of replicas of a template to launch concurrently')
+    @cmdln.option("--no-cache", action="store_true", default=False,
+                  help='Rebuild changed templates instead of reusing images from identical earlier builds')
+    @cmdln.option("--dry-run", action="store_true", default=False,
+                  help='Only print the plan')
+    @cmdln.option("--trace",
+                  help='Write a Chrome trace-event file of where the time went to this path')
+    def do_apply(self, subcmd, opts, *args):
+      """Bring an existing environment in line with maestro.yml, changing only the templates that differ and the ones that require them.
+
+        usage:
+            apply
+        
+        ${cmd_option_list}
+      """
+      if opts.trace:
+        tracing.enable(opts.trace)
+
+      config = self._verify_config(opts)
+      environment = self._verify_environment(opts)
+
+      containers = service.Service(environment=environment)
+      try:
+        steps = containers.apply(config, build_jobs=opts.build_jobs, launch_jobs=opts.launch_jobs,
+          use_cache=not opts.no_cache, dry_run=opts.dry_run)
+      finally:
+        # Keep track of whatever changed even if a step failed
+        if not opts.dry_run:
+          containers.save(environment)
+
+      if steps is None:
+        exit(1)
+      if steps and not opts.dry_run:
+        print "Applied."
+
+    @cmdln.option("-e", "--environment_file",
+                  help='path to the environment file to use to save the state of running containers')
+    @cmdln.option("-n", "--name",
+                  help='Create a global named environment using the provided name')
+    @cmdln.option("-b", "--batch", type="int", default=16,
+                  help='Number of replicas to add or remove at once')
+    @cmdln.option("--trace",
+                  help='Write a Chrome trace-event file of where the time went to this path')
+    def do_scale(self, subcmd, opts, template, count):
+      """Change the number of replicas of a template in a running environment. Templates that require it are given the new set of addresses.
+
+        usage:
+            scale template count
+        
+        ${cmd_option_list}
+      """
+      if opts.trace:
+        tracing.enable(opts.trace)
+
+      if not count.isdigit():
+        sys.stderr.write("Error: The count must be a number\n")
+        exit(1)
+
+      environment = self._verify_environment(opts)
+
+      containers = service.Service(environment=environment)
+      scaled = False
+      try:
+        scaled = containers.scale(template, int(count), batch=opts.batch)
+      finally:
+        # Keep track of the replicas that were added or removed even if a batch failed
+        containers.save(environment)
+
+      if scaled:
+        print "Scaled."
+
     @cmdln.option("-e", "--environment_file",
                   help='path to the environment file to use to save the state of running containers')
     @cmdln.option("-n", "--name",
                   help='Create a global named environment using the provided name')
+    @cmdln.option("--trace",
+                  help='Write a Chrome trace-event file of where the time went to this path')
     def do_start(self, subcmd, opts, *args):
       """Start a set of Docker containers that had been previously stopped. Container state is defined in an environment file. 
 
@@ -71,6 +166,9 @@ class MaestroCli(cmdln.Cmdln):
         
         ${cmd_option_list}
       """
+      if opts.trace:
+        tracing.enable(opts.trace)
+
       container = None
       if (len(args) > 0):
         container = args[0]
@@ -86,6 +184,10 @@ class MaestroCli(cmdln.Cmdln):
                   help='path to the environment file to use to save the state of running containers')
     @cmdln.option("-n", "--name",
                   help='Create a global named environment using the provided name')
+    @cmdln.option("-d", "--deadline", type="float",
+                  help='Maximum number of seconds to spend stopping containers before killing whatever is left')
+    @cmdln.option("--trace",
+                  help='Write a Chrome trace-event file of where the time went to this path')
     def do_stop(self, subcmd, opts, *args):
       """Stop a set of Docker containers as defined in an environment file. 
 
@@ -94,6 +196,9 @@ class MaestroCli(cmdln.Cmdln):
         
         ${cmd_option_list}
       """
+      if opts.trace:
+        tracing.enable(opts.trace)
+
       container = None
       if (len(args) > 0):
         container = args[0]
@@ -101,7 +206,7 @@ class MaestroCli(cmdln.Cmdln):
       environment = self._verify_environment(opts)
       
       containers = service.Service(environment=environment)
-      if containers.stop(container):
+      if containers.stop(container, deadline=opts.deadline):
         containers.save(environment)
         print "Stopped."
 
@@ -109,21 +214,58 @@ class MaestroCli(cmdln.Cmdln):
                   help='path to the environment file to use to save the state of running containers')
     @cmdln.option("-n", "--name",
                   help='Create a global named environment using the provided name')
+    @cmdln.option("-d", "--deadline", type="float",
+                  help='Maximum number of seconds to spend stopping containers before killing whatever is left')
+    @cmdln.option("--rolling", action="store_true", default=False,
+                  help='Restart the replicas of each template a batch at a time, waiting for each batch to be ready')
+    @cmdln.option("-b", "--batch", type="int", default=1,
+                  help='Number of replicas to restart at once with --rolling')
+    @cmdln.option("-t", "--timeout", type="int",
+                  help='Seconds to wait for each container to stop with --rolling before it is killed')
+    @cmdln.option("--trace",
+                  help='Write a Chrome trace-event file of where the time went to this path')
     def do_restart(self, subcmd, opts, *args):
       """Restart a set of containers as defined in an environment file. 
 
         usage:
             restart [container_name]
+            restart --rolling [template_name]
         
         ${cmd_option_list}
       """
-      self.do_stop('stop', opts, args)
-      self.do_start('start', opts, args)
+      if not opts.rolling:
+        self.do_stop('stop', opts, args)
+        self.do_start('start', opts, args)
+        return
+
+      if opts.trace:
+        tracing.enable(opts.trace)
+
+      template = None
+      if (len(args) > 0):
+        template = args[0]
+
+      environment = self._verify_environment(opts)
+
+      containers = service.Service(environment=environment)
+      restarted = False
+      try:
+        restarted = containers.restart(template, batch=opts.batch, timeout=opts.timeout)
+      finally:
+        # Recreated containers have new ids
+        containers.save(environment)
+
+      if restarted:
+        print "Restarted."
 
     @cmdln.option("-e", "--environment_file",
                   help='path to the environment file to use to save the state of running containers')
     @cmdln.option("-n", "--name",
                   help='Create a global named environment using the provided name')
+    @cmdln.option("-d", "--deadline", type="float",
+                  help='Maximum number of seconds to spend stopping containers before killing whatever is left')
+    @cmdln.option("--trace",
+                  help='Write a Chrome trace-event file of where the time went to this path')
     def do_destroy(self, subcmd, opts, *args):
       """Stop and destroy a set of Docker containers as defined in an environment file. 
 
@@ -132,10 +274,13 @@ class MaestroCli(cmdln.Cmdln):
         
         ${cmd_option_list}
       """
+      if opts.trace:
+        tracing.enable(opts.trace)
+
       environment = self._verify_environment(opts)
       
       containers = service.Service(environment=environment)
-      if containers.destroy():
+      if containers.destroy(deadline=opts.deadline):
         containers.save(environment)
         print "Destroyed."
  
@@ -178,6 +323,12 @@ class MaestroCli(cmdln.Cmdln):
                   help='path to the environment file to use to save the state of running containers')
     @cmdln.option("-n", "--name",
                   help='Create a global named environment using the provided name')
+    @cmdln.option("--format", choices=['table', 'json'], default='table',
+                  help='Output format, table or json')
+    @cmdln.option("-t", "--template", action="append",
+                  help='Only show containers of this template. Can be repeated')
+    @cmdln.option("-s", "--status", choices=['running', 'stopped', 'destroyed'],
+                  help='Only show containers with this status')
     def do_ps(self, subcmd, opts, *args):
       """Show the status of a set of containers as defined in an environment file. 
 
@@ -189,7 +340,87 @@ class MaestroCli(cmdln.Cmdln):
       environment = self._verify_environment(opts)
       
       containers = service.Service(environment=environment)
-      print containers.ps() 
+      print containers.ps(format=opts.format, templates=opts.template, status=opts.status) 
+
+    @cmdln.option("-e", "--environment_file",
+                  help='path to the environment file to use to save the state of running containers')
+    @cmdln.option("-n", "--name",
+                  help='Create a global named environment using the provided name')
+    @cmdln.option("-f", "--follow", action="store_true", default=False,
+                  help='Keep following the output as the containers produce it')
+    @cmdln.option("-t", "--template", action="append",
+                  help='Only show containers of this template. Can be repeated')
+    @cmdln.option("-b", "--buffer-lines", type="int", default=1000,
+                  help='Lines to hold per container before reading from it waits for the output to catch up')
+    def do_logs(self, subcmd, opts, *args):
+      """Show the output of every container in an environment, each line prefixed with the container name. 
+
+        usage:
+            logs
+        
+        ${cmd_option_list}
+      """
+      environment = self._verify_environment(opts)
+      
+      containers = service.Service(environment=environment)
+      try:
+        containers.logs(templates=opts.template, follow=opts.follow, buffer_lines=opts.buffer_lines)
+      except KeyboardInterrupt:
+        pass
+
+    def do_convert(self, subcmd, opts, source, destination):
+      """Convert an environment file between the YAML and SQLite formats. Files ending in .db are SQLite.
+
+        usage:
+            convert source destination
+        
+        ${cmd_option_list}
+      """
+      if store.isStore(source) == store.isStore(destination):
+        sys.stderr.write("One of the files must be a .db file and the other a YAML file\n")
+        exit(1)
+
+      if not os.path.exists(source):
+        sys.stderr.write("Could not locate the environments file {0}\n".format(source))
+        exit(1)
+
+      if store.isStore(destination):
+        store.importYaml(source, destination)
+      else:
+        store.exportYaml(source, destination)
+
+      print "Converted."
+
+    @cmdln.option("-e", "--environment_file", action="append",
+                  help='An environment to keep besides the local and named ones. Can be repeated')
+    @cmdln.option("--dry-run", action="store_true", default=False,
+                  help='Only report what would be removed')
+    @cmdln.option("-j", "--jobs", type="int", default=8,
+                  help='Number of images or containers to remove concurrently')
+    def do_gc(self, subcmd, opts, *args):
+      """Remove the images and stopped containers maestro created that no environment uses anymore. 
+
+        usage:
+            gc
+        
+        ${cmd_option_list}
+      """
+      environments = cleanup.environments(opts.environment_file)
+      report = cleanup.collect(environments, dry_run=opts.dry_run, jobs=opts.jobs, since=cleanup.trackedSince())
+
+      action = "Would remove" if opts.dry_run else "Removed"
+      for container in report['containers']:
+        print "{0} container {1} ({2})".format(action, container['id'], container['image'])
+      for image in report['images']:
+        print "{0} image {1} ({2:.1f} MB)".format(action, ', '.join(image['tags']) or image['id'], image['size'] / 1048576.0)
+      for container in report['skipped']:
+        print "Skipped {0} container {1} ({2})".format(container['reason'], container['id'], container['image'])
+      for error in report['errors']:
+        sys.stderr.write("Unable to remove {0}: {1}\n".format(error['id'], error['error']))
+
+      print "{0} {1:.1f} MB from {2} images and {3} containers, keeping what {4} environments use.".format(
+        "Would reclaim" if opts.dry_run else "Reclaimed", report['reclaimed'] / 1048576.0, len(report['images']),
+        len(report['containers']), len(environments))
 
     def _verify_global_environment(self, name):
       """
@@ -239,6 +470,23 @@ class MaestroCli(cmdln.Cmdln):
         os.makedirs(env_path)
       return os.path.join(env_path, 'environment.yml')
 
+    def _verify_config(self, opts):
+      """
+      Locate the maestro.yml to use.
+      """
+      config = opts.maestro_file
+      if not config:
+        config = os.path.join(os.getcwd(), 'maestro.yml')
+
+      if not config.startswith('/'):
+        config = os.path.join(os.getcwd(), config)
+
+      if not os.path.exists(config):
+        sys.stderr.write("No maestro configuration found {0}\n".format(config))
+        exit(1)
+
+      return config
+
     def _verify_environment(self, opts):
       """
       Verify that the provided environment file exists.
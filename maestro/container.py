@@ -19,7 +19,7 @@ class Container:
     #  self.log.error("Error: No command specified for container " + name + "\n")
     #  raise ContainerError('No command specified in configuration') 
       
-    self.backend = py_backend.PyBackend()
+    self.backend = py_backend.shared()
 
   def create(self):
     self._start_container(False) 
@@ -27,24 +27,76 @@ class Container:
   def run(self):
     self._start_container()
 
-  def rerun(self):
-    # Commit the current container and then use that image_id to restart.
-    self.state['image_id'] = self.backend.commit_container(self.state['container_id'])['Id']
+  def recreate(self, image_id, timeout=10):
+    # docker start won't take a new set of env vars so the container is replaced with a fresh one created from 
+    # the template image. Data carries over by binding the old container's volumes into the new one.
+    from requests.exceptions import HTTPError
+
+    previous = dict(self.state)
+    mounted = (self.mounts or {}).values()
+    volumes = self.state.get('volumes', {})
+    for path, host_path in (self.inspect().get('Volumes') or {}).items():
+      if path not in mounted:
+        volumes[host_path] = path
+    if volumes:
+      self.state['volumes'] = volumes
+
+    utils.status("Recreating container %s - %s" % (self.name, previous['container_id'])) 
+    # The daemon won't remove a running container and the new one may need the same host ports
+    self.stop(timeout)
+    self.state['image_id'] = image_id
     self._start_container()
+    self.backend.remove_container(previous['container_id'])
+
+    # Containers used to be rerun from a commit of themselves. Those images aren't used by anything else.
+    if previous['image_id'] != image_id:
+      try:
+        self.backend.remove_image(previous['image_id'])
+      except HTTPError:
+        self.log.warning('Unable to remove image %s left by an earlier restart', previous['image_id'])
 
   def start(self):
     utils.status("Starting container %s - %s" % (self.name, self.state['container_id'])) 
-    self.backend.start_container(self.state['container_id'], self.mounts)
+    self.backend.start_container(self.state['container_id'], self._binds())
   
   def stop(self, timeout=10):
     utils.status("Stopping container %s - %s" % (self.name, self.state['container_id']))     
     self.backend.stop_container(self.state['container_id'], timeout=timeout)
     
+  def kill(self):
+    utils.status("Killing container %s - %s" % (self.name, self.state['container_id']))     
+    self.backend.kill_container(self.state['container_id'])
+
   def destroy(self, timeout=None):
     self.stop(timeout)
+    self.remove()
+
+  def remove(self):
     utils.status("Destroying container %s - %s" % (self.name, self.state['container_id']))         
     self.backend.remove_container(self.state['container_id'])    
 
+  # The _async forms return a future instead of waiting for the daemon. Only async backends have them.
+
+  def run_async(self):
+    def created(container_id):
+      self.state['container_id'] = container_id
+      utils.status("Starting container %s - %s" % (self.name, container_id)) 
+      return self.backend.start_container_async(container_id, self._binds())
+
+    return self.backend.create_container_async(self.state['image_id'], self.config).then(created)
+
+  def stop_async(self, timeout=10):
+    utils.status("Stopping container %s - %s" % (self.name, self.state['container_id']))     
+    return self.backend.stop_container_async(self.state['container_id'], timeout=timeout)
+
+  def kill_async(self):
+    utils.status("Killing container %s - %s" % (self.name, self.state['container_id']))     
+    return self.backend.kill_container_async(self.state['container_id'])
+
+  def remove_async(self):
+    utils.status("Destroying container %s - %s" % (self.name, self.state['container_id']))         
+    return self.backend.remove_container_async(self.state['container_id'])
+
   def get_ip_address(self):
     return self.backend.get_ip_address(self.state['container_id']) 
 
@@ -55,7 +107,18 @@ class Container:
     # should probably catch ctrl-c here so that the process doesn't abort
     for line in self.backend.attach_container(self.state['container_id']):
       sys.stdout.write(line)
+
+  def logs(self, follow=False):
+    # The container's output so far and, with follow, everything after it as it arrives
+    if follow:
+      return self.backend.attach_container(self.state['container_id'], logs=True)
+    return [self.backend.container_logs(self.state['container_id'])]
     
+  def _binds(self):
+    binds = dict(self.mounts or {})
+    binds.update(self.state.get('volumes', {}))
+    return binds or None
+
   def _start_container(self, start=True):
     # Start the container
     self.state['container_id'] = self.backend.create_container(self.state['image_id'], self.config)
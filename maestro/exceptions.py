@@ -6,4 +6,7 @@ class TemplateError(MaestroError):
   pass
 
 class ContainerError(MaestroError):
-  pass
\ No newline at end of file
+  pass
+
+class DependencyError(MaestroError):
+  pass
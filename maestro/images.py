@@ -0,0 +1,90 @@
+import threading, logging, re, sys
+import exceptions, utils, py_backend, tracing
+
+def baseImage(config):
+  # The image a template builds on, if it can be known before building
+  buildspec = config.get('buildspec')
+  if buildspec:
+    match = re.search(r'^\s*FROM\s+(\S+)', buildspec.get('dockerfile') or '', re.MULTILINE | re.IGNORECASE)
+    return match.group(1) if match else None
+  return config.get('base_image')
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+def resolve(name):
+  return resolver().resolve(name)
+
+def resolver():
+  global _resolver
+  with _resolver_lock:
+    if not _resolver:
+      _resolver = Resolver()
+    return _resolver
+
+class Resolver:
+  """
+  Makes sure images are available locally, pulling them when they aren't. Each image is looked up
+  once per process and any number of threads asking for the same image share a single pull. An image
+  that can't be pulled fails the same way for everyone who asks for it afterwards.
+  """
+  def __init__(self, backend=None):
+    self.backend = backend or py_backend.shared()
+    self.log = logging.getLogger('maestro')
+    self.lock = threading.Lock()
+    self.images = {}
+
+  def resolve(self, name):
+    # Returns the id of the image once it is present
+    with self.lock:
+      entry = self.images.get(name)
+      owner = entry is None
+      if owner:
+        entry = self.images[name] = {'done': threading.Event()}
+
+    if owner:
+      try:
+        entry['id'] = self._fetch(name)
+      except Exception:
+        entry['error'] = sys.exc_info()
+      finally:
+        entry['done'].set()
+    else:
+      entry['done'].wait()
+
+    if 'error' in entry:
+      error = entry['error']
+      raise error[0], error[1], error[2]
+    return entry['id']
+
+  def _fetch(self, name):
+    from requests.exceptions import HTTPError
+
+    try:
+      image = self.backend.inspect_image(name)
+    except HTTPError:
+      self.log.info('Attempting to pull base: %s', name)
+      utils.status('Pulling image %s' % (name))
+      with tracing.span('pull image', image=name):
+        pulled = self._pull(name)
+      if not pulled:
+        self.log.error('No base image could be pulled under the name: %s', name)
+        raise exceptions.TemplateError("No base image could be pulled under the name: " + name)
+      try:
+        image = self.backend.inspect_image(name)
+      except HTTPError:
+        raise exceptions.TemplateError("No base image could be pulled under the name: " + name)
+
+    return image.get('id') or image.get('Id')
+
+  def _pull(self, name):
+    # Progress updates are only logged, every other line is shown as it arrives
+    failed = False
+    with open(utils.logPath('pull', name), 'w') as log_file:
+      for line, message in utils.outputLines(self.backend.pull_image(name, stream=True)):
+        log_file.write(line + '\n')
+        if message and 'error' in message:
+          failed = True
+        if not (message and message.get('progress')):
+          utils.status('[%s] %s' % (name, line))
+    return not failed
@@ -0,0 +1,110 @@
+import threading, Queue, sys, struct
+
+# A line this long without a newline is written out as it is
+MAX_LINE = 65536
+
+def demux(chunks):
+  # Output of containers without a tty comes in frames, an 8 byte header of the stream type, three zero bytes
+  # and the payload length, then the payload. Output that doesn't start with a header is passed on as it is.
+  pending = ''
+  framed = None
+  for chunk in chunks:
+    if framed is False:
+      yield chunk
+      continue
+
+    pending += chunk
+    if framed is None:
+      if len(pending) < 8:
+        continue
+      framed = pending[0] in '\x00\x01\x02' and pending[1:4] == '\x00\x00\x00'
+      if not framed:
+        yield pending
+        pending = ''
+        continue
+
+    while len(pending) >= 8:
+      length = struct.unpack('>L', pending[4:8])[0]
+      if len(pending) < 8 + length:
+        break
+      if length:
+        yield pending[8:8 + length]
+      pending = pending[8 + length:]
+
+  if pending and not framed:
+    yield pending
+
+class Multiplexer:
+  """
+  Interleaves the output of many containers a line at a time, each line prefixed with the container's name.
+  Every container is read by its own thread into a bounded buffer. A reader whose buffer is full waits,
+  leaving the rest of its output with the daemon, while lines from the other containers keep flowing.
+  """
+  def __init__(self, streams, output=sys.stdout, buffer_lines=1000):
+    # streams are (name, open) pairs where open returns an iterable of output chunks
+    self.streams = streams
+    self.output = output
+    self.buffers = [Queue.Queue(buffer_lines) for stream in streams]
+    self.width = max([len(name) for name, open_stream in streams] or [0])
+    self.ready = threading.Condition()
+    self.pending = 0
+
+  def run(self):
+    for index, (name, open_stream) in enumerate(self.streams):
+      thread = threading.Thread(target=self._read, args=(index, open_stream), name='logs ' + name)
+      thread.daemon = True
+      thread.start()
+
+    remaining = len(self.streams)
+    position = 0
+    while remaining:
+      with self.ready:
+        while not self.pending:
+          # Waiting with a timeout keeps ctrl-c working
+          self.ready.wait(1)
+        self.pending -= 1
+        idle = not self.pending
+
+      # Serve the buffers in turn so a noisy container gets no more than its share of the output
+      for offset in range(len(self.buffers)):
+        index = (position + offset) % len(self.buffers)
+        try:
+          line = self.buffers[index].get_nowait()
+          break
+        except Queue.Empty:
+          pass
+      position = index + 1
+
+      if line is None:
+        remaining -= 1
+      else:
+        self.output.write('%s | %s\n' % (self.streams[index][0].ljust(self.width), line))
+      if idle:
+        self.output.flush()
+
+  def _read(self, index, open_stream):
+    buffer = self.buffers[index]
+    try:
+      pending = ''
+      for chunk in open_stream():
+        pending += chunk
+        lines = pending.split('\n')
+        pending = lines.pop()
+        if len(pending) > MAX_LINE:
+          lines.append(pending)
+          pending = ''
+        for line in lines:
+          self._put(buffer, line.rstrip('\r'))
+      if pending:
+        self._put(buffer, pending.rstrip('\r'))
+    except Exception, e:
+      self._put(buffer, 'Unable to read the output: %s' % e)
+    finally:
+      self._put(buffer, None)
+
+  def _put(self, buffer, line):
+    # Blocks while the buffer is full
+    buffer.put(line)
+    with self.ready:
+      self.pending += 1
+      self.ready.notify()
@@ -0,0 +1,102 @@
+import threading, time, os, atexit, functools, tempfile, types
+
+# Latency buckets in seconds, from quick inspects up to slow builds and pulls
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Per backend method: calls, errors, total seconds and a count per bucket
+_methods = {}
+_lock = threading.Lock()
+
+def timed(streams=False):
+  # Counts calls and errors of the wrapped backend method and records how long each call took. With streams
+  # a call that hands back a generator is only done once the generator is.
+  def decorate(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      start = time.time()
+      failed = True
+      try:
+        result = func(*args, **kwargs)
+        failed = False
+      finally:
+        if failed:
+          observe(func.__name__, time.time() - start, failed)
+      if streams and isinstance(result, types.GeneratorType):
+        return _observed(result, func.__name__, start)
+      observe(func.__name__, time.time() - start)
+      return result
+    return wrapper
+  return decorate
+
+def _observed(stream, method, start):
+  failed = True
+  try:
+    for item in stream:
+      yield item
+    failed = False
+  except GeneratorExit:
+    # The caller stopped reading, which isn't an error
+    failed = False
+    raise
+  finally:
+    observe(method, time.time() - start, failed)
+
+def observe(method, seconds, failed=False):
+  with _lock:
+    if method not in _methods:
+      _methods[method] = [0, 0, 0.0, [0] * len(BUCKETS)]
+    stats = _methods[method]
+    stats[0] += 1
+    stats[1] += 1 if failed else 0
+    stats[2] += seconds
+    for index, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        stats[3][index] += 1
+
+def reset():
+  with _lock:
+    _methods.clear()
+
+def render():
+  # The Prometheus text exposition format
+  with _lock:
+    methods = dict((method, (stats[0], stats[1], stats[2], list(stats[3]))) for method, stats in _methods.items())
+
+  lines = [
+    '# HELP maestro_docker_calls_total Docker API calls made by maestro.',
+    '# TYPE maestro_docker_calls_total counter'
+  ]
+  for method in sorted(methods):
+    lines.append('maestro_docker_calls_total{method="%s"} %d' % (method, methods[method][0]))
+
+  lines.extend([
+    '# HELP maestro_docker_errors_total Docker API calls that failed.',
+    '# TYPE maestro_docker_errors_total counter'
+  ])
+  for method in sorted(methods):
+    lines.append('maestro_docker_errors_total{method="%s"} %d' % (method, methods[method][1]))
+
+  lines.extend([
+    '# HELP maestro_docker_call_seconds How long Docker API calls took.',
+    '# TYPE maestro_docker_call_seconds histogram'
+  ])
+  for method in sorted(methods):
+    count, errors, total, buckets = methods[method]
+    for bound, bucket in zip(BUCKETS, buckets):
+      lines.append('maestro_docker_call_seconds_bucket{method="%s",le="%s"} %d' % (method, bound, bucket))
+    lines.append('maestro_docker_call_seconds_bucket{method="%s",le="+Inf"} %d' % (method, count))
+    lines.append('maestro_docker_call_seconds_sum{method="%s"} %f' % (method, total))
+    lines.append('maestro_docker_call_seconds_count{method="%s"} %d' % (method, count))
+
+  return '\n'.join(lines) + '\n'
+
+def write(filename):
+  # The textfile collector may read at any moment so the file is replaced in one step
+  fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+  with os.fdopen(fd, 'w') as output_file:
+    output_file.write(render())
+  os.chmod(temp, 0644)
+  os.rename(temp, filename)
+
+def writeOnExit(filename):
+  atexit.register(write, filename)
@@ -1,60 +1,189 @@
-import docker
+import threading, time, os
+import tracing, metrics
+from logs import demux
+
+# Settings for the backend shared by the whole process. pool_size is the number of keep-alive
+# connections to the daemon that are held open for reuse. backend picks between threads, where every
+# call blocks a thread, and async, where one event loop thread carries up to max_requests calls at once.
+settings = {
+  'base_url': 'unix://var/run/docker.sock',
+  'timeout': 60,
+  'pool_size': 32,
+  'backend': os.environ.get('MAESTRO_BACKEND', 'threads'),
+  'max_requests': 256
+}
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def configure(**kwargs):
+  global _shared
+  with _shared_lock:
+    settings.update(kwargs)
+    _shared = None
+
+def shared():
+  # One backend, and one connection pool, is used by every template, container and command
+  global _shared
+  with _shared_lock:
+    if not _shared:
+      if settings['backend'] == 'async':
+        import async_backend
+        _shared = async_backend.AsyncBackend()
+      else:
+        _shared = PyBackend(connect=lambda: _client(settings['pool_size']))
+    return _shared
+
+def isAsync(backend):
+  # Async backends can have many calls in flight without a thread for each
+  return hasattr(backend, 'create_container_async')
+
+def _client(pool_size):
+  # docker and requests are slow to import so that only happens once the daemon is actually needed
+  import docker, requests.adapters, unixconn
+
+  client = docker.Client(base_url=settings['base_url'], timeout=settings['timeout'])
+  if client.base_url.startswith('unix:'):
+    client.mount('unix://', unixconn.UnixPoolAdapter(client.base_url, settings['timeout'], pool_size))
+  else:
+    client.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+  return client
+
+def _default_client():
+  import docker
+  return docker.Client()
 
 class PyBackend:
-  def __init__(self):
-    self.docker_client = docker.Client()
+  def __init__(self, docker_client=None, connect=_default_client):
+    if docker_client:
+      self.docker_client = docker_client
+    self.connect = connect
+    self.connect_lock = threading.Lock()
+
+  def __getattr__(self, name):
+    # The client is created the first time the daemon is used
+    if name == 'docker_client':
+      with self.connect_lock:
+        if 'docker_client' not in self.__dict__:
+          self.docker_client = self.connect()
+      return self.docker_client
+    raise AttributeError(name)
 
   ## Container management
 
+  @tracing.traced()
+  @metrics.timed()
   def create_container(self, image_id, config):
     return self._start_container(image_id, config, False) 
 
+  @tracing.traced()
+  @metrics.timed()
   def run_container(self, image_id, config):
     return self._start_container(image_id, config)
 
+  @tracing.traced()
+  @metrics.timed()
   def start_container(self, container_id, mounts=None):
     self.docker_client.start(container_id, binds=mounts)
   
+  @tracing.traced()
+  @metrics.timed()
   def stop_container(self, container_id, timeout=10):
     self.docker_client.stop(container_id, timeout=timeout)
     
+  @tracing.traced()
+  @metrics.timed()
+  def kill_container(self, container_id):
+    self.docker_client.kill(container_id)
+
+  @tracing.traced()
+  @metrics.timed()
   def remove_container(self, container_id, timeout=None):
-    self.stop_container(timeout)
+    if timeout is not None:
+      self.stop_container(container_id, timeout)
     self.docker_client.remove_container(container_id)    
 
+  @tracing.traced()
+  @metrics.timed()
+  def list_containers(self):
+    return self.docker_client.containers(all=True, trunc=False)
+
+  @tracing.traced()
+  @metrics.timed()
   def inspect_container(self, container_id):
     return self.docker_client.inspect_container(container_id)
 
+  @tracing.traced()
+  @metrics.timed()
   def commit_container(self, container_id):
     return self.docker_client.commit(container_id)  
   
-  def attach_container(self, container_id):
-    return self.docker_client.attach(container_id)  
+  @tracing.traced()
+  @metrics.timed()
+  def attach_container(self, container_id, logs=False):
+    if not logs:
+      return self.docker_client.attach(container_id)
+    # Output from before attaching followed by whatever comes next
+    return demux(self._receive(self.docker_client.attach_socket(container_id,
+      params={'stdout': 1, 'stderr': 1, 'stream': 1, 'logs': 1})))
+
+  def _receive(self, sock):
+    while True:
+      chunk = sock.recv(4096)
+      if not chunk:
+        break
+      yield chunk
+
+  @tracing.traced()
+  @metrics.timed()
+  def container_logs(self, container_id):
+    return self.docker_client.logs(container_id)
   
   ## Image management
 
-  def build_image(self, fileobj=None, path=None):
-    return self.docker_client.build(path=path, fileobj=fileobj)
+  @tracing.traced(streams=True)
+  @metrics.timed(streams=True)
+  def build_image(self, fileobj=None, path=None, nocache=False, stream=False):
+    # With stream the output is handed back line by line while the build runs
+    return self.docker_client.build(path=path, fileobj=fileobj, nocache=nocache, stream=stream)
 
+  @tracing.traced()
+  @metrics.timed()
   def remove_image(self, image_id):
     self.docker_client.remove_image(image_id)
 
+  @tracing.traced()
+  @metrics.timed()
   def inspect_image(self, image_id):
     return self.docker_client.inspect_image(image_id)
 
-  def images(self, name):
+  @tracing.traced()
+  @metrics.timed()
+  def images(self, name=None):
     return self.docker_client.images(name=name)
 
+  @tracing.traced()
+  @metrics.timed()
   def tag_image(self, image_id, name, tag):
     self.docker_client.tag(image_id, name, tag=tag)
 
-  def pull_image(self, name):
-    return self.docker_client.pull(name)
+  @tracing.traced(streams=True)
+  @metrics.timed(streams=True)
+  def pull_image(self, name, stream=False):
+    return self.docker_client.pull(name, stream=stream)
   
+  ## Events
+
+  def monitor(self):
+    return monitor()
+
   ## Helpers
 
   def get_ip_address(self, container_id):
-    state = self.docker_client.inspect_container(container_id)    
+    return address(container_id, self._lookup_ip_address)
+
+  def _lookup_ip_address(self, container_id):
+    state = self.inspect_container(container_id)
     return state['NetworkSettings']['IPAddress']
 
   def _start_container(self, image_id, config, start=True):
@@ -64,4 +193,125 @@ class PyBackend:
     if (start):
       self.start_container(container_id)
 
-    return container_id
\ No newline at end of file
+    return container_id
+
+def _short_id(container_id):
+  # The daemon reports both full and truncated ids
+  return container_id[:12]
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+def monitor():
+  # The event stream is subscribed to once per process and shared by every backend
+  global _monitor
+  with _monitor_lock:
+    if not _monitor or not _monitor.alive:
+      # The stream holds its connection open so it gets a client of its own
+      _monitor = EventMonitor(_client(1))
+      _monitor.start()
+  return _monitor
+
+def address(container_id, lookup):
+  # The address only changes when the container is restarted so the event monitor can cache it
+  if _monitor and _monitor.alive:
+    return _monitor.address(container_id, lookup)
+  return lookup(container_id)
+
+class EventMonitor:
+  # Follows the daemon's /events stream on a background thread and keeps the last known state
+  # of every container seen. States are running, exited, created and destroyed. Every event is numbered
+  # so a crash can be told apart from news that came before the container was last started.
+  STATES = {
+    'create': 'created',
+    'start': 'running',
+    'restart': 'running',
+    'unpause': 'running',
+    'die': 'exited',
+    'kill': 'exited',
+    'stop': 'exited',
+    'oom': 'exited',
+    'destroy': 'destroyed'
+  }
+
+  def __init__(self, docker_client):
+    self.docker_client = docker_client
+    self.states = {}
+    self.addresses = {}
+    # The number of events seen and, for each container, the numbers of the last ones that started and ended it
+    self.events = 0
+    self.starts = {}
+    self.exits = {}
+    self.changed = threading.Condition()
+    self.alive = True
+
+  def start(self):
+    thread = threading.Thread(target=self._follow, name='docker-events')
+    thread.daemon = True
+    thread.start()
+
+    # Containers that haven't produced an event yet get their state from a single list call
+    for container in self.docker_client.containers(all=True):
+      state = 'running' if container['Status'].startswith('Up') else 'exited'
+      with self.changed:
+        self.states.setdefault(_short_id(container['Id']), state)
+
+  def state(self, container_id):
+    # None for containers there's no news about yet
+    with self.changed:
+      return self.states.get(_short_id(container_id))
+
+  def mark(self):
+    with self.changed:
+      return self.events
+
+  def exited_since(self, container_id, mark):
+    # Whether the container died or was destroyed after mark was taken
+    with self.changed:
+      return self.exits.get(_short_id(container_id), 0) > mark
+
+  def crashed(self, container_id, since=0):
+    # Whether the container died or was destroyed after it was last started, leaving out exits up to since
+    with self.changed:
+      exit = self.exits.get(_short_id(container_id), 0)
+      return exit > self.starts.get(_short_id(container_id), 0) and exit > since
+
+  def address(self, container_id, lookup):
+    with self.changed:
+      if _short_id(container_id) in self.addresses:
+        return self.addresses[_short_id(container_id)]
+
+    address = lookup(container_id)
+    with self.changed:
+      if self.state(container_id) == 'running':
+        self.addresses[_short_id(container_id)] = address
+    return address
+
+  def wait(self, timeout):
+    # Sleep for up to timeout seconds but wake up as soon as any container changes state
+    with self.changed:
+      self.changed.wait(timeout)
+
+  def _follow(self):
+    try:
+      for event in self.docker_client.events():
+        if event.get('status') not in self.STATES:
+          continue
+
+        with self.changed:
+          self.events += 1
+          self.states[_short_id(event['id'])] = self.STATES[event['status']]
+          if self.STATES[event['status']] == 'running':
+            self.starts[_short_id(event['id'])] = self.events
+          elif self.STATES[event['status']] in ('exited', 'destroyed'):
+            self.exits[_short_id(event['id'])] = self.events
+          # Restarts hand out new addresses
+          self.addresses.pop(_short_id(event['id']), None)
+          self.changed.notify_all()
+    except Exception:
+      pass
+
+    # Without the stream everyone falls back to asking the daemon directly
+    with self.changed:
+      self.alive = False
+      self.changed.notify_all()
@@ -0,0 +1,123 @@
+import threading, Queue, time, sys
+from collections import deque
+from exceptions import MaestroError
+
+class Scheduler:
+  """
+  Runs a set of tasks on worker threads while honoring the dependencies between them.
+
+  A task is started as soon as every task it requires has finished. Each task belongs to a pool and
+  the number of tasks running at once in a pool can be capped with limits.
+  """
+  def __init__(self, limits=None):
+    self.limits = limits or {}
+    self.tasks = {}
+    self.keys = []
+    self.results = {}
+    self.timings = {}
+
+  def add(self, key, func, requires=None, pool='default'):
+    self.tasks[key] = (func, list(requires or []), pool)
+    self.keys.append(key)
+
+  def run(self):
+    waiting = {}
+    dependents = dict((key, []) for key in self.keys)
+    for key in self.keys:
+      waiting[key] = set(self.tasks[key][1])
+      for required in waiting[key]:
+        if required not in self.tasks:
+          raise MaestroError('Task %s requires unknown task %s' % (key, required))
+        dependents[required].append(key)
+
+    ready = deque([key for key in self.keys if not waiting[key]])
+    running = dict((self.tasks[key][2], 0) for key in self.keys)
+    finished = set()
+    done = Queue.Queue()
+    error = None
+    active = 0
+    origin = time.time()
+
+    def worker(key, func):
+      start = time.time() - origin
+      try:
+        done.put((key, start, func(), None))
+      except Exception:
+        done.put((key, start, None, sys.exc_info()))
+
+    while True:
+      # Start everything that is ready unless its pool is already full. After a failure nothing new is started.
+      deferred = []
+      while ready and not error:
+        key = ready.popleft()
+        func, requires, pool = self.tasks[key]
+        if self.limits.get(pool) and running[pool] >= self.limits[pool]:
+          deferred.append(key)
+          continue
+
+        running[pool] += 1
+        active += 1
+        thread = threading.Thread(target=worker, args=(key, func), name=str(key))
+        thread.daemon = True
+        thread.start()
+      ready.extendleft(reversed(deferred))
+
+      if not active:
+        break
+
+      # Waiting with a timeout keeps the main thread responsive to ctrl-c
+      try:
+        key, start, result, exc_info = done.get(True, 1)
+      except Queue.Empty:
+        continue
+
+      active -= 1
+      running[self.tasks[key][2]] -= 1
+      self.timings[key] = (start, time.time() - origin)
+
+      if exc_info:
+        if not error:
+          error = exc_info
+        continue
+
+      self.results[key] = result
+      finished.add(key)
+      for dependent in dependents[key]:
+        waiting[dependent].discard(key)
+        if not waiting[dependent]:
+          ready.append(dependent)
+
+    if error:
+      raise error[0], error[1], error[2]
+
+    if len(finished) != len(self.keys):
+      raise MaestroError('Unable to schedule tasks with circular requirements: ' +
+        ', '.join(str(key) for key in self.keys if key not in finished))
+
+    return self.results
+
+  def critical_path(self):
+    # Walk back from the last task to finish, each time following the requirement that finished last
+    if not self.timings:
+      return []
+
+    key = max(self.timings, key=lambda key: self.timings[key][1])
+    path = [key]
+    while True:
+      requires = [required for required in self.tasks[key][1] if required in self.timings]
+      if not requires:
+        break
+      key = max(requires, key=lambda required: self.timings[required][1])
+      path.insert(0, key)
+
+    return [(key, self.timings[key][0], self.timings[key][1]) for key in path]
+
+def parallel(func, items, jobs=None):
+  # Apply func to every item using at most jobs threads and return the results in the same order as items
+  items = list(items)
+  scheduler = Scheduler({'default': jobs})
+  for index, item in enumerate(items):
+    scheduler.add(index, lambda item=item: func(item))
+
+  results = scheduler.run()
+  return [results[index] for index in range(len(items))]
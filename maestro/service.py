@@ -1,18 +1,22 @@
-import docker
-import os, sys, yaml, copy, string, StringIO
-import maestro, template, utils
-from requests.exceptions import HTTPError
+import os, sys, copy, StringIO, time, json
+import maestro, template, utils, scheduler, py_backend, store, cache, images, tracing, logs, cleanup
 from .container import Container
+from .exceptions import TemplateError
 
 class ContainerError(Exception):
   pass
 
 class Service:
-  def __init__(self, conf_file=None, environment=None):
+  def __init__(self, conf_file=None, environment=None, backend=None):
     self.log = utils.setupLogging()
+    # threads or async, otherwise whatever MAESTRO_BACKEND says
+    if backend:
+      py_backend.configure(backend=backend)
+
     self.containers = {}
-    self.templates = {}
+    self.templates = utils.LazyDict()
     self.state = 'live'
+    self.store = None
 
     if environment:
       self.load(environment)      
@@ -21,66 +25,57 @@ class Service:
       if not conf_file.startswith('/'):
         conf_file = os.path.join(os.path.dirname(sys.argv[0]), conf_file)
 
-      data = open(conf_file, 'r')
-      self.config = yaml.load(data)
-      
-    # On load, order templates into the proper startup sequence      
-    self.start_order = utils.order(self.config['templates'])
+      # Parsing and ordering the templates into the proper startup sequence is cached
+      self.config, self.start_order, self.levels = cache.loadPlan(conf_file)
 
   def get(self, container):
     return self.containers[container]
 
-  def build(self, wait_time=60):
-    # Setup and build all the templates
+  def build(self, wait_time=60, build_jobs=4, launch_jobs=16, use_cache=True):
     for tmpl in self.start_order:          
       if not self.config['templates'][tmpl]:
         sys.stderr.write('Error: no configuration found for template: ' + tmpl + '\n')
         exit(1)
 
-      config = self.config['templates'][tmpl]
-      
-      # Create the template. The service name and version will be dynamic once the new config format is implemented
-      utils.status('Building template %s' % (tmpl))
-      tmpl_instance = template.Template(tmpl, config, 'service', '0.1')
-      tmpl_instance.build()
-
-
-      self.templates[tmpl] = tmpl_instance
-
       # We'll store the running instances as a dict under the template
-      self.containers[tmpl] = {}
-
-    # Start the envrionment
-    for tmpl in self.start_order:            
-      self._handleRequire(tmpl, wait_time)
-
-      tmpl_instance = self.templates[tmpl]
-      config = self.config['templates'][tmpl]
-      
-      # If count is defined in the config then we're launching multiple instances of the same thing
-      # and they'll need to be tagged accordingly. Count only applies on build.
-      count = tag_name = 1
-      if 'count' in config:
-        count = tag_name = config['count']  
+      self.containers[tmpl] = utils.LazyDict()
+      # Taken before launching adds the addresses of required services to the environment
+      self.config['templates'][tmpl]['config_hash'] = self._configHash(self.config['templates'][tmpl])
+
+    # Every template is a build node and a launch node. Builds start right away, bounded by build_jobs, and a template
+    # launches as soon as its own image is built and the templates it requires have launched.
+    # Base images are resolved up front, each one once no matter how many templates share it, and missing ones
+    # are pulled concurrently.
+    plan = scheduler.Scheduler({'build': build_jobs, 'pull': build_jobs})
+    for base in set(images.baseImage(self.config['templates'][tmpl]) for tmpl in self.start_order):
+      if base:
+        plan.add(('pull', base), lambda base=base: self._resolveImage(base), pool='pull')
+
+    for tmpl in self.start_order:
+      requires = [('launch', service) for service in self.config['templates'][tmpl].get('require', {})]
+      base = images.baseImage(self.config['templates'][tmpl])
+      plan.add(('build', tmpl), lambda tmpl=tmpl: self._buildTemplate(tmpl, use_cache), 
+        [('pull', base)] if base else [], pool='build')
+      plan.add(('launch', tmpl), lambda tmpl=tmpl: self._launchTemplate(tmpl, wait_time, launch_jobs), 
+        [('build', tmpl)] + requires, pool='launch')
+
+    try:
+      plan.run()
+    except:
+      error = sys.exc_info()
+      utils.status('Failure on build. Shutting down the environment')
+      self.destroy()
+      raise error[0], error[1], error[2]
+    finally:
+      self._reportCriticalPath(plan)
+
+    if use_cache:
+      reused = [tmpl for tmpl in self.start_order if self.templates[tmpl].cache_hit]
+      utils.status('Build cache: reused %d of %d images%s' % (len(reused), len(self.start_order), 
+        ' (%s)' % ', '.join(reused) if reused else ''))
       
-      while count > 0:      
-        name = tmpl
-        if tag_name > 1:
-          name = name + '__' + str(count)
-
-        utils.status('Launching instance of template %s named %s' % (tmpl, name))      
-        instance = tmpl_instance.instantiate(name)
-        instance.run()
-
-        self.containers[tmpl][name] = instance
-        
-        count = count - 1
-      
-  def destroy(self, timeout=None):       
-    for tmpl in reversed(self.start_order):
-      for container in self.containers[tmpl]:
-        self.log.info('Destroying container: %s', container)      
-        self.containers[tmpl][container].destroy(timeout) 
+  def destroy(self, timeout=None, deadline=None, stop_jobs=16):       
+    self._teardown(timeout, deadline, stop_jobs, remove=True)
 
     self.state = 'destroyed'    
     return True
@@ -97,12 +92,10 @@ class Service:
       
       rerun = self._handleRequire(tmpl, wait_time)
       
-      # We need to see if env has changed and then commit and run a new container.
-      # This rerun functionality should only be a temporary solution as each time the
-      # container is restarted this way it will consume a layer.
+      # We need to see if env has changed and then create a new container from the template image.
       # This is only necessary because docker start won't take a new set of env vars
       if rerun:
-        self.containers[tmpl][container].rerun()  
+        self.containers[tmpl][container].recreate(self.config['templates'][tmpl]['image_id'])
       else:
         self.containers[tmpl][container].start()  
     else:
@@ -111,13 +104,13 @@ class Service:
         
         for container in self.containers[tmpl]:
           if rerun:
-            self.containers[tmpl][container].rerun()
+            self.containers[tmpl][container].recreate(self.config['templates'][tmpl]['image_id'])
           else:
             self.containers[tmpl][container].start()
 
     return True
     
-  def stop(self, container=None, timeout=None):
+  def stop(self, container=None, timeout=None, deadline=None, stop_jobs=16):
     if not self._live():
       utils.status('Environment has been destroyed and can\'t be stopped.')
       return False
@@ -125,37 +118,226 @@ class Service:
     if container:
       self.containers[self._getTemplate(container)][container].stop(timeout)
     else:
-      for tmpl in reversed(self.start_order):  
-        for container in self.containers[tmpl]:             
-          self.containers[tmpl][container].stop(timeout)
+      self._teardown(timeout, deadline, stop_jobs)
+
+    return True
+
+  def diff(self, conf_file):
+    # The steps apply would take to bring the environment in line with conf_file
+    desired, start_order, levels = cache.loadPlan(conf_file)
+    return self._diff(desired['templates'], start_order)
+
+  def apply(self, conf_file, wait_time=60, build_jobs=4, launch_jobs=16, use_cache=True, dry_run=False):
+    if not self._live():
+      utils.status('Environment has been destroyed, use build to create it again')
+      return None
+
+    desired, start_order, levels = cache.loadPlan(conf_file)
+    steps = self._diff(desired['templates'], start_order)
+    if not steps:
+      utils.status('Nothing to change')
+      return steps
+
+    utils.status('Plan:')
+    width = max(len(tmpl) for action, tmpl, reason in steps)
+    for action, tmpl, reason in steps:
+      utils.status('  %-9s %-*s  %s' % (action, width, tmpl, reason))
+    if dry_run:
+      return steps
+
+    actions = dict((tmpl, action) for action, tmpl, reason in steps)
+
+    # Templates that are gone are torn down first, dependents before what they require
+    for tmpl in reversed(self.start_order):
+      if actions.get(tmpl) == 'remove':
+        self._removeTemplate(tmpl)
+    self.start_order, self.levels = start_order, levels
+
+    # Changed templates get their new config when their turn comes. The running image is kept until a rebuild
+    # replaces it and the config hash only once the containers match, so a failed apply can be run again.
+    configs = {}
+    hashes = {}
+    for tmpl in start_order:
+      if actions.get(tmpl) in ('create', 'rebuild', 'recreate', 'scale'):
+        configs[tmpl] = copy.deepcopy(desired['templates'][tmpl])
+        configs[tmpl].pop('config_hash', None)
+        # Taken before launching adds the addresses of required services to the environment
+        hashes[tmpl] = self._configHash(configs[tmpl])
+        if tmpl in self.config['templates'] and 'image_id' in self.config['templates'][tmpl]:
+          configs[tmpl]['image_id'] = self.config['templates'][tmpl]['image_id']
+        if tmpl not in self.containers:
+          self.containers[tmpl] = utils.LazyDict()
+
+    plan = scheduler.Scheduler({'build': build_jobs})
+    for tmpl in start_order:
+      action = actions.get(tmpl)
+      if not action:
+        continue
+
+      requires = [('apply', service) for service in desired['templates'][tmpl].get('require', {}) if service in actions]
+      if action in ('create', 'rebuild'):
+        plan.add(('build', tmpl), lambda tmpl=tmpl: self._buildTemplate(tmpl, use_cache, configs[tmpl]), pool='build')
+        requires.append(('build', tmpl))
+      plan.add(('apply', tmpl), lambda tmpl=tmpl: self._applyTemplate(tmpl, actions[tmpl], configs.get(tmpl),
+        hashes.get(tmpl), wait_time, launch_jobs), requires, pool='apply')
+
+    try:
+      plan.run()
+    finally:
+      self._reportCriticalPath(plan)
+
+    return steps
+
+  def scale(self, tmpl, count, batch=16, wait_time=60):
+    if not self._live():
+      utils.status('Environment has been destroyed and can\'t be scaled')
+      return False
+    if tmpl not in self.templates:
+      raise ContainerError('Unknown template: ' + tmpl)
+    consumers = [consumer for consumer in self.start_order if tmpl in self.config['templates'][consumer].get('require', {})]
+    if count < 1 and consumers:
+      raise ContainerError('%s is required by %s and needs at least one replica' % (tmpl, ', '.join(consumers)))
+
+    current = len(self._replicas(tmpl))
+    utils.status('Scaling %s from %d to %d replicas' % (tmpl, current, count))
+    with tracing.span('scale template', template=tmpl, count=count):
+      if count > current:
+        self._handleRequire(tmpl, wait_time, cleanup=False)
+      self._resize(tmpl, count, batch)
+    self.config['templates'][tmpl]['count'] = count
+
+    self._refreshConsumers(tmpl, wait_time, batch)
+    return True
 
+  def restart(self, tmpl=None, batch=1, timeout=None, wait_time=60):
+    # Restarts the replicas of every template, or just tmpl, a batch at a time. Each batch has to pass the same
+    # checks consumers wait on before the next one goes and the rollout stops at the first batch that doesn't.
+    if not self._live():
+      utils.status('Environment has been destroyed and can\'t be restarted')
+      return False
+    if tmpl and tmpl not in self.templates:
+      raise ContainerError('Unknown template: ' + tmpl)
+
+    for current in ([tmpl] if tmpl else self.start_order):
+      with tracing.span('roll template', template=current):
+        self._roll(current, batch, timeout, wait_time)
+
+    if tmpl:
+      self._refreshConsumers(tmpl, wait_time)
     return True
 
+  def _roll(self, tmpl, batch, timeout, wait_time):
+    rerun = self._handleRequire(tmpl, wait_time, cleanup=False)
+    image_id = self.config['templates'][tmpl]['image_id']
+    checks = self._readiness(tmpl)
+    names = sorted(self.containers[tmpl], key=lambda name: (self._replicaIndex(tmpl, name) is None,
+      self._replicaIndex(tmpl, name), name))
+
+    def restart(name):
+      instance = self.containers[tmpl][name]
+      stop_timeout = timeout if timeout is not None else 10
+      # docker start won't take a new set of env vars
+      since = 0
+      if rerun:
+        instance.recreate(image_id, stop_timeout)
+      else:
+        # Once the stop has come through the event stream it can't be taken for a crash while waiting on the probe
+        monitor = self._monitor()
+        mark = monitor.mark()
+        instance.stop(stop_timeout)
+        expires = time.time() + min(wait_time, 10)
+        while monitor.alive and not monitor.exited_since(instance.state['container_id'], mark) and time.time() < expires:
+          monitor.wait(0.5)
+        since = monitor.mark()
+        instance.start()
+
+      for port, check in sorted(checks.items()):
+        self._pollService(tmpl, tmpl, name, port, wait_time, check, since)
+
+    batches = [names[start:start + batch] for start in range(0, len(names), batch)]
+    for number, group in enumerate(batches):
+      utils.status('Restarting %s, batch %d of %d: %s' % (tmpl, number + 1, len(batches), ', '.join(group)))
+      try:
+        scheduler.parallel(restart, group, batch)
+      except:
+        error = sys.exc_info()
+        remaining = sum(len(rest) for rest in batches[number + 1:])
+        utils.status('Batch %d of %s failed, stopping the rollout with %d containers not restarted' % (number + 1, 
+          tmpl, remaining))
+        raise error[0], error[1], error[2]
+
+  def _readiness(self, tmpl):
+    # The checks consumers wait on, or a plain connect to each exposed port when nothing requires the template
+    checks = {}
+    for consumer in self.start_order:
+      require = self.config['templates'][consumer].get('require', {}).get(tmpl)
+      if require and require.get('port'):
+        checks[str(require['port'])] = require
+    if not checks:
+      for port in self.config['templates'][tmpl]['config'].get('ports') or []:
+        port = str(port).split(':')[-1]
+        if '/' not in port or port.endswith('/tcp'):
+          checks[port.split('/')[0]] = {}
+    return checks
+
+  def _refreshConsumers(self, tmpl, wait_time, jobs=16):
+    # Consumers get the new set of addresses, and so on down the line for any that had to be recreated
+    changed = set([tmpl])
+    for consumer in self.start_order[self.start_order.index(tmpl) + 1:]:
+      if changed.intersection(self.config['templates'][consumer].get('require', {})):
+        if self._refresh(consumer, wait_time, jobs):
+          changed.add(consumer)
+
   def load(self, filename='envrionment.yml'):
     self.log.info('Loading environment from: %s', filename)      
     
-    with open(filename, 'r') as input_file:
-      self.config = yaml.load(input_file)
+    if store.isStore(filename):
+      self.store = store.SqliteStore(filename)
+      # Container rows are only read when a command uses the container
+      db = self.store
+      index = db.index()
+      states = utils.LazyDict()
+      for container in index:
+        states.lazy(container, lambda container=container: db.container(container))
+      self.config = {'state': self.store.state(), 'templates': self.store.templates(), 'containers': states}
+      self.start_order, self.levels = utils.plan(self.config['templates'])
+    else:
+      self.config, self.start_order, self.levels = cache.loadPlan(filename)
+      index = dict((container, state['template']) for container, state in self.config['containers'].items())
 
-      self.state = self.config['state']
-      
-      for tmpl in self.config['templates']:
-        # TODO fix hardcoded service name and version
-        self.templates[tmpl] = template.Template(tmpl, self.config['templates'][tmpl], 'service', '0.1')
-        self.containers[tmpl] = {}
-
-      self.start_order = utils.order(self.config['templates'])
-      for container in self.config['containers']:
-        tmpl = self.config['containers'][container]['template']
-      
-        self.containers[tmpl][container] = Container(container, self.config['containers'][container], 
-          self.config['templates'][tmpl]['config'])
+    self.state = self.config['state']
+    
+    # Templates and containers are only created once a command actually uses them
+    for tmpl in self.config['templates']:
+      # TODO fix hardcoded service name and version
+      self.templates.lazy(tmpl, lambda tmpl=tmpl: template.Template(tmpl, self.config['templates'][tmpl], 'service', '0.1'))
+      self.containers[tmpl] = utils.LazyDict()
+
+    for container, tmpl in index.items():
+      self.containers[tmpl].lazy(container, lambda container=container, tmpl=tmpl: Container(container, 
+        self.config['containers'][container], self.config['templates'][tmpl]['config'], 
+        mounts=self.config['templates'][tmpl].get('mounts')))
       
   def save(self, filename='environment.yml'):
     self.log.info('Saving environment state to: %s', filename)      
+    cleanup.register(filename)
       
-    with open(filename, 'w') as output_file:
-      output_file.write(self.dump())
+    if store.isStore(filename):
+      loaded_from = self.store and self.store.filename == filename
+      if not loaded_from:
+        self.store = store.SqliteStore(filename)
+
+      # Row level updates. Containers that were never read are unchanged, those no longer in the environment are dropped.
+      snapshot = self._snapshot(changed_only=loaded_from)
+      current = set(container for tmpl in self.containers for container in self.containers[tmpl])
+      removed = [name for name in self.store.index() if name not in current]
+      self.store.save(snapshot['state'], snapshot['templates'], snapshot['containers'], removed)
+    else:
+      snapshot = self._snapshot()
+      data = utils.dumpYaml(snapshot)
+      with open(filename, 'w') as output_file:
+        output_file.write(data)
+      cache.storePlan(filename, data, snapshot, self.start_order, self.levels)
 
   def run(self, template, commandline=None, wait_time=60, attach=False, dont_add=False):
     if template in self.templates:
@@ -178,56 +360,362 @@ class Service:
       # Should handle arbitrary containers
       raise ContainerError('Unknown template')
 
-  def ps(self):
+  def logs(self, templates=None, follow=False, output=None, buffer_lines=1000):
+    # Every container's output, or those of some templates, interleaved a line at a time
+    for tmpl in templates or []:
+      if tmpl not in self.templates:
+        raise ContainerError('Unknown template: ' + tmpl)
+
+    streams = []
+    for tmpl in self.start_order:
+      if templates and tmpl not in templates:
+        continue
+      for name in sorted(self.containers[tmpl]):
+        if self._containerState(tmpl, name).get('container_id'):
+          container = self.containers[tmpl][name]
+          streams.append((name, lambda container=container: container.logs(follow)))
+
+    logs.Multiplexer(streams, output or sys.stdout, buffer_lines).run()
+
+  def ps(self, format='table', templates=None, status=None):
+    # A single list call covers state, command and ports for every container. Inspect is only needed
+    # for containers whose port mappings the list doesn't include.
+    backend = py_backend.shared()
+    listed = {}
+    for entry in backend.list_containers():
+      listed[entry['Id'][:12]] = entry
+
+    rows = []
+    for tmpl in self.start_order:
+      if templates and tmpl not in templates:
+        continue
+
+      for container in sorted(self.containers[tmpl]):
+        container_id = self._containerState(tmpl, container)['container_id']
+        row = {'id': container_id, 'name': container, 'template': tmpl, 'command': '', 'status': 'Destroyed', 'ports': ''}
+
+        entry = listed.get(container_id[:12])
+        if entry:
+          row['command'] = entry['Command']
+          row['status'] = 'Running' if entry['Status'].startswith('Up') else 'Stopped'
+          row['ports'] = self._listedPorts(entry)
+
+        rows.append(row)
+
+    from requests.exceptions import HTTPError
+    def inspect(row):
+      try:
+        state = backend.inspect_container(row['id'])
+      except HTTPError:
+        row['status'], row['ports'] = 'Destroyed', ''
+        return
+
+      p = []
+      if state['NetworkSettings']['PortMapping']:
+        p = state['NetworkSettings']['PortMapping']['Tcp']
+      row['ports'] = ', '.join(p[port] + '->' + port for port in p)
+
+    scheduler.parallel(inspect, [row for row in rows if row['ports'] is None], 16)
+
+    if status:
+      rows = [row for row in rows if row['status'].lower() == status.lower()]
+
+    if format == 'json':
+      return json.dumps(rows, indent=2)
+
     columns = '{0:<14}{1:<19}{2:<44}{3:<11}{4:<15}\n'
     result = columns.format('ID', 'NODE', 'COMMAND', 'STATUS', 'PORTS')
-
-    for tmpl in self.templates:
-      for container in self.containers[tmpl]:
-        container_id = self.containers[tmpl][container].state['container_id']
-        
-        node_name = (container[:15] + '..') if len(container) > 17 else container
-
-        command = ''
-        status = 'Stopped'
-        ports = ''
-        try:
-          state = docker.Client().inspect_container(container_id)
-          command = string.join([state['Path']] + state['Args'])
-          command = (command[:40] + '..') if len(command) > 42 else command
-          p = []
-          if state['NetworkSettings']['PortMapping']:
-            p = state['NetworkSettings']['PortMapping']['Tcp']
-          
-          for port in p:
-            if ports:
-              ports += ', '
-            ports += p[port] + '->' + port 
-          if state['State']['Running']:
-            status = 'Running'
-        except HTTPError:
-          status = 'Destroyed'
-
-        result += columns.format(container_id, node_name, command, status, ports)
+    for row in rows:
+      node_name = (row['name'][:15] + '..') if len(row['name']) > 17 else row['name']
+      command = (row['command'][:40] + '..') if len(row['command']) > 42 else row['command']
+      result += columns.format(row['id'], node_name, command, row['status'], row['ports'])
 
     return result.rstrip('\n')
 
   def dump(self):
+    return utils.dumpYaml(self._snapshot())
+  
+  def _snapshot(self, changed_only=False):
     result = {}
     result['state'] = self.state
     result['templates'] = {}
     result['containers'] = {}
     
+    # Templates and containers share their config and state with self.config until they are changed
+    # so there's no need to create them just to save them
     for template in self.templates:      
-      result['templates'][template] = self.templates[template].config
+      result['templates'][template] = self.config['templates'][template]
 
       for container in self.containers[template]:      
-        result['containers'][container] = self.containers[template][container].state
-
-    return yaml.dump(result, Dumper=yaml.SafeDumper)
+        if changed_only and not self._stateRead(template, container):
+          continue
+        result['containers'][container] = self._containerState(template, container)
+
+    return result
+
+  def _containerState(self, tmpl, container):
+    if self.containers[tmpl].loaded(container):
+      return self.containers[tmpl][container].state
+    return self.config['containers'][container]
+
+  def _stateRead(self, tmpl, container):
+    # Whether the container's state may differ from what the store has
+    states = self.config['containers']
+    if self.containers[tmpl].loaded(container) or not isinstance(states, utils.LazyDict):
+      return True
+    return states.loaded(container)
   
+  def _resolveImage(self, base):
+    try:
+      with tracing.span('resolve image', image=base):
+        images.resolve(base)
+    except TemplateError:
+      # Only fatal for templates built directly on the image. Dockerfile builds report it themselves.
+      if not any(config.get('base_image') == base for config in self.config['templates'].values()):
+        return
+      raise
+
+  def _buildTemplate(self, tmpl, use_cache=True, config=None):
+    # Create the template. The service name and version will be dynamic once the new config format is implemented
+    if config is not None:
+      self.config['templates'][tmpl] = config
+    utils.status('Building template %s' % (tmpl))
+    tmpl_instance = template.Template(tmpl, self.config['templates'][tmpl], 'service', '0.1')
+    with tracing.span('build template', template=tmpl):
+      tmpl_instance.build(use_cache)
+    if tmpl_instance.cache_hit:
+      utils.status('Reused cached image for template %s' % (tmpl))
+    else:
+      utils.status('Built template %s' % (tmpl))
+
+    self.templates[tmpl] = tmpl_instance
+
+  def _launchTemplate(self, tmpl, wait_time, launch_jobs):
+    with tracing.span('wait for requirements', template=tmpl):
+      self._handleRequire(tmpl, wait_time, cleanup=False, jobs=launch_jobs)
+      
+    # If count is defined in the config then we're launching multiple instances of the same thing
+    # and they'll need to be tagged accordingly. Count only applies on build.
+    with tracing.span('launch template', template=tmpl):
+      self._launch(tmpl, self._replicaNames(tmpl, self.config['templates'][tmpl].get('count', 1)), launch_jobs)
+
+  def _diff(self, desired, start_order):
+    # (action, template, reason) for every template that has to change, in start order with removals last
+    changes = {}
+    for tmpl in start_order:
+      want = desired[tmpl]
+      have = self.config['templates'].get(tmpl)
+      if have is None:
+        changes[tmpl] = ('create', 'new template')
+      elif want.get('base_image') != have.get('base_image') or want.get('buildspec') != have.get('buildspec'):
+        changes[tmpl] = ('rebuild', 'image changed')
+      elif self._configHash(want) != have.get('config_hash'):
+        changes[tmpl] = ('recreate', 'config changed')
+      elif want.get('mounts') != have.get('mounts'):
+        changes[tmpl] = ('recreate', 'mounts changed')
+      elif want.get('require') != have.get('require'):
+        changes[tmpl] = ('recreate', 'requirements changed')
+      elif want.get('count', 1) != have.get('count', 1):
+        changes[tmpl] = ('scale', 'count changed from %s to %s' % (have.get('count', 1), want.get('count', 1)))
+      else:
+        # Anything requiring a changed template may see it at a new address
+        changed = [service for service in sorted(want.get('require', {})) if service in changes]
+        if changed:
+          changes[tmpl] = ('restart', 'requires ' + ', '.join(changed))
+
+    steps = [(changes[tmpl][0], tmpl, changes[tmpl][1]) for tmpl in start_order if tmpl in changes]
+    steps.extend(('remove', tmpl, 'no longer configured') for tmpl in self.start_order if tmpl not in desired)
+    return steps
+
+  def _configHash(self, config):
+    return cache.buildKey(config.get('config'))
+
+  def _applyTemplate(self, tmpl, action, config, config_hash, wait_time, launch_jobs):
+    if config is not None and action in ('recreate', 'scale'):
+      self.config['templates'][tmpl] = config
+      self.templates[tmpl] = template.Template(tmpl, config, 'service', '0.1')
+    config = self.config['templates'][tmpl]
+
+    with tracing.span('apply template', template=tmpl, action=action):
+      if action == 'restart':
+        self._refresh(tmpl, wait_time, launch_jobs)
+        return
+
+      self._handleRequire(tmpl, wait_time, cleanup=False)
+
+      kept = self._resize(tmpl, config.get('count', 1), launch_jobs)
+      if action != 'scale':
+        scheduler.parallel(lambda name: self._replace(tmpl, name), kept, launch_jobs)
+      config['config_hash'] = config_hash
+
+  def _refresh(self, tmpl, wait_time, jobs=16):
+    # Recreates the template's containers if the addresses of what it requires changed
+    if self._handleRequire(tmpl, wait_time, cleanup=False, jobs=jobs):
+      scheduler.parallel(lambda name: self._replace(tmpl, name), sorted(self.containers[tmpl]), jobs)
+      return True
+    utils.status('Requirements of %s are unchanged' % (tmpl))
+    return False
+
+  def _resize(self, tmpl, count, batch=16):
+    # Adds or removes replicas in batches until there are count of them. New replicas continue the numbering
+    # and the highest numbered go first. Returns the containers that were there before and still are.
+    replicas = self._replicas(tmpl)
+    if count > len(replicas):
+      first = self._replicaIndex(tmpl, replicas[-1]) + 1 if replicas else 1
+      names = [tmpl + '__' + str(index) for index in range(first, first + count - len(replicas))]
+      if not replicas and count == 1:
+        names = [tmpl]
+      kept = sorted(self.containers[tmpl])
+      for start in range(0, len(names), batch):
+        self._launch(tmpl, names[start:start + batch], batch)
+    else:
+      surplus = list(reversed(replicas[count:]))
+      for start in range(0, len(surplus), batch):
+        self._removeContainers(tmpl, surplus[start:start + batch], batch)
+      kept = sorted(self.containers[tmpl])
+    return kept
+
+  def _replicas(self, tmpl):
+    # Replica names in index order. Containers added by run aren't replicas.
+    names = [name for name in self.containers.get(tmpl, {}) if self._replicaIndex(tmpl, name)]
+    return sorted(names, key=lambda name: self._replicaIndex(tmpl, name))
+
+  def _replicaIndex(self, tmpl, name):
+    if name == tmpl:
+      return 1
+    prefix = tmpl + '__'
+    if name.startswith(prefix) and name[len(prefix):].isdigit():
+      return int(name[len(prefix):])
+    return None
+
+  def _replace(self, tmpl, name):
+    # Recreates the container from the template's current image and config
+    instance = self.containers[tmpl][name]
+    fresh = self.templates[tmpl].instantiate(name)
+    instance.config, instance.mounts = fresh.config, fresh.mounts
+    instance.recreate(self.config['templates'][tmpl]['image_id'])
+
+  def _removeContainers(self, tmpl, names, stop_jobs=16):
+    from requests.exceptions import HTTPError
+
+    def remove(name):
+      try:
+        self.containers[tmpl][name].destroy()
+      except HTTPError:
+        self.log.warning('Container %s was already gone', name)
+
+    scheduler.parallel(remove, names, stop_jobs)
+    for name in names:
+      del self.containers[tmpl][name]
+
+  def _removeTemplate(self, tmpl):
+    self._removeContainers(tmpl, sorted(self.containers[tmpl]))
+    del self.containers[tmpl]
+    self.templates.pop(tmpl, None)
+    del self.config['templates'][tmpl]
+
+  def _reportCriticalPath(self, plan):
+    path = plan.critical_path()
+    if path:
+      steps = ['%s %s (%.1fs)' % (step, tmpl, end - start) for (step, tmpl), start, end in path]
+      utils.status('Critical path: %s, finished after %.1fs' % (' -> '.join(steps), path[-1][2]))
+
+  def _teardown(self, timeout=None, deadline=None, stop_jobs=16, remove=False):
+    # Containers are stopped in reverse dependency waves with everything in a wave stopped concurrently.
+    # Once the deadline passes whatever is left gets killed instead.
+    expires = None
+    if deadline is not None:
+      expires = time.time() + deadline
+
+    backend = py_backend.shared()
+
+    def teardownAsync(instance):
+      if expires is not None and expires - time.time() < 1:
+        future = instance.kill_async()
+      else:
+        stop_timeout = timeout if timeout is not None else 10
+        if expires is not None:
+          stop_timeout = min(stop_timeout, int(expires - time.time()))
+        future = instance.stop_async(stop_timeout)
+
+      if remove:
+        future = future.then(lambda ignored: instance.remove_async())
+      return future
+
+    def teardown(instance):
+      if expires is not None and expires - time.time() < 1:
+        instance.kill()
+      else:
+        stop_timeout = timeout
+        if expires is not None:
+          # Never let a graceful stop run past the deadline. Docker waits 10 seconds by default.
+          stop_timeout = min(timeout if timeout is not None else 10, int(expires - time.time()))
+        instance.stop(stop_timeout)
+
+      if remove:
+        instance.remove()
+
+    for wave in reversed(self.levels):
+      instances = []
+      for tmpl in wave:
+        for container in sorted(self.containers[tmpl]):
+          self.log.info('Stopping container: %s', container)      
+          instances.append(self.containers[tmpl][container])
+
+      with tracing.span('stop wave', templates=wave):
+        if py_backend.isAsync(backend):
+          # The whole wave is in flight at once without a thread per container
+          backend.gather([teardownAsync(instance) for instance in instances])
+        else:
+          scheduler.parallel(teardown, instances, stop_jobs)
+
+  def _listedPorts(self, entry):
+    # Depending on the API version ports are listed as a string or as a list of mappings. None means
+    # the container has to be inspected to find them.
+    ports = entry.get('Ports')
+    if isinstance(ports, basestring):
+      return ports
+    if isinstance(ports, list):
+      return ', '.join('%s->%s' % (port['PublicPort'], port['PrivatePort']) for port in ports
+        if port.get('PublicPort') and port.get('Type', 'tcp') == 'tcp')
+    return None
+
+  def _replicaNames(self, tmpl, count):
+    if count > 1:
+      return [tmpl + '__' + str(index) for index in range(1, count + 1)]
+    return [tmpl]
+
+  def _launch(self, tmpl, names, launch_jobs=16):
+    # Replicas are created and started concurrently
+    instances = [self.templates[tmpl].instantiate(name) for name in names]
+
+    def run(instance):
+      utils.status('Launching instance of template %s named %s' % (tmpl, instance.name))
+      instance.run()
+
+    def runAsync(instance):
+      utils.status('Launching instance of template %s named %s' % (tmpl, instance.name))
+      return instance.run_async()
+
+    backend = py_backend.shared()
+    try:
+      if py_backend.isAsync(backend):
+        backend.gather([runAsync(instance) for instance in instances])
+      else:
+        scheduler.parallel(run, instances, launch_jobs)
+    finally:
+      # Record everything that made it to the daemon, in name order, so a failed launch can still be cleaned up
+      for instance in instances:
+        if 'container_id' in instance.state:
+          self.containers[tmpl][instance.name] = instance
+
   def _getTemplate(self, container):
     # Find the template for this container
+    if self.store:
+      tmpl = self.store.template_of(container)
+      if tmpl in self.containers and container in self.containers[tmpl]:
+        return tmpl
+
     for tmpl in self.containers:
       if container in self.containers[tmpl]:
         return tmpl
@@ -235,46 +723,62 @@ class Service:
   def _live(self):
     return self.state == 'live'
 
-  def _pollService(self, container, service, name, port, wait_time):
+  def _pollService(self, container, service, name, port, wait_time, check=None, since=0):
     # Based on start_order the service should already be running
-    service_ip = self.containers[service][name].get_ip_address()
+    instance = self.containers[service][name]
+    service_ip = instance.get_ip_address()
     utils.status('Starting %s: waiting for service %s on ip %s and port %s' % (container, service, service_ip, port))
      
-    result = utils.waitForService(service_ip, int(port), wait_time)
-    if result < 0:
-      utils.status('Never found service %s on port %s' % (service, port))
-      raise ContainerError('Couldn\d find required services, aborting')
+    # The event stream tells us right away if the service died since it was started, even before we got here
+    monitor = self._monitor()
+    failed = lambda: monitor.crashed(instance.state['container_id'], since)
+    with tracing.span('wait for service', container=container, service=name, port=port):
+      ready = utils.waitForService(service_ip, int(port), wait_time, check, failed, monitor.wait)
+    if not ready:
+      if failed():
+        utils.status('Service %s exited before it became available on port %s' % (name, port))
+      else:
+        utils.status('Never found service %s on port %s' % (service, port))
+      raise ContainerError('Couldn\'t find required services, aborting')
 
     utils.status('Found service %s on ip %s and port %s' % (service, service_ip, port))
     
     #return service_ip + ":" + str(port)
     return service_ip
 
-  def _handleRequire(self, tmpl, wait_time):
+  def _monitor(self):
+    return py_backend.shared().monitor()
+
+  def _handleRequire(self, tmpl, wait_time, cleanup=True, jobs=16):
     env = []
     # Wait for any required services to finish registering        
     config = self.config['templates'][tmpl]
     if 'require' in config:
       try:
-        # Containers can depend on mulitple services
+        # Containers can depend on mulitple services and their instances get probed jobs at a time
+        targets = []
         for service in config['require']:
-          service_env = []
-          port = config['require'][service]['port']          
-          if port:
-            # If count is defined then we need to wait for all instances to start                    
-            count = config['require'][service].get('count', 1)          
-            if count > 1:
-              while count > 0:
-                name = service + '__' + str(count)
-                service_env.append(self._pollService(tmpl, service, name, port, wait_time))
-                count = count - 1                
-            else:
-              service_env.append(self._pollService(tmpl, service, service, port, wait_time))
+          if config['require'][service]['port']:
+            # Wait for every replica the service has, which can differ from the count it was built with
+            names = self._replicas(service) or self._replicaNames(service, config['require'][service].get('count', 1))
+            targets.extend((service, name) for name in reversed(names))
+
+        def poll(target):
+          service, name = target
+          require = config['require'][service]
+          return self._pollService(tmpl, service, name, require['port'], wait_time, require)
 
+        found = scheduler.parallel(poll, targets, jobs)
+
+        for service in config['require']:
+          service_env = [ip for (required, name), ip in zip(targets, found) if required == service]
+          if service_env:
             env.append(service.upper() + '=' + ' '.join(service_env))
       except:
-        utils.status('Failure on require. Shutting down the environment')
-        self.destroy()
+        # During a build other templates may still be launching so the caller does the cleanup
+        if cleanup:
+          utils.status('Failure on require. Shutting down the environment')
+          self.destroy()
         raise
       
       # If the environment changes then dependent containers will need to be re-run not just restarted
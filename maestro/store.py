@@ -0,0 +1,128 @@
+import json, threading
+import utils
+
+def isStore(filename):
+  # Environments saved with a .db extension are kept in SQLite instead of YAML
+  return filename.endswith('.db')
+
+class SqliteStore:
+  """
+  Environment state kept in SQLite. Containers are indexed by name and template so single
+  containers can be looked up without reading the whole environment and saves only touch
+  the rows that changed, all in one transaction.
+  """
+  SCHEMA = """
+    create table if not exists environment (key text primary key, value text not null);
+    create table if not exists templates (name text primary key, config text not null);
+    create table if not exists containers (name text primary key, template text not null, state text not null);
+    create index if not exists containers_template on containers (template);
+  """
+
+  def __init__(self, filename):
+    import sqlite3
+
+    self.filename = filename
+    # Rows are read on demand, from whichever thread first needs the container
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.lock = threading.Lock()
+    self.db.executescript(self.SCHEMA)
+    # What each row looked like when it was last read or written
+    self.rows = {'environment': {}, 'templates': {}, 'containers': {}}
+
+  def close(self):
+    self.db.close()
+
+  def state(self):
+    row = self.db.execute("select value from environment where key = 'state'").fetchone()
+    if row:
+      self.rows['environment']['state'] = row[0]
+      return row[0]
+    return 'live'
+
+  def templates(self):
+    result = {}
+    for name, config in self.db.execute('select name, config from templates'):
+      self.rows['templates'][name] = config
+      result[name] = json.loads(config)
+    return result
+
+  def containers(self, template=None):
+    query = 'select name, template, state from containers'
+    if template:
+      rows = self.db.execute(query + ' where template = ?', (template,))
+    else:
+      rows = self.db.execute(query)
+
+    result = {}
+    for name, tmpl, state in rows:
+      self.rows['containers'][name] = state
+      result[name] = json.loads(state)
+    return result
+
+  def index(self):
+    # Container names and their templates, without reading any state
+    with self.lock:
+      return dict(self.db.execute('select name, template from containers'))
+
+  def container(self, name):
+    with self.lock:
+      row = self.db.execute('select state from containers where name = ?', (name,)).fetchone()
+    if row:
+      self.rows['containers'][name] = row[0]
+      return json.loads(row[0])
+    return None
+
+  def template_of(self, name):
+    row = self.db.execute('select template from containers where name = ?', (name,)).fetchone()
+    if row:
+      return row[0]
+    return None
+
+  def save(self, state, templates, containers, removed=None):
+    # templates is every template in the environment, containers only needs the ones that may have changed.
+    # Only rows that differ from what was last read or written get updated.
+    with self.lock, self.db:
+      if self.rows['environment'].get('state') != state:
+        self.db.execute("insert or replace into environment (key, value) values ('state', ?)", (state,))
+        self.rows['environment']['state'] = state
+
+      for name, config in templates.items():
+        serialized = _serialize(config)
+        if self.rows['templates'].get(name) != serialized:
+          self.db.execute('insert or replace into templates (name, config) values (?, ?)', (name, serialized))
+          self.rows['templates'][name] = serialized
+
+      for (name,) in self.db.execute('select name from templates').fetchall():
+        if name not in templates:
+          self.db.execute('delete from templates where name = ?', (name,))
+          self.rows['templates'].pop(name, None)
+
+      for name, container_state in containers.items():
+        serialized = _serialize(container_state)
+        if self.rows['containers'].get(name) != serialized:
+          self.db.execute('insert or replace into containers (name, template, state) values (?, ?, ?)', 
+            (name, container_state['template'], serialized))
+          self.rows['containers'][name] = serialized
+
+      for name in removed or []:
+        self.db.execute('delete from containers where name = ?', (name,))
+        self.rows['containers'].pop(name, None)
+
+def _serialize(value):
+  return json.dumps(value, sort_keys=True)
+
+def importYaml(yaml_file, db_file):
+  with open(yaml_file, 'r') as input_file:
+    env = utils.loadYaml(input_file)
+
+  store = SqliteStore(db_file)
+  store.save(env['state'], env['templates'], env['containers'])
+  store.close()
+
+def exportYaml(db_file, yaml_file):
+  store = SqliteStore(db_file)
+  env = {'state': store.state(), 'templates': store.templates(), 'containers': store.containers()}
+  store.close()
+
+  with open(yaml_file, 'w') as output_file:
+    output_file.write(utils.dumpYaml(env))
@@ -1,6 +1,5 @@
-import exceptions, utils, container, py_backend
-import StringIO, copy, logging, sys
-from requests.exceptions import HTTPError
+import exceptions, utils, container, py_backend, cache, images
+import StringIO, copy, logging, sys, collections, re
 
 class Template:
   def __init__(self, name, config, service, version):
@@ -10,32 +9,35 @@ class Template:
     self.version  = version
     self.log      = logging.getLogger('maestro')
 
-    self.backend = py_backend.PyBackend()
+    self.backend = py_backend.shared()
+    # Set when the last build reused a cached image
+    self.cache_hit = False
 
-  def build(self):
+  def build(self, use_cache=True):
+    self.cache_hit = False
     # If there is a docker file or url hand off to Docker builder    
     if 'buildspec' in self.config:
       if self.config['buildspec']:
         if 'dockerfile' in self.config['buildspec']:
-          self._build(dockerfile=self.config['buildspec']['dockerfile'])
+          dockerfile = self.config['buildspec']['dockerfile']
+          base_id = None
+          base = images.baseImage(self.config)
+          if base:
+            # A base image that couldn't be pulled would only be pulled again by the builder
+            base_id = images.resolve(base)
+          self._build(dockerfile=dockerfile, key=self._cache_key(dockerfile, base_id), use_cache=use_cache)
         elif 'url' in self.config['buildspec']:
-          self._build(url=self.config['buildspec']['url'])
+          # The remote build context can change without the url changing so these are never cached
+          self._build(url=self.config['buildspec']['url'], use_cache=use_cache)
       else:
         raise exceptions.TemplateError("Template: " + self.name + " Buildspec specified but no dockerfile or url found.")
     else:
       # verify the base image and pull it if necessary
       try:
         base = self.config['base_image']    
-        self.backend.inspect_image(base)
-      except HTTPError:
-        # Attempt to pull the image.
-        self.log.info('Attempting to pull base: %s', base)
-        result = self.backend.pull_image(base)
-        if 'error' in result:
-          self.log.error('No base image could be pulled under the name: %s', base)      
-          raise exceptions.TemplateError("No base image could be pulled under the name: " + base)
       except KeyError:
         raise exceptions.TemplateError("Template: " + self.name + "No base image specified.")
+      base_id = images.resolve(base)
 
       # There doesn't seem to be a way to currently remove tags so we'll generate a new image.
       # More consistent for all cases this way too but it does feel kinda wrong.
@@ -43,7 +45,7 @@ class Template:
       FROM %s
       MAINTAINER %s
       """ % (base, self._mid())
-      self._build(dockerfile=dockerfile)
+      self._build(dockerfile=dockerfile, key=self._cache_key(dockerfile, base_id), use_cache=use_cache)
 
     return True
 
@@ -93,27 +95,78 @@ class Template:
   def _mid(self):
     return self.service + "." + self.name + ":" + self.version
 
-  def _build(self, dockerfile=None, url=None):
+  def _image_id(self, name):
+    from requests.exceptions import HTTPError
+    try:
+      image = self.backend.inspect_image(name)
+      return image.get('id') or image.get('Id')
+    except HTTPError:
+      return None
+
+  def _cache_key(self, dockerfile, base_id):
+    # Everything that goes into the build. Without a base image id there's nothing reliable to key on.
+    if not base_id:
+      return None
+    return cache.buildKey(self._mid(), dockerfile, base_id, self.config.get('buildspec'))
+
+  def _build(self, dockerfile=None, url=None, key=None, use_cache=True):
+    # Reuse the image from an identical earlier build as long as it still exists
+    if key and use_cache:
+      image_id = cache.buildCache().get(key)
+      if image_id and self._image_id(image_id):
+        self.log.info('Reusing cached image %s for: %s', image_id, self._mid())
+        self.cache_hit = True
+        self.config['image_id'] = image_id
+        self._tag(image_id)
+        return
+
     self.log.info('Building container: %s', self._mid())      
 
     if (dockerfile):
-      result = self.backend.build_image(fileobj=StringIO.StringIO(dockerfile))
+      output = self.backend.build_image(fileobj=StringIO.StringIO(dockerfile), nocache=not use_cache, stream=True)
     elif (url):
-      result = self.backend.build_image(path=url)
+      output = self.backend.build_image(path=url, nocache=not use_cache, stream=True)
     else:
       raise exceptions.TemplateError("Can't build if no buildspec is provided: " + self.name)
-    
-    if result[0] == None:
-      # TODO: figure out what to do with the result of this execution
-      print result
-      raise exceptions.TemplateError("Build failed for template: " + self.name)
 
-    self.config['image_id'] = result[0]
+    image_id = self._follow(output)
+
+    self.config['image_id'] = image_id
+    if key:
+      cache.buildCache().put(key, image_id)
     
     self._tag(self.config['image_id'])
 
     self.log.info('Container registered with tag: %s', self._mid())   
 
+  def _follow(self, output):
+    # Reads the build output as it arrives. Steps are shown as they start, everything goes to the template's
+    # build log and only the last few lines are held on to for reporting a failure.
+    path = utils.logPath('build', self.service + '.' + self.name)
+    tail = collections.deque(maxlen=20)
+    image_id = None
+    failed = False
+    with open(path, 'w') as log_file:
+      for line, message in utils.outputLines(output):
+        log_file.write(line + '\n')
+        log_file.flush()
+        tail.append(line)
+        if message and 'error' in message:
+          failed = True
+        match = re.match(r'Successfully built ([0-9a-f]+)', line)
+        if match:
+          image_id = match.group(1)
+        elif line.startswith('Step '):
+          # Builds run concurrently so attribute every line to this template
+          utils.status('[%s] %s' % (self.name, line))
+
+    if failed or not image_id:
+      for line in tail:
+        utils.status('[%s] %s' % (self.name, line))
+      utils.status('[%s] Full build output is in %s' % (self.name, path))
+      raise exceptions.TemplateError("Build failed for template: " + self.name)
+    return image_id
+
   def _tag(self, image_id):
     # Tag the container with the name and process id
     self.backend.tag_image(image_id, self.service + "." + self.name, tag=self.version)
@@ -0,0 +1,114 @@
+import threading, time, json, os, atexit, functools, itertools, types
+from contextlib import contextmanager
+
+# Spans recorded in Chrome's trace event format. Nothing is recorded until enable is called.
+_events = None
+_threads = {}
+_ids = itertools.count(1)
+_lock = threading.Lock()
+
+def enable(filename=None):
+  # Record spans from now on and, given a filename, write them there when the process exits
+  global _events
+  with _lock:
+    if _events is None:
+      _events = []
+      if filename:
+        atexit.register(write, filename)
+
+def disable():
+  global _events
+  with _lock:
+    _events = None
+    _threads.clear()
+
+def enabled():
+  return _events is not None
+
+def begin(name, category='maestro', **args):
+  # For spans that don't fit in a with block, like requests finished on another thread. These are recorded
+  # as async events so overlapping ones don't have to nest.
+  if _events is None:
+    return None
+  token = (name, category, next(_ids))
+  _append({'name': name, 'cat': category, 'ph': 'b', 'id': token[2], 'ts': int(time.time() * 1000000), 'args': args})
+  return token
+
+def end(token):
+  if token:
+    name, category, id = token
+    _append({'name': name, 'cat': category, 'ph': 'e', 'id': id, 'ts': int(time.time() * 1000000)})
+
+@contextmanager
+def span(name, category='maestro', **args):
+  if _events is None:
+    yield
+    return
+
+  start = time.time()
+  try:
+    yield
+  finally:
+    _record(name, category, args, start, time.time())
+
+def traced(category='docker', streams=False):
+  # Wraps every call to the function in a span named after it. A string first argument, usually a
+  # container or image, is recorded with it. With streams a call that hands back a generator is only
+  # done once the generator is, which may be on another thread.
+  def decorate(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+      if _events is None:
+        return func(self, *args, **kwargs)
+
+      details = {}
+      if args and isinstance(args[0], basestring):
+        details['target'] = args[0]
+      if not streams:
+        with span(func.__name__, category, **details):
+          return func(self, *args, **kwargs)
+
+      token = begin(func.__name__, category, **details)
+      try:
+        result = func(self, *args, **kwargs)
+      except:
+        end(token)
+        raise
+      if isinstance(result, types.GeneratorType):
+        return _ended(result, token)
+      end(token)
+      return result
+    return wrapper
+  return decorate
+
+def _ended(stream, token):
+  try:
+    for item in stream:
+      yield item
+  finally:
+    end(token)
+
+def write(filename):
+  with _lock:
+    events = list(_events or [])
+    threads = dict(_threads)
+
+  pid = os.getpid()
+  for tid, name in threads.items():
+    events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+
+  with open(filename, 'w') as output_file:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, output_file)
+
+def _record(name, category, args, start, finish):
+  _append({'name': name, 'cat': category, 'ph': 'X', 'ts': int(start * 1000000), 'dur': int((finish - start) * 1000000),
+    'args': args})
+
+def _append(event):
+  thread = threading.current_thread()
+  event['pid'] = os.getpid()
+  event['tid'] = thread.ident
+  with _lock:
+    if _events is not None:
+      _events.append(event)
+      _threads.setdefault(thread.ident, thread.name)
@@ -0,0 +1,43 @@
+import socket, httplib
+import requests.adapters
+
+try:
+  import requests.packages.urllib3.connectionpool as connectionpool
+except ImportError:
+  import urllib3.connectionpool as connectionpool
+
+class UnixConnection(httplib.HTTPConnection):
+  def __init__(self, socket_path, timeout):
+    httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+    self.socket_path = socket_path
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+    sock.connect(self.socket_path)
+    self.sock = sock
+
+class UnixConnectionPool(connectionpool.HTTPConnectionPool):
+  def __init__(self, socket_path, timeout, maxsize):
+    connectionpool.HTTPConnectionPool.__init__(self, 'localhost', timeout=timeout, maxsize=maxsize)
+    self.socket_path = socket_path
+
+  def _new_conn(self):
+    return UnixConnection(self.socket_path, self.timeout)
+
+class UnixPoolAdapter(requests.adapters.HTTPAdapter):
+  # docker-py's own unix adapter opens a new connection pool for every URL so nothing is ever reused.
+  # This one sends every request through a single bounded pool of keep-alive connections.
+  def __init__(self, base_url, timeout, pool_size):
+    requests.adapters.HTTPAdapter.__init__(self)
+    self.base_url = base_url
+    self.unix_pool = UnixConnectionPool(base_url.replace('unix:/', ''), timeout, pool_size)
+
+  def get_connection(self, url, proxies=None):
+    return self.unix_pool
+
+  def request_url(self, request, proxies):
+    return request.url[len(self.base_url):]
+
+  def close(self):
+    self.unix_pool.close()
@@ -1,6 +1,6 @@
 import logging
-import os, sys, time, socket
-import docker
+import os, sys, time, socket, threading, random, re, httplib
+import exceptions, py_backend
 
 def setupLogging():
   log = logging.getLogger('maestro')
@@ -14,7 +14,22 @@ def setupLogging():
     log.addHandler(filehandler)  
   return log
 
+# Use the libyaml bindings when they're available, they're several times faster than the pure Python versions.
+# yaml is only imported when a file actually needs to be parsed or written.
+def yamlLoader():
+  import yaml
+  return getattr(yaml, 'CLoader', yaml.Loader)
+
+def loadYaml(stream):
+  import yaml
+  return yaml.load(stream, Loader=yamlLoader())
+
+def dumpYaml(data):
+  import yaml
+  return yaml.dump(data, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
+
 quiet=False
+status_lock = threading.Lock()
 def setQuiet(state=True):
   global quiet
   quiet = state
@@ -26,64 +41,226 @@ def status(string):
   log.info(string)
   
   if not quiet:
-    print string
+    # Work is spread across threads so keep lines from interleaving
+    with status_lock:
+      print string
 
-def order(raw_list):
-  def _process(wait_list):
-    new_wait = []
-    for item in wait_list:
-      match = False
-      for dependency in raw_list[item]['require']:
-        if dependency in ordered_list:
-          match = True  
-        else:
-          match = False
-          break
-
-      if match:
-        ordered_list.append(item)
-      else:
-        new_wait.append(item)
-
-    if len(new_wait) > 0:
-      # Guard against circular dependencies
-      if len(new_wait) == len(wait_list):
-        raise Exception("Unable to satisfy the require for: " + item)
-
-      # Do it again for any remaining items
-      _process(new_wait)
+def logPath(kind, name):
+  # Per template build and pull output is kept with the cache, out of the way of local and named environments
+  import cache
+  directory = os.environ.get('MAESTRO_LOG_DIR') or os.path.join(cache.cacheDir(), 'logs')
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      # Another thread got there first
+      pass
+  return os.path.join(directory, '%s-%s.log' % (kind, re.sub(r'[^\w.-]', '_', name)))
 
-  ordered_list = []
-  wait_list = []
-  # Start by building up the list of items that do not have any dependencies
-  for item in raw_list:  
-    if 'require' not in raw_list[item]:
-      ordered_list.append(item)
+def outputLines(stream):
+  # Build and pull output comes as plain text from older daemons and as JSON messages from newer ones.
+  # Yields (line, message) one line at a time as chunks arrive, message being None for plain text.
+  pending = ''
+  for chunk in stream:
+    pending += chunk
+    while '\n' in pending:
+      line, pending = pending.split('\n', 1)
+      for item in _decodeOutput(line):
+        yield item
+  for item in _decodeOutput(pending):
+    yield item
+
+def _decodeOutput(line):
+  import json
+  line = line.strip()
+  if not line.startswith('{'):
+    if line:
+      yield line, None
+    return
+
+  # Messages aren't always separated by newlines
+  decoder = json.JSONDecoder()
+  index = 0
+  while index < len(line):
+    try:
+      message, index = decoder.raw_decode(line, index)
+    except ValueError:
+      yield line[index:], None
+      return
+    while index < len(line) and line[index].isspace():
+      index += 1
+
+    if 'error' in message:
+      text = message['error']
+    elif 'stream' in message:
+      text = message['stream']
     else:
-      wait_list.append(item)
-
-  # Then recursively order the items that do define dependencies
-  _process(wait_list)
-
-  return ordered_list
-
-def waitForService(ip, port, retries=60):      
-  while retries >= 0:
-    try:        
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(1)
-        s.connect((ip, port))
-        s.close()
-        break
-    except:
-      time.sleep(0.5)
-      retries = retries - 1
-      continue
-    
-  return retries
+      text = u' '.join(unicode(message[key]) for key in ('id', 'status', 'progress') if message.get(key))
+    for part in text.splitlines():
+      if part.strip():
+        yield part.rstrip().encode('utf-8'), message
+
+def plan(raw_list):
+  # Kahn style topological sort. Returns the flat start order along with the levels of items that can be
+  # handled at the same time because each item only requires items from earlier levels.
+  dependents = dict((item, []) for item in raw_list)
+  waiting = {}
+  for item in raw_list:
+    requires = (raw_list[item] or {}).get('require') or {}
+    for dependency in requires:
+      if dependency not in raw_list:
+        raise exceptions.DependencyError("Unable to satisfy the require for: " + item + ". Unknown template: " + dependency)
+      dependents[dependency].append(item)
+    waiting[item] = len(requires)
+
+  ordered_list = []
+  levels = []
+  level = [item for item in raw_list if not waiting[item]]
+  while level:
+    levels.append(level)
+    ordered_list.extend(level)
+
+    next_level = []
+    for item in level:
+      for dependent in dependents[item]:
+        waiting[dependent] -= 1
+        if not waiting[dependent]:
+          next_level.append(dependent)
+    level = next_level
+
+  # Anything still waiting is part of, or stuck behind, a circular dependency
+  if len(ordered_list) != len(raw_list):
+    raise exceptions.DependencyError("Unable to satisfy the require due to a cycle: " + 
+      " -> ".join(_cycle(raw_list, waiting)))
+
+  return ordered_list, levels
+
+def order(raw_list):
+  return plan(raw_list)[0]
+
+def levels(raw_list):
+  return plan(raw_list)[1]
+
+def _cycle(raw_list, waiting):
+  # Every item still waiting requires at least one other waiting item so following those
+  # requirements has to come back around to an item already seen.
+  item = [item for item in raw_list if waiting[item]][0]
+  path = []
+  seen = {}
+  while item not in seen:
+    seen[item] = len(path)
+    path.append(item)
+    item = [dependency for dependency in raw_list[item]['require'] if waiting[dependency]][0]
+
+  return path[seen[item]:] + [item]
+
+def waitForService(ip, port, wait_time=60, check=None, failed=None, pause=time.sleep):
+  # Probe the service until the check passes or wait_time seconds have gone by. Retries back off exponentially
+  # with jitter so that many waiting containers don't hammer a service in lock step. Waiting stops early
+  # if failed reports that the service is gone, and pause can wake up early to let that happen sooner.
+  check = check or {}
+  probe = probes.get(check.get('probe', 'tcp'))
+  if not probe:
+    raise exceptions.ContainerError('Unknown probe type: ' + check['probe'])
+  if probe == _bannerProbe and not check.get('banner'):
+    raise exceptions.ContainerError('banner probe needs a banner pattern')
+
+  expires = time.time() + wait_time
+  delay = 0.1
+  while True:
+    try:
+      if probe(ip, port, check):
+        return True
+    except (socket.error, httplib.HTTPException):
+      pass
+
+    if time.time() + delay > expires or (failed and failed()):
+      return False
+
+    pause(random.uniform(delay / 2, delay))
+    delay = min(delay * 2, 2)
+
+def _tcpProbe(ip, port, check):
+  s = socket.create_connection((ip, port), 1)
+  s.close()
+  return True
+
+def _httpProbe(ip, port, check):
+  connection = httplib.HTTPConnection(ip, port, timeout=1)
+  try:
+    connection.request('GET', check.get('path', '/'))
+    return connection.getresponse().status == int(check.get('status', 200))
+  finally:
+    connection.close()
+
+def _bannerProbe(ip, port, check):
+  s = socket.create_connection((ip, port), 1)
+  try:
+    return re.search(check['banner'], s.recv(1024)) is not None
+  finally:
+    s.close()
+
+probes = {
+  'tcp': _tcpProbe,
+  'http': _httpProbe,
+  'banner': _bannerProbe
+}
+
+class LazyDict(dict):
+  # A dict where values can be registered as a factory that is only called the first time the value is used
+  def __init__(self):
+    dict.__init__(self)
+    self.factories = {}
+    self.lock = threading.Lock()
+
+  def lazy(self, key, factory):
+    dict.__setitem__(self, key, None)
+    self.factories[key] = factory
+
+  def loaded(self, key):
+    return key not in self.factories
+
+  def __getitem__(self, key):
+    if key in self.factories:
+      with self.lock:
+        if key in self.factories:
+          dict.__setitem__(self, key, self.factories.pop(key)())
+    return dict.__getitem__(self, key)
+
+  def __setitem__(self, key, value):
+    self.factories.pop(key, None)
+    dict.__setitem__(self, key, value)
+
+  def __delitem__(self, key):
+    self.factories.pop(key, None)
+    dict.__delitem__(self, key)
+
+  def get(self, key, default=None):
+    if key in self:
+      return self[key]
+    return default
+
+  def pop(self, key, *default):
+    if key in self:
+      value = self[key]
+      del self[key]
+      return value
+    return dict.pop(self, key, *default)
+
+  def values(self):
+    return [self[key] for key in self]
+
+  def items(self):
+    return [(key, self[key]) for key in self]
+
+  def itervalues(self):
+    return (self[key] for key in self)
+
+  def iteritems(self):
+    return ((key, self[key]) for key in self)
 
 def findImage(name, tag="latest"):
-  result =  docker.Client().images(name=name)
+  result = py_backend.shared().images(name=name)
 
   for image in result:
     if image['Tag'] == tag:
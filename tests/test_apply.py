@@ -0,0 +1,169 @@
+import unittest, sys, os, copy, tempfile, shutil
+sys.path.append('.')
+from maestro import service, utils, cache
+
+utils.setQuiet(True)
+
+TEMPLATES = {
+  'db': {'base_image': 'ubuntu', 'config': {'command': 'db', 'ports': ['5432']}},
+  'web': {'base_image': 'ubuntu', 'count': 2, 'config': {'command': 'web'}, 'require': {'db': {'port': '5432'}}},
+  'proxy': {'base_image': 'ubuntu', 'config': {'command': 'proxy'}, 'require': {'web': {'port': '80', 'count': 2}}},
+  'cron': {'base_image': 'ubuntu', 'config': {'command': 'cron'}}
+}
+
+class Replica:
+  def __init__(self, name, tmpl):
+    self.name = name
+    self.state = {'template': tmpl, 'container_id': 'id-' + name, 'image_id': 'image'}
+
+class TestApply(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.environ['MAESTRO_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+    os.environ['MAESTRO_REGISTRY'] = os.path.join(self.dir, 'environments.json')
+
+    # What build saves: image ids, config hashes and the addresses added to the environment of consumers
+    templates = copy.deepcopy(TEMPLATES)
+    for name, config in templates.items():
+      config['config_hash'] = cache.buildKey(config['config'])
+      config['image_id'] = 'image-' + name
+    templates['web']['config']['environment'] = ['DB=172.17.0.2']
+    containers = {}
+    for name in ['db', 'web__1', 'web__2', 'proxy', 'cron']:
+      containers[name] = {'template': name.split('__')[0], 'container_id': 'id-' + name, 'image_id': 'image'}
+
+    self.environment = self._write('environment.yml', {'state': 'live', 'templates': templates, 'containers': containers})
+
+  def tearDown(self):
+    del os.environ['MAESTRO_CACHE_DIR']
+    del os.environ['MAESTRO_REGISTRY']
+    shutil.rmtree(self.dir)
+
+  def testUnchanged(self):
+    self.assertEqual(self._diff(TEMPLATES), [])
+
+  def testConfigChange(self):
+    templates = copy.deepcopy(TEMPLATES)
+    templates['web']['config']['command'] = 'web --verbose'
+    self.assertEqual(self._diff(templates), [('recreate', 'web', 'config changed'), ('restart', 'proxy', 'requires web')])
+
+  def testImageChange(self):
+    templates = copy.deepcopy(TEMPLATES)
+    templates['db']['base_image'] = 'ubuntu:12.04'
+    self.assertEqual([step[:2] for step in self._diff(templates)],
+      [('rebuild', 'db'), ('restart', 'web'), ('restart', 'proxy')])
+
+  def testAddAndRemove(self):
+    templates = copy.deepcopy(TEMPLATES)
+    del templates['cron']
+    templates['worker'] = {'base_image': 'ubuntu', 'config': {'command': 'work'}}
+    templates['web']['count'] = 3
+    self.assertEqual(sorted(self._diff(templates)), [('create', 'worker', 'new template'),
+      ('remove', 'cron', 'no longer configured'), ('restart', 'proxy', 'requires web'),
+      ('scale', 'web', 'count changed from 2 to 3')])
+
+  def testScale(self):
+    mix = service.Service(environment=self.environment)
+    launched = []
+    removed = []
+    refreshed = []
+    def launch(tmpl, names, jobs):
+      launched.append(names)
+      for name in names:
+        mix.containers[tmpl][name] = None
+    def remove(tmpl, names, jobs):
+      removed.append(names)
+      for name in names:
+        del mix.containers[tmpl][name]
+    mix._launch, mix._removeContainers = launch, remove
+    mix._handleRequire = lambda tmpl, wait_time, cleanup=True, jobs=16: False
+    mix._refresh = lambda tmpl, wait_time, jobs: refreshed.append(tmpl)
+
+    # Numbering carries on from the highest replica and the highest go first
+    mix.scale('web', 5, batch=2)
+    self.assertEqual(launched, [['web__3', 'web__4'], ['web__5']])
+    mix.scale('web', 1, batch=3)
+    self.assertEqual(removed, [['web__5', 'web__4', 'web__3'], ['web__2']])
+    self.assertEqual(mix._replicas('web'), ['web__1'])
+    self.assertEqual(mix.config['templates']['web']['count'], 1)
+    self.assertEqual(refreshed, ['proxy', 'proxy'])
+
+    mix.scale('db', 2)
+    self.assertEqual(launched[-1], ['db__2'])
+    self.assertEqual(mix._replicas('db'), ['db', 'db__2'])
+
+  def testApplyScale(self):
+    mix = service.Service(environment=self.environment)
+    def launch(tmpl, names, jobs):
+      for name in names:
+        mix.containers[tmpl][name] = Replica(name, tmpl)
+    def require(tmpl, wait_time, cleanup=True, jobs=16):
+      # Like the real thing, the addresses of what it requires end up in the environment
+      if tmpl == 'web':
+        mix.config['templates'][tmpl]['config']['environment'] = ['DB=172.17.0.9']
+      return False
+    mix._launch, mix._handleRequire = launch, require
+
+    templates = copy.deepcopy(TEMPLATES)
+    templates['web']['count'] = 4
+    conf = self._write('maestro.yml', {'templates': templates})
+    self.assertEqual(mix.apply(conf)[0], ('scale', 'web', 'count changed from 2 to 4'))
+    self.assertEqual(mix._replicas('web'), ['web__1', 'web__2', 'web__3', 'web__4'])
+    self.assertEqual(mix.config['templates']['web']['count'], 4)
+
+    mix.save(self.environment)
+    self.assertEqual(service.Service(environment=self.environment).diff(conf), [])
+
+  def testRollingRestart(self):
+    mix = service.Service(environment=self.environment)
+    events = []
+    class Instance:
+      def __init__(self, name):
+        self.name = name
+        self.state = {'container_id': 'id-' + name}
+
+      def stop(self, timeout):
+        events.append(('stop', self.name))
+
+      def start(self):
+        events.append(('start', self.name))
+
+    class Monitor:
+      alive = True
+
+      def mark(self):
+        return 0
+
+      def exited_since(self, container_id, mark):
+        return True
+
+    def poll(container, required, name, port, wait_time, check, since=0):
+      events.append(('ready', name, port))
+      if name == 'web__3':
+        raise service.ContainerError('Couldn\'t find required services, aborting')
+
+    for name in ['web__1', 'web__2', 'web__3', 'web__4', 'web__5']:
+      mix.containers['web'][name] = Instance(name)
+    mix._handleRequire = lambda tmpl, wait_time, cleanup=True, jobs=16: False
+    mix._monitor = lambda: Monitor()
+    mix._pollService = poll
+
+    # Each batch waits on the port proxy requires and the rollout ends with the batch that never got there
+    with self.assertRaises(service.ContainerError):
+      mix.restart('web', batch=2)
+    self.assertEqual(sorted(events[:6]), [('ready', 'web__1', '80'), ('ready', 'web__2', '80'), ('start', 'web__1'),
+      ('start', 'web__2'), ('stop', 'web__1'), ('stop', 'web__2')])
+    self.assertEqual(sorted(event[1] for event in events[6:]), ['web__3', 'web__3', 'web__3', 'web__4', 'web__4',
+      'web__4'])
+
+  def _diff(self, templates):
+    return service.Service(environment=self.environment).diff(self._write('maestro.yml', {'templates': templates}))
+
+  def _write(self, name, data):
+    filename = os.path.join(self.dir, name)
+    with open(filename, 'w') as output_file:
+      output_file.write(utils.dumpYaml(data))
+    return filename
+
+if __name__ == '__main__':
+  unittest.main()
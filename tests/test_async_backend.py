@@ -0,0 +1,122 @@
+import unittest, sys, os, json, tempfile, shutil, threading, time, struct
+import SocketServer, BaseHTTPServer
+sys.path.append('.')
+from maestro import async_backend, metrics
+from requests.exceptions import HTTPError
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    if self.path.startswith('/v1.6/images/ubuntu/json'):
+      self._reply(200, json.dumps({'id': 'abc123'}))
+    elif self.path.startswith('/v1.6/containers/slow/json'):
+      time.sleep(0.2)
+      self._reply(200, json.dumps({'Id': 'slow'}))
+    else:
+      self._reply(404, 'No such image')
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if self.path.startswith('/v1.6/containers/create'):
+      self.server.created.append(json.loads(body))
+      self._reply(201, json.dumps({'Id': 'container1'}))
+    elif self.path.startswith('/v1.6/containers/container2/attach'):
+      # Output of a container without a tty comes in frames
+      output = ''.join(struct.pack('>BxxxL', 1, len(line)) + line for line in ['hello\n', 'world\n'])
+      self._reply(200, output)
+    elif self.path.startswith('/v1.6/containers/container1/attach') or self.path.startswith('/v1.6/images/create'):
+      # Streamed output comes back chunked
+      self.send_response(200)
+      self.send_header('Transfer-Encoding', 'chunked')
+      self.end_headers()
+      for line in ['hello\n', 'world\n']:
+        self.wfile.write('%x\r\n%s\r\n' % (len(line), line))
+      self.wfile.write('0\r\n\r\n')
+    else:
+      self._reply(204, '')
+
+  def _reply(self, status, body):
+    self.send_response(status)
+    if status != 204:
+      self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+  def get_request(self):
+    # BaseHTTPRequestHandler expects a client address
+    request, address = SocketServer.UnixStreamServer.get_request(self)
+    return request, ('local', 0)
+
+class TestAsyncBackend(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    path = os.path.join(self.dir, 'docker.sock')
+    self.daemon = Daemon(path, Handler)
+    self.daemon.created = []
+    thread = threading.Thread(target=self.daemon.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.backend = async_backend.AsyncBackend(async_backend.Loop(path))
+
+  def tearDown(self):
+    self.daemon.shutdown()
+    self.daemon.server_close()
+    shutil.rmtree(self.dir)
+
+  def testRequest(self):
+    self.assertEqual(self.backend.inspect_image('ubuntu'), {'id': 'abc123'})
+    self.assertEqual(self.backend.create_container('abc123', {'command': 'echo hello', 'hostname': 'web'}), 'container1')
+    self.assertEqual(self.daemon.created[0]['Cmd'], ['echo', 'hello'])
+    self.assertEqual(self.daemon.created[0]['Hostname'], 'web')
+    self.backend.start_container('container1')
+
+  def testError(self):
+    with self.assertRaises(HTTPError) as e:
+      self.backend.inspect_image('missing')
+    self.assertEqual(str(e.exception), '404 Client Error: Not Found ("No such image")')
+
+  def testMetrics(self):
+    metrics.reset()
+    self.backend.inspect_image('ubuntu')
+    with self.assertRaises(HTTPError):
+      self.backend.inspect_image('missing')
+    self.backend.start_container('container1')
+
+    # Counted under the same names the threaded backend uses
+    text = metrics.render()
+    self.assertIn('maestro_docker_calls_total{method="inspect_image"} 2\n', text)
+    self.assertIn('maestro_docker_errors_total{method="inspect_image"} 1\n', text)
+    self.assertIn('maestro_docker_calls_total{method="start_container"} 1\n', text)
+    self.assertEqual(async_backend._endpoint('DELETE', '/images/user/app'), 'remove_image')
+    self.assertEqual(async_backend._endpoint('GET', '/version'), 'GET /version')
+
+  def testStream(self):
+    self.assertEqual(''.join(self.backend.attach_container('container1')), 'hello\nworld\n')
+
+  def testLogs(self):
+    self.assertEqual(''.join(self.backend.attach_container('container2', logs=True)), 'hello\nworld\n')
+    self.assertEqual(self.backend.container_logs('container2'), 'hello\nworld\n')
+
+  def testStreamPull(self):
+    self.assertEqual(list(self.backend.pull_image('ubuntu', stream=True)), ['hello\n', 'world\n'])
+
+  def testConcurrent(self):
+    # Every request is in flight at once on the single loop thread
+    start = time.time()
+    futures = [self.backend.inspect_container_async('slow') for i in range(50)]
+    self.assertEqual(len(self.backend.gather(futures)), 50)
+    self.assertLess(time.time() - start, 2)
+
+  def testChain(self):
+    future = self.backend.run_container_async('abc123', {'command': 'true'})
+    self.assertEqual(future.result(), 'container1')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+import unittest, sys, os, tempfile, shutil
+sys.path.append('.')
+from maestro import cache
+
+class TestCache(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.environ['MAESTRO_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+    self.filename = os.path.join(self.dir, 'maestro.yml')
+    self._write("""
+templates:
+  web:
+    base_image: ubuntu
+    require:
+      db:
+        port: '5432'
+  db:
+    base_image: ubuntu
+""")
+
+  def tearDown(self):
+    del os.environ['MAESTRO_CACHE_DIR']
+    shutil.rmtree(self.dir)
+
+  def testLoadPlan(self):
+    config, start_order, levels = cache.loadPlan(self.filename)
+    self.assertEqual(start_order, ['db', 'web'])
+    self.assertEqual(levels, [['db'], ['web']])
+    self.assertEqual(len(os.listdir(os.environ['MAESTRO_CACHE_DIR'])), 1)
+
+    # The second load comes from the cache
+    self.assertEqual(cache.loadPlan(self.filename), (config, start_order, levels))
+
+  def testCacheDir(self):
+    # Outside of ~/.maestro so it can't be taken for an environment
+    del os.environ['MAESTRO_CACHE_DIR']
+    os.environ['XDG_CACHE_HOME'] = self.dir
+    try:
+      self.assertEqual(cache.cacheDir(), os.path.join(self.dir, 'maestro'))
+      self.assertTrue(os.path.isdir(os.path.join(self.dir, 'maestro')))
+    finally:
+      del os.environ['XDG_CACHE_HOME']
+      os.environ['MAESTRO_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+
+  def testInvalidate(self):
+    cache.loadPlan(self.filename)
+    self._write("""
+templates:
+  db:
+    base_image: ubuntu
+    require:
+      web:
+        port: '80'
+  web:
+    base_image: ubuntu
+""")
+
+    config, start_order, levels = cache.loadPlan(self.filename)
+    self.assertEqual(start_order, ['web', 'db'])
+    self.assertEqual(len(os.listdir(os.environ['MAESTRO_CACHE_DIR'])), 1)
+
+  def testBuildCache(self):
+    key = cache.buildKey('service.web:0.1', 'FROM ubuntu', 'abc123')
+    self.assertNotEqual(key, cache.buildKey('service.web:0.1', 'FROM ubuntu', 'def456'))
+
+    builds = cache.BuildCache(os.path.join(self.dir, 'builds.json'))
+    self.assertEqual(builds.get(key), None)
+    builds.put(key, 'image1')
+
+    # Entries are shared through the file
+    self.assertEqual(cache.BuildCache(builds.filename).get(key), 'image1')
+
+  def _write(self, data):
+    with open(self.filename, 'w') as output_file:
+      output_file.write(data)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,120 @@
+import unittest, sys, os, time, tempfile, shutil
+sys.path.append('.')
+from maestro import cleanup
+
+class FakeBackend:
+  def __init__(self):
+    self.listing = [
+      {'Id': 'aaaaaaaaaaaa1111', 'Repository': 'service.web', 'Tag': '0.1', 'Size': 100},
+      {'Id': 'aaaaaaaaaaaa1111', 'Repository': 'service.web', 'Tag': 'latest', 'Size': 100},
+      {'Id': 'bbbbbbbbbbbb2222', 'Repository': '<none>', 'Tag': '<none>', 'Size': 200},
+      {'Id': 'cccccccccccc3333', 'Repository': '<none>', 'Tag': '<none>', 'Size': 300},
+      {'Id': 'dddddddddddd4444', 'Repository': 'service.db', 'Tag': '0.1', 'Size': 400},
+      {'Id': 'eeeeeeeeeeee5555', 'Repository': 'ubuntu', 'Tag': 'latest', 'Size': 500}
+    ]
+    self.details = {
+      'aaaaaaaaaaaa': {'parent': 'eeeeeeeeeeee5555', 'author': 'service.web:0.1'},
+      # An older build of web that lost its tags and a commit of a container running it
+      'bbbbbbbbbbbb': {'parent': 'eeeeeeeeeeee5555', 'author': 'service.web:0.1'},
+      'cccccccccccc': {'parent': 'bbbbbbbbbbbb2222', 'author': ''},
+      'dddddddddddd': {'parent': 'eeeeeeeeeeee5555', 'author': 'service.db:0.1'},
+      'eeeeeeeeeeee': {'parent': '', 'author': ''}
+    }
+    self.containers = [
+      {'Id': '111111111111aaaa', 'Image': 'service.web:0.1', 'Status': 'Up 2 hours'},
+      {'Id': '222222222222bbbb', 'Image': 'cccccccccccc', 'Status': 'Exit 0'},
+      {'Id': '333333333333cccc', 'Image': 'service.db:0.1', 'Status': 'Exit 0'},
+      {'Id': '444444444444dddd', 'Image': 'ubuntu:latest', 'Status': 'Exit 0'}
+    ]
+    self.removed = []
+
+  def images(self, name=None):
+    return self.listing
+
+  def inspect_image(self, image_id):
+    return self.details[image_id[:12]]
+
+  def list_containers(self):
+    return self.containers
+
+  def remove_container(self, container_id):
+    self.removed.append(container_id)
+
+  def remove_image(self, image):
+    self.removed.append(image)
+
+class TestCleanup(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.environment = os.path.join(self.dir, 'environment.yml')
+    with open(self.environment, 'w') as output_file:
+      output_file.write("""
+state: live
+templates:
+  db:
+    image_id: dddddddddddd
+containers:
+  db:
+    template: db
+    image_id: dddddddddddd
+    container_id: 333333333333cccc
+""")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testDryRun(self):
+    backend = FakeBackend()
+    report = cleanup.collect([self.environment], dry_run=True, backend=backend)
+
+    self.assertEqual([container['id'] for container in report['containers']], ['222222222222'])
+    self.assertEqual([image['id'] for image in report['images']], ['bbbbbbbbbbbb', 'cccccccccccc'])
+    self.assertEqual(report['reclaimed'], 500)
+    self.assertEqual([container['id'] for container in report['skipped']], ['111111111111'])
+    self.assertEqual(backend.removed, [])
+
+  def testCollect(self):
+    backend = FakeBackend()
+    report = cleanup.collect([self.environment], backend=backend)
+
+    # The container goes before its image and the commit before the image it was committed from
+    self.assertEqual(backend.removed, ['222222222222', 'cccccccccccc', 'bbbbbbbbbbbb'])
+    self.assertEqual(report['reclaimed'], 500)
+
+  def testDestroyedEnvironment(self):
+    with open(self.environment, 'w') as output_file:
+      output_file.write("state: destroyed\ntemplates: {}\ncontainers: {}\n")
+
+    report = cleanup.collect([self.environment], dry_run=True, backend=FakeBackend())
+    self.assertEqual(sorted(container['id'] for container in report['containers']), ['222222222222', '333333333333'])
+    self.assertEqual(report['reclaimed'], 900)
+
+  def testUntracked(self):
+    # Everything from before environments were recorded stays
+    backend = FakeBackend()
+    for entry in backend.listing + backend.containers:
+      entry['Created'] = 1000
+    backend.containers[1]['Created'] = 3000
+    report = cleanup.collect([self.environment], dry_run=True, backend=backend, since=2000)
+
+    self.assertEqual([container['id'] for container in report['containers']], ['222222222222'])
+    self.assertEqual(report['images'], [])
+    self.assertEqual([container['id'] for container in report['skipped']], ['111111111111'])
+
+  def testRegistry(self):
+    os.environ['MAESTRO_REGISTRY'] = os.path.join(self.dir, 'registry', 'environments.json')
+    try:
+      elsewhere = os.path.join(self.dir, 'project', '.maestro', 'environment.yml')
+      os.makedirs(os.path.dirname(elsewhere))
+      shutil.copy(self.environment, elsewhere)
+      self.assertNotIn(elsewhere, cleanup.environments())
+
+      cleanup.register(elsewhere)
+      cleanup.register(elsewhere)
+      self.assertEqual(cleanup.environments().count(elsewhere), 1)
+      self.assertLessEqual(cleanup.trackedSince(), time.time())
+    finally:
+      del os.environ['MAESTRO_REGISTRY']
+
+if __name__ == '__main__':
+  unittest.main()
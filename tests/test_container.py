@@ -10,6 +10,40 @@ class TestContainer(unittest.TestCase):
   #  with self.assertRaises(exceptions.ContainerError) as e:
   #      container.Container('test_container', { 'image_id': utils.findImage('ubuntu') }, {})
     pass
+  def testRecreateRunning(self):
+    class Backend:
+      def __init__(self):
+        self.running = set(['old'])
+        self.calls = []
+
+      def inspect_container(self, container_id):
+        return {'Volumes': {'/data': '/var/lib/docker/vfs/dir/abc'}}
+
+      def stop_container(self, container_id, timeout=10):
+        self.calls.append(('stop', container_id))
+        self.running.discard(container_id)
+
+      def create_container(self, image_id, config):
+        return 'new'
+
+      def start_container(self, container_id, mounts=None):
+        self.calls.append(('start', container_id, mounts))
+        self.running.add(container_id)
+
+      def remove_container(self, container_id, timeout=None):
+        # Like the daemon, running containers can't be removed
+        if container_id in self.running:
+          raise HTTPError('500 Server Error: Internal Server Error')
+        self.calls.append(('remove', container_id))
+
+    c = container.Container('web', {'container_id': 'old', 'image_id': 'image'}, {'command': 'web'})
+    c.backend = Backend()
+    c.recreate('image')
+
+    self.assertEqual(c.state['container_id'], 'new')
+    self.assertEqual(c.backend.calls, [('stop', 'old'), ('start', 'new', {'/var/lib/docker/vfs/dir/abc': '/data'}),
+      ('remove', 'old')])
+
   def testGetIpAddress(self):
     # TODO: image_id will change
     c = container.Container('test_container', { 'image_id': utils.findImage('ubuntu') }, {'command': 'ps aux'})
@@ -0,0 +1,72 @@
+import unittest, sys, os, threading, time, tempfile, shutil
+sys.path.append('.')
+from maestro import images, exceptions
+from requests.exceptions import HTTPError
+
+class FakeBackend:
+  def __init__(self, available=None):
+    self.available = set(available or [])
+    self.pulls = []
+
+  def inspect_image(self, name):
+    if name not in self.available:
+      raise HTTPError('404 Client Error: Not Found')
+    return {'id': 'id-' + name}
+
+  def pull_image(self, name, stream=False):
+    time.sleep(0.1)
+    self.pulls.append(name)
+    if name == 'missing':
+      return ['{"status": "Pulling repository missing"}\r\n', '{"error": "not found"}\r\n']
+    self.available.add(name)
+    return ['{"status": "Pulling repository %s"}\r\n' % name, '{"status": "Downloading", "progress": "[=>  ]"}\r\n']
+
+class TestImages(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.environ['MAESTRO_LOG_DIR'] = self.dir
+
+  def tearDown(self):
+    del os.environ['MAESTRO_LOG_DIR']
+    shutil.rmtree(self.dir)
+
+  def testSingleFlight(self):
+    backend = FakeBackend()
+    resolver = images.Resolver(backend)
+    threads = [threading.Thread(target=resolver.resolve, args=('ubuntu',)) for i in range(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(backend.pulls, ['ubuntu'])
+    self.assertEqual(resolver.resolve('ubuntu'), 'id-ubuntu')
+
+  def testPresent(self):
+    backend = FakeBackend(['ubuntu'])
+    self.assertEqual(images.Resolver(backend).resolve('ubuntu'), 'id-ubuntu')
+    self.assertEqual(backend.pulls, [])
+
+  def testPullFailure(self):
+    backend = FakeBackend()
+    resolver = images.Resolver(backend)
+    with self.assertRaises(exceptions.TemplateError):
+      resolver.resolve('missing')
+
+    # The failure stands for the rest of the run
+    with self.assertRaises(exceptions.TemplateError):
+      resolver.resolve('missing')
+    self.assertEqual(backend.pulls, ['missing'])
+
+  def testPullLog(self):
+    images.Resolver(FakeBackend()).resolve('ubuntu')
+    with open(os.path.join(self.dir, 'pull-ubuntu.log')) as log_file:
+      self.assertEqual(log_file.read(), 'Pulling repository ubuntu\nDownloading [=>  ]\n')
+
+  def testBaseImage(self):
+    self.assertEqual(images.baseImage({'base_image': 'ubuntu'}), 'ubuntu')
+    self.assertEqual(images.baseImage({'buildspec': {'dockerfile': 'from ubuntu:12.04\nRUN true'}}), 'ubuntu:12.04')
+    self.assertEqual(images.baseImage({'buildspec': {'url': 'github.com/toscanini/docker-mongodb'}}), None)
+
+if __name__ == '__main__':
+  unittest.main()
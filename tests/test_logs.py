@@ -0,0 +1,67 @@
+import unittest, sys, threading, StringIO, struct
+sys.path.append('.')
+from maestro import logs
+
+class TestLogs(unittest.TestCase):
+  def testPrefix(self):
+    output = StringIO.StringIO()
+    logs.Multiplexer([('web', lambda: ['hello\nwor', 'ld\r\n']), ('db.1', lambda: ['ready'])], output).run()
+    self.assertEqual(sorted(output.getvalue().splitlines()), ['db.1 | ready', 'web  | hello', 'web  | world'])
+
+  def testDemux(self):
+    framed = ''.join(struct.pack('>BxxxL', stream, len(data)) + data for stream, data in
+      [(1, 'hello\n'), (2, 'oops\n'), (1, ''), (1, 'world\n')])
+    # Frames can be split anywhere
+    chunks = [framed[i:i + 5] for i in range(0, len(framed), 5)]
+    self.assertEqual(list(logs.demux(chunks)), ['hello\n', 'oops\n', 'world\n'])
+
+    # Containers with a tty send their output as it is
+    self.assertEqual(''.join(logs.demux(['hel', 'lo\nworld\n'])), 'hello\nworld\n')
+    self.assertEqual(list(logs.demux(['hi'])), ['hi'])
+
+  def testError(self):
+    def broken():
+      yield 'starting\n'
+      raise IOError('connection reset')
+
+    output = StringIO.StringIO()
+    logs.Multiplexer([('web', broken)], output).run()
+    self.assertEqual(output.getvalue(), 'web | starting\nweb | Unable to read the output: connection reset\n')
+
+  def testNoisyNeighbour(self):
+    # The noisy container is never more than its buffer ahead and can't crowd out the quiet one
+    read = []
+    def noisy():
+      for i in range(5000):
+        read.append(i)
+        yield 'noise %d\n' % i
+
+    quiet_ready = threading.Event()
+    def quiet():
+      quiet_ready.wait()
+      return ['one\ntwo\n']
+
+    class Output:
+      def __init__(self):
+        self.lines = []
+        self.ahead = 0
+
+      def write(self, line):
+        self.lines.append(line)
+        self.ahead = max(self.ahead, len(read) - len(self.lines))
+        if len(self.lines) == 100:
+          quiet_ready.set()
+
+      def flush(self):
+        pass
+
+    output = Output()
+    logs.Multiplexer([('noisy', noisy), ('quiet', quiet)], output, buffer_lines=10).run()
+
+    self.assertEqual(len(output.lines), 5002)
+    self.assertLessEqual(output.ahead, 12)
+    quiet_lines = [index for index, line in enumerate(output.lines) if line.startswith('quiet')]
+    self.assertLess(quiet_lines[-1], 200)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+import unittest, sys, os, tempfile, shutil, time
+sys.path.append('.')
+from maestro import metrics
+
+class Backend:
+  @metrics.timed()
+  def inspect_image(self, image_id):
+    if image_id == 'missing':
+      raise KeyError(image_id)
+    return {'id': image_id}
+
+  @metrics.timed(streams=True)
+  def pull_image(self, name, stream=False):
+    def output():
+      time.sleep(0.3)
+      yield 'Pulling %s\n' % name
+      if name == 'missing':
+        raise KeyError(name)
+    return output()
+
+class TestMetrics(unittest.TestCase):
+  def setUp(self):
+    metrics.reset()
+
+  def testRender(self):
+    backend = Backend()
+    backend.inspect_image('ubuntu')
+    with self.assertRaises(KeyError):
+      backend.inspect_image('missing')
+    metrics.observe('build_image', 12)
+
+    text = metrics.render()
+    self.assertIn('maestro_docker_calls_total{method="inspect_image"} 2\n', text)
+    self.assertIn('maestro_docker_errors_total{method="inspect_image"} 1\n', text)
+    self.assertIn('maestro_docker_call_seconds_bucket{method="inspect_image",le="0.005"} 2\n', text)
+    self.assertIn('maestro_docker_call_seconds_bucket{method="build_image",le="10"} 0\n', text)
+    self.assertIn('maestro_docker_call_seconds_bucket{method="build_image",le="30"} 1\n', text)
+    self.assertIn('maestro_docker_call_seconds_bucket{method="build_image",le="+Inf"} 1\n', text)
+    self.assertIn('maestro_docker_call_seconds_count{method="build_image"} 1\n', text)
+
+  def testStream(self):
+    backend = Backend()
+    stream = backend.pull_image('ubuntu', stream=True)
+    # Nothing is recorded until the stream has been read to the end
+    self.assertNotIn('pull_image', metrics.render())
+    self.assertEqual(list(stream), ['Pulling ubuntu\n'])
+    with self.assertRaises(KeyError):
+      list(backend.pull_image('missing', stream=True))
+
+    text = metrics.render()
+    self.assertIn('maestro_docker_calls_total{method="pull_image"} 2\n', text)
+    self.assertIn('maestro_docker_errors_total{method="pull_image"} 1\n', text)
+    self.assertIn('maestro_docker_call_seconds_bucket{method="pull_image",le="0.25"} 0\n', text)
+
+  def testWrite(self):
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, 'maestro.prom')
+      metrics.observe('start_container', 0.2)
+      metrics.write(filename)
+      with open(filename) as input_file:
+        self.assertEqual(input_file.read(), metrics.render())
+      self.assertEqual(os.listdir(directory), ['maestro.prom'])
+    finally:
+      shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  unittest.main()
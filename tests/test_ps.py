@@ -0,0 +1,86 @@
+import unittest, sys, os, json, tempfile, shutil, yaml
+sys.path.append('.')
+from maestro import service, utils, py_backend
+from requests.exceptions import HTTPError
+
+utils.setQuiet(True)
+
+TEMPLATES = {
+  'db': {'base_image': 'ubuntu', 'config': {'command': 'db'}},
+  'web': {'base_image': 'ubuntu', 'count': 2, 'config': {'command': 'web'}, 'require': {'db': {'port': '5432'}}},
+  'proxy': {'base_image': 'ubuntu', 'config': {'command': 'proxy'}, 'require': {'web': {'port': '80'}}},
+  'cron': {'base_image': 'ubuntu', 'config': {'command': 'cron'}}
+}
+
+def fullId(name):
+  return ('id-' + name).ljust(64, '0')
+
+class Backend:
+  def __init__(self):
+    self.lists = 0
+    self.inspected = []
+
+  def list_containers(self):
+    self.lists += 1
+    return [
+      # Older daemons list ports as a string, newer ones as mappings and some not at all
+      {'Id': fullId('db'), 'Command': 'db', 'Status': 'Up 5 minutes', 'Ports': '49153->5432'},
+      {'Id': fullId('web__1'), 'Command': 'web', 'Status': 'Up 5 minutes', 'Ports': [
+        {'PublicPort': 49154, 'PrivatePort': 80, 'Type': 'tcp'}, {'PrivatePort': 81, 'Type': 'tcp'},
+        {'PublicPort': 49155, 'PrivatePort': 53, 'Type': 'udp'}]},
+      {'Id': fullId('web__2'), 'Command': 'web', 'Status': 'Exit 0', 'Ports': None},
+      {'Id': fullId('cron'), 'Command': 'cron', 'Status': 'Up 1 second', 'Ports': None}
+    ]
+
+  def inspect_container(self, container_id):
+    self.inspected.append(container_id)
+    if container_id == fullId('cron'):
+      # Gone between the list and the inspect
+      raise HTTPError('404 Client Error: Not Found')
+    return {'NetworkSettings': {'PortMapping': {'Tcp': {'80': '49156'}}}}
+
+class TestPs(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.environ['MAESTRO_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+
+    containers = {}
+    for name in ['db', 'web__1', 'web__2', 'proxy', 'cron']:
+      containers[name] = {'template': name.split('__')[0], 'container_id': fullId(name), 'image_id': 'image'}
+    environment = os.path.join(self.dir, 'environment.yml')
+    with open(environment, 'w') as output_file:
+      output_file.write(yaml.dump({'state': 'live', 'templates': TEMPLATES, 'containers': containers}))
+
+    self.mix = service.Service(environment=environment)
+    self.backend = py_backend._shared = Backend()
+
+  def tearDown(self):
+    py_backend._shared = None
+    del os.environ['MAESTRO_CACHE_DIR']
+    shutil.rmtree(self.dir)
+
+  def testJson(self):
+    rows = dict((row['name'], row) for row in json.loads(self.mix.ps(format='json')))
+    self.assertEqual(self.backend.lists, 1)
+    # Only the listed containers without ports get inspected
+    self.assertEqual(sorted(self.backend.inspected), [fullId('cron'), fullId('web__2')])
+
+    self.assertEqual(rows['db'], {'id': fullId('db'), 'name': 'db', 'template': 'db', 'command': 'db', 'status': 'Running',
+      'ports': '49153->5432'})
+    self.assertEqual(rows['web__1']['ports'], '49154->80')
+    self.assertEqual((rows['web__2']['status'], rows['web__2']['ports']), ('Stopped', '49156->80'))
+    self.assertEqual((rows['proxy']['status'], rows['proxy']['ports']), ('Destroyed', ''))
+    self.assertEqual((rows['cron']['status'], rows['cron']['ports']), ('Destroyed', ''))
+
+  def testFilters(self):
+    rows = json.loads(self.mix.ps(format='json', templates=['web', 'db'], status='running'))
+    self.assertEqual([row['name'] for row in rows], ['db', 'web__1'])
+    self.assertEqual(self.backend.inspected, [fullId('web__2')])
+
+    table = self.mix.ps(templates=['web'], status='stopped').splitlines()
+    self.assertEqual(len(table), 2)
+    self.assertTrue(table[1].startswith(fullId('web__2')))
+    self.assertEqual(table[1].split()[-3:], ['web', 'Stopped', '49156->80'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,4 +1,4 @@
-import unittest, sys, StringIO
+import unittest, sys, StringIO, Queue
 sys.path.append('.')
 from maestro import py_backend, exceptions, utils
 from requests.exceptions import HTTPError
@@ -52,5 +52,73 @@ class TestContainer(unittest.TestCase):
     
     self.assertIsNotNone(p.get_ip_address(c))
     
+  def testShared(self):
+    backend = py_backend.shared()
+    self.assertIs(backend, py_backend.shared())
+
+    # Changing the settings starts a fresh backend
+    py_backend.configure(pool_size=4)
+    self.assertIsNot(backend, py_backend.shared())
+
+  def testEventMonitor(self):
+    class EventClient:
+      def __init__(self):
+        self.stream = Queue.Queue()
+
+      def containers(self, all=False):
+        return [{'Id': 'aaaaaaaaaaaaaaaa', 'Status': 'Up 5 minutes'}, {'Id': 'bbbbbbbbbbbbbbbb', 'Status': 'Exit 0'}]
+
+      def events(self):
+        while True:
+          event = self.stream.get()
+          if not event:
+            raise StopIteration
+          yield event
+
+    client = EventClient()
+    monitor = py_backend.EventMonitor(client)
+    monitor.start()
+    
+    self.assertEqual(monitor.state('aaaaaaaaaaaa'), 'running')
+    self.assertEqual(monitor.state('bbbbbbbbbbbbbbbb'), 'exited')
+    self.assertIsNone(monitor.state('cccccccccccc'))
+
+    # Only news that arrives after the mark counts
+    mark = monitor.mark()
+    self.assertFalse(monitor.exited_since('bbbbbbbbbbbb', mark))
+    client.stream.put({'status': 'die', 'id': 'aaaaaaaaaaaaaaaa'})
+    client.stream.put({'status': 'start', 'id': 'cccccccccccccccc'})
+    client.stream.put(None)
+    while monitor.alive:
+      monitor.wait(0.1)
+
+    self.assertEqual(monitor.state('aaaaaaaaaaaa'), 'exited')
+    self.assertEqual(monitor.state('cccccccccccc'), 'running')
+    self.assertTrue(monitor.exited_since('aaaaaaaaaaaa', mark))
+    self.assertFalse(monitor.exited_since('cccccccccccc', mark))
+    self.assertFalse(monitor.exited_since('aaaaaaaaaaaa', monitor.mark()))
+
+  def testCrashed(self):
+    class EventClient:
+      def containers(self, all=False):
+        return []
+
+      def events(self):
+        for event in [('start', 'dddd'), ('die', 'dddd'), ('start', 'eeee'), ('die', 'ffff'), ('start', 'ffff')]:
+          yield {'status': event[0], 'id': event[1] * 4}
+
+    monitor = py_backend.EventMonitor(EventClient())
+    monitor.start()
+    while monitor.alive:
+      monitor.wait(0.1)
+
+    # A crash that came through before anyone started waiting still counts
+    self.assertTrue(monitor.crashed('dddddddddddd'))
+    self.assertFalse(monitor.crashed('eeeeeeeeeeee'))
+    self.assertFalse(monitor.crashed('ffffffffffff'))
+    self.assertFalse(monitor.crashed('gggggggggggg'))
+    # Unless it was the stop the caller made itself
+    self.assertFalse(monitor.crashed('dddddddddddd', monitor.mark()))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,57 @@
+import unittest, sys, os, time, socket, tempfile, shutil, yaml
+sys.path.append('.')
+from maestro import service, utils, py_backend
+
+utils.setQuiet(True)
+
+class EventClient:
+  # The dependency crashed right after it was started, before anyone waited on it
+  def containers(self, all=False):
+    return []
+
+  def events(self):
+    yield {'status': 'start', 'id': 'id-db'}
+    yield {'status': 'die', 'id': 'id-db'}
+
+class Instance:
+  state = {'container_id': 'id-db'}
+
+  def get_ip_address(self):
+    return '127.0.0.1'
+
+class TestRequire(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.environ['MAESTRO_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+    environment = os.path.join(self.dir, 'environment.yml')
+    with open(environment, 'w') as output_file:
+      output_file.write(yaml.dump({'state': 'live', 'containers': {}, 'templates': {
+        'db': {'base_image': 'ubuntu', 'config': {'command': 'db'}},
+        'web': {'base_image': 'ubuntu', 'config': {'command': 'web'}, 'require': {'db': {'port': '5432'}}}}}))
+    self.mix = service.Service(environment=environment)
+
+  def tearDown(self):
+    del os.environ['MAESTRO_CACHE_DIR']
+    shutil.rmtree(self.dir)
+
+  def testCrashedBeforePolling(self):
+    monitor = py_backend.EventMonitor(EventClient())
+    monitor.start()
+    while monitor.alive:
+      monitor.wait(0.1)
+
+    # Nothing listens on the port so only the die event can end the wait early
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+
+    self.mix.containers['db']['db'] = Instance()
+    self.mix._monitor = lambda: monitor
+    start = time.time()
+    with self.assertRaises(service.ContainerError):
+      self.mix._pollService('web', 'db', 'db', port, 60)
+    self.assertLess(time.time() - start, 5)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,83 @@
+import unittest, sys, threading, time
+sys.path.append('.')
+from maestro import scheduler, exceptions
+
+class TestScheduler(unittest.TestCase):
+  def testRequireOrder(self):
+    finished = []
+    s = scheduler.Scheduler()
+    s.add('c', lambda: finished.append('c'), ['b'])
+    s.add('b', lambda: finished.append('b'), ['a'])
+    s.add('a', lambda: finished.append('a'))
+    s.run()
+
+    self.assertEqual(finished, ['a', 'b', 'c'])
+
+  def testConcurrent(self):
+    def task():
+      start = time.time()
+      time.sleep(0.1)
+      return start, time.time()
+
+    s = scheduler.Scheduler({'build': 2})
+    s.add('a', task, pool='build')
+    s.add('b', task, pool='build')
+    results = s.run()
+
+    # The two runs should overlap
+    self.assertLess(results['a'][0], results['b'][1])
+    self.assertLess(results['b'][0], results['a'][1])
+
+  def testLimit(self):
+    lock = threading.Lock()
+    state = {'running': 0, 'peak': 0}
+    def task():
+      with lock:
+        state['running'] += 1
+        state['peak'] = max(state['peak'], state['running'])
+      time.sleep(0.05)
+      with lock:
+        state['running'] -= 1
+
+    s = scheduler.Scheduler({'build': 2})
+    for i in range(6):
+      s.add(i, task, pool='build')
+    s.run()
+
+    self.assertEqual(state['peak'], 2)
+
+  def testFailure(self):
+    started = []
+    def fail():
+      raise exceptions.TemplateError('broken')
+
+    s = scheduler.Scheduler()
+    s.add('a', fail)
+    s.add('b', lambda: started.append('b'), ['a'])
+
+    with self.assertRaises(exceptions.TemplateError):
+      s.run()
+    self.assertEqual(started, [])
+
+  def testCycle(self):
+    s = scheduler.Scheduler()
+    s.add('a', lambda: None, ['b'])
+    s.add('b', lambda: None, ['a'])
+
+    with self.assertRaises(exceptions.MaestroError):
+      s.run()
+
+  def testCriticalPath(self):
+    s = scheduler.Scheduler()
+    s.add('slow', lambda: time.sleep(0.2))
+    s.add('fast', lambda: None)
+    s.add('last', lambda: None, ['slow', 'fast'])
+    s.run()
+
+    self.assertEqual([key for key, start, end in s.critical_path()], ['slow', 'last'])
+
+  def testParallel(self):
+    self.assertEqual(scheduler.parallel(lambda x: x * 2, [3, 1, 2], 2), [6, 2, 4])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,34 @@
+import unittest, sys, os, subprocess
+
+# Modules that are slow to import and should only be loaded once a command actually talks to the
+# daemon or reads an environment
+HEAVY = ['docker', 'requests', 'yaml', 'sqlite3']
+
+SUBCOMMANDS = ['build', 'apply', 'scale', 'start', 'stop', 'restart', 'destroy', 'run', 'ps', 'logs', 'convert', 'gc']
+
+SCRIPT = """
+import sys, os, time
+start = time.time()
+from maestro import cli
+imported = time.time() - start
+
+sys.stdout = open(os.devnull, 'w')
+cli.MaestroCli().main(['maestro', 'help', sys.argv[1]])
+sys.stdout = sys.__stdout__
+
+print imported, time.time() - start, ','.join(name for name in %r if name in sys.modules)
+""" % HEAVY
+
+class TestStartup(unittest.TestCase):
+  def testSubcommandStartup(self):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    for subcmd in SUBCOMMANDS:
+      output = subprocess.check_output([sys.executable, '-c', SCRIPT, subcmd], cwd=root).split()
+      imported, total = float(output[0]), float(output[1])
+      sys.stderr.write('\n%-10s import %6.1f ms  total %6.1f ms' % (subcmd, imported * 1000, total * 1000))
+
+      # Timings depend on the machine so only what got imported is checked
+      self.assertEqual(output[2:], [], '%s imported %s' % (subcmd, ' '.join(output[2:])))
+
+if __name__ == '__main__':
+  unittest.main()
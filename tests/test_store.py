@@ -0,0 +1,103 @@
+import unittest, sys, os, tempfile, shutil, yaml
+sys.path.append('.')
+from maestro import store, service, utils
+
+utils.setQuiet(True)
+
+class TestStore(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.templates = {
+      'db': {'base_image': 'ubuntu', 'config': {'command': 'ps aux'}, 'image_id': '1234'},
+      'web': {'base_image': 'ubuntu', 'config': {'command': 'ls -l'}, 'image_id': '5678', 'require': {'db': {'port': '80'}}}
+    }
+    self.containers = {
+      'db': {'template': 'db', 'image_id': '1234', 'container_id': 'aaaa'},
+      'web__1': {'template': 'web', 'image_id': '5678', 'container_id': 'bbbb'},
+      'web__2': {'template': 'web', 'image_id': '5678', 'container_id': 'cccc'}
+    }
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testSaveLoad(self):
+    filename = os.path.join(self.dir, 'environment.db')
+    s = store.SqliteStore(filename)
+    s.save('live', self.templates, self.containers)
+    s.close()
+
+    s = store.SqliteStore(filename)
+    self.assertEqual(s.state(), 'live')
+    self.assertEqual(s.templates(), self.templates)
+    self.assertEqual(s.containers(), self.containers)
+    self.assertEqual(sorted(s.containers('web')), ['web__1', 'web__2'])
+    self.assertEqual(s.container('db'), self.containers['db'])
+    self.assertEqual(s.template_of('web__2'), 'web')
+    self.assertIsNone(s.template_of('missing'))
+
+  def testRowUpdates(self):
+    s = store.SqliteStore(os.path.join(self.dir, 'environment.db'))
+    s.save('live', self.templates, self.containers)
+
+    # Nothing changed so nothing gets written
+    changes = s.db.total_changes
+    s.save('live', self.templates, self.containers)
+    self.assertEqual(s.db.total_changes, changes)
+
+    self.containers['db']['container_id'] = 'dddd'
+    s.save('live', self.templates, self.containers, removed=['web__2'])
+    self.assertEqual(s.db.total_changes, changes + 2)
+    self.assertEqual(s.container('db')['container_id'], 'dddd')
+    self.assertIsNone(s.container('web__2'))
+
+  def testRemovedTemplate(self):
+    filename = os.path.join(self.dir, 'environment.db')
+    s = store.SqliteStore(filename)
+    s.save('live', self.templates, self.containers)
+    del self.templates['web']
+    s.save('live', self.templates, {'db': self.containers['db']}, removed=['web__1', 'web__2'])
+    s.close()
+
+    s = store.SqliteStore(filename)
+    self.assertEqual(s.templates(), self.templates)
+    self.assertEqual(s.index(), {'db': 'db'})
+
+  def testLazyLoad(self):
+    filename = os.path.join(self.dir, 'environment.db')
+    s = store.SqliteStore(filename)
+    s.save('live', self.templates, self.containers)
+    s.close()
+
+    # Only the container that's used gets read
+    env = service.Service(environment=filename)
+    self.assertEqual(env.get('web')['web__2'].state['container_id'], 'cccc')
+    self.assertEqual(env.store.rows['containers'].keys(), ['web__2'])
+
+    env.get('web')['web__2'].state['container_id'] = 'dddd'
+    del env.containers['db']
+    env.templates.pop('db')
+    del env.config['templates']['db']
+    env.save(filename)
+
+    s = store.SqliteStore(filename)
+    self.assertEqual(sorted(s.templates()), ['web'])
+    self.assertEqual(sorted(s.index()), ['web__1', 'web__2'])
+    self.assertEqual(s.container('web__1'), self.containers['web__1'])
+    self.assertEqual(s.container('web__2')['container_id'], 'dddd')
+
+  def testImportExport(self):
+    source = os.path.join(self.dir, 'environment.yml')
+    with open(source, 'w') as output_file:
+      output_file.write(yaml.dump({'state': 'live', 'templates': self.templates, 'containers': self.containers}))
+
+    store.importYaml(source, os.path.join(self.dir, 'environment.db'))
+    store.exportYaml(os.path.join(self.dir, 'environment.db'), os.path.join(self.dir, 'exported.yml'))
+
+    with open(os.path.join(self.dir, 'exported.yml')) as input_file:
+      env = yaml.load(input_file)
+
+    self.assertEqual(env['templates'], self.templates)
+    self.assertEqual(env['containers'], self.containers)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,135 @@
+import unittest, sys, os, tempfile, shutil, yaml
+sys.path.append('.')
+from maestro import service, utils, py_backend
+
+utils.setQuiet(True)
+
+TEMPLATES = {
+  'db': {'base_image': 'ubuntu', 'config': {'command': 'db'}},
+  'web': {'base_image': 'ubuntu', 'count': 2, 'config': {'command': 'web'}, 'require': {'db': {'port': '5432'}}},
+  'proxy': {'base_image': 'ubuntu', 'config': {'command': 'proxy'}, 'require': {'web': {'port': '80'}}}
+}
+
+class Clock:
+  # Stands in for the time module so stops can take as long as they like without the test waiting
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+class Done:
+  def then(self, func):
+    func(None)
+    return self
+
+class Instance:
+  # A container that uses all of its stop timeout
+  def __init__(self, name, clock, calls):
+    self.name = name
+    self.clock = clock
+    self.calls = calls
+
+  def stop(self, timeout=10):
+    self.calls.append(('stop', self.name, timeout))
+    self.clock.now += timeout
+
+  def kill(self):
+    self.calls.append(('kill', self.name))
+
+  def remove(self):
+    self.calls.append(('remove', self.name))
+
+  def stop_async(self, timeout=10):
+    self.calls.append(('stop', self.name, timeout))
+    return Done()
+
+  def kill_async(self):
+    self.kill()
+    return Done()
+
+  def remove_async(self):
+    self.remove()
+    return Done()
+
+class AsyncBackend:
+  # A wave is in flight at once so it takes as long as its slowest stop
+  def __init__(self, clock, calls):
+    self.clock = clock
+    self.calls = calls
+    self.waves = []
+
+  def create_container_async(self, image_id, config):
+    pass
+
+  def gather(self, futures):
+    self.waves.append(len(futures))
+    timeouts = [call[2] for call in self.calls if call[0] == 'stop']
+    self.clock.now += max(timeouts[-len(futures):] or [0])
+
+class TestTeardown(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.environ['MAESTRO_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+    os.environ['MAESTRO_REGISTRY'] = os.path.join(self.dir, 'environments.json')
+
+    containers = {}
+    for name in ['db', 'web__1', 'web__2', 'proxy']:
+      containers[name] = {'template': name.split('__')[0], 'container_id': 'id-' + name, 'image_id': 'image'}
+    environment = os.path.join(self.dir, 'environment.yml')
+    with open(environment, 'w') as output_file:
+      output_file.write(yaml.dump({'state': 'live', 'templates': TEMPLATES, 'containers': containers}))
+
+    self.mix = service.Service(environment=environment)
+    self.clock = Clock()
+    self.calls = []
+    for tmpl in self.mix.containers:
+      for name in list(self.mix.containers[tmpl]):
+        self.mix.containers[tmpl][name] = Instance(name, self.clock, self.calls)
+
+    self.time = service.time
+    service.time = self.clock
+    py_backend._shared = object()
+
+  def tearDown(self):
+    service.time = self.time
+    py_backend._shared = None
+    del os.environ['MAESTRO_CACHE_DIR']
+    del os.environ['MAESTRO_REGISTRY']
+    shutil.rmtree(self.dir)
+
+  def testWaves(self):
+    self.mix._teardown(timeout=3)
+    # Consumers go before what they require
+    self.assertEqual([call[1].split('__')[0] for call in self.calls], ['proxy', 'web', 'web', 'db'])
+    self.assertEqual(set(call[2] for call in self.calls), set([3]))
+
+  def testDeadline(self):
+    self.mix._teardown(deadline=22.5, stop_jobs=1)
+    # Stops are cut short to what's left of the deadline and once less than a second is left it's kill
+    self.assertEqual(self.calls, [('stop', 'proxy', 10), ('stop', 'web__1', 10), ('stop', 'web__2', 2), ('kill', 'db')])
+    self.assertLessEqual(self.clock.now, 1000 + 22.5)
+
+  def testRemove(self):
+    self.mix._teardown(deadline=20.5, stop_jobs=1, remove=True)
+    self.assertEqual(self.calls, [('stop', 'proxy', 10), ('remove', 'proxy'), ('stop', 'web__1', 10),
+      ('remove', 'web__1'), ('kill', 'web__2'), ('remove', 'web__2'), ('kill', 'db'), ('remove', 'db')])
+
+  def testAsync(self):
+    backend = py_backend._shared = AsyncBackend(self.clock, self.calls)
+    self.mix._teardown(deadline=22.5, remove=True)
+    self.assertEqual(backend.waves, [1, 2, 1])
+    self.assertEqual(self.calls, [('stop', 'proxy', 10), ('remove', 'proxy'), ('stop', 'web__1', 10),
+      ('remove', 'web__1'), ('stop', 'web__2', 10), ('remove', 'web__2'), ('stop', 'db', 2), ('remove', 'db')])
+    self.assertLessEqual(self.clock.now, 1000 + 22.5)
+
+    del self.calls[:]
+    self.clock.now = 1000.0
+    self.mix._teardown(deadline=20.5)
+    self.assertEqual(self.calls, [('stop', 'proxy', 10), ('stop', 'web__1', 10), ('stop', 'web__2', 10), ('kill', 'db')])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+import unittest, sys, os, json, tempfile, shutil, threading
+sys.path.append('.')
+from maestro import tracing
+
+class Backend:
+  @tracing.traced()
+  def start_container(self, container_id):
+    return container_id
+
+  @tracing.traced(streams=True)
+  def pull_image(self, name, stream=False):
+    return (line for line in ['Pulling %s\n' % name])
+
+class TestTracing(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, 'trace.json')
+    tracing.enable()
+
+  def tearDown(self):
+    tracing.disable()
+    shutil.rmtree(self.dir)
+
+  def testSpans(self):
+    with tracing.span('build template', template='web'):
+      self.assertEqual(Backend().start_container('abc123'), 'abc123')
+
+    token = tracing.begin('POST /containers/create', 'docker')
+    thread = threading.Thread(target=tracing.end, args=(token,))
+    thread.start()
+    thread.join()
+
+    tracing.write(self.filename)
+    with open(self.filename) as input_file:
+      events = json.load(input_file)['traceEvents']
+
+    spans = dict((event['name'], event) for event in events if event['ph'] == 'X')
+    self.assertEqual(spans['build template']['args'], {'template': 'web'})
+    self.assertEqual(spans['start_container']['args'], {'target': 'abc123'})
+    self.assertEqual(spans['start_container']['cat'], 'docker')
+    # The inner span sits inside the outer one
+    self.assertGreaterEqual(spans['start_container']['ts'], spans['build template']['ts'])
+
+    self.assertEqual(sorted(event['ph'] for event in events if event['name'] == 'POST /containers/create'), ['b', 'e'])
+    self.assertIn('thread_name', [event['name'] for event in events])
+
+  def testStream(self):
+    stream = Backend().pull_image('ubuntu', stream=True)
+    self.assertEqual([event['ph'] for event in tracing._events if event['name'] == 'pull_image'], ['b'])
+    self.assertEqual(list(stream), ['Pulling ubuntu\n'])
+    self.assertEqual([event['ph'] for event in tracing._events if event['name'] == 'pull_image'], ['b', 'e'])
+
+  def testDisabled(self):
+    tracing.disable()
+    with tracing.span('build template'):
+      pass
+    self.assertFalse(tracing.enabled())
+    self.assertEqual(tracing.begin('ignored'), None)
+
+if __name__ == '__main__':
+  unittest.main()
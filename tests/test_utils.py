@@ -0,0 +1,156 @@
+import unittest, sys, os, socket, threading, tempfile, shutil, BaseHTTPServer
+sys.path.append('.')
+from maestro import utils, exceptions
+
+class TestUtils(unittest.TestCase):
+  def testOrder(self):
+    templates = {
+      'web': {'require': {'db': {'port': '5432'}, 'cache': {'port': '6379'}}},
+      'db': {},
+      'cache': {'require': {'db': {'port': '5432'}}},
+      'proxy': {'require': {'web': {'port': '80'}}}
+    }
+
+    self.assertEqual(utils.order(templates), ['db', 'cache', 'web', 'proxy'])
+    self.assertEqual(utils.levels(templates), [['db'], ['cache'], ['web'], ['proxy']])
+
+  def testLevels(self):
+    templates = {
+      'db': {},
+      'web_1': {'require': {'db': {'port': '5432'}}},
+      'web_2': {'require': {'db': {'port': '5432'}}}
+    }
+
+    ordered, levels = utils.plan(templates)
+    self.assertEqual(ordered[0], 'db')
+    self.assertEqual(levels[0], ['db'])
+    self.assertEqual(sorted(levels[1]), ['web_1', 'web_2'])
+
+  def testCycle(self):
+    templates = {
+      'a': {'require': {'b': {}}},
+      'b': {'require': {'c': {}}},
+      'c': {'require': {'a': {}}},
+      'd': {'require': {'a': {}}}
+    }
+
+    with self.assertRaises(exceptions.DependencyError) as e:
+      utils.order(templates)
+
+    cycle = str(e.exception).split(': ')[1].split(' -> ')
+    self.assertEqual(cycle[0], cycle[-1])
+    self.assertEqual(sorted(cycle[:-1]), ['a', 'b', 'c'])
+
+  def testUnknownRequire(self):
+    with self.assertRaises(exceptions.DependencyError):
+      utils.order({'a': {'require': {'missing': {}}}})
+
+  def testLargeChain(self):
+    # Deep chains must not be limited by the recursion limit
+    templates = {'node_0': {}}
+    for i in range(1, 5000):
+      templates['node_%d' % i] = {'require': {'node_%d' % (i - 1): {}}}
+
+    self.assertEqual(utils.order(templates)[-1], 'node_4999')
+
+  def testLazyDict(self):
+    built = []
+    def factory(value):
+      built.append(value)
+      return value
+
+    d = utils.LazyDict()
+    d.lazy('a', lambda: factory(1))
+    d.lazy('b', lambda: factory(2))
+    d['c'] = 3
+
+    self.assertEqual(sorted(d), ['a', 'b', 'c'])
+    self.assertFalse(d.loaded('a'))
+    self.assertEqual(built, [])
+
+    self.assertEqual(d['a'], 1)
+    self.assertTrue(d.loaded('a'))
+    self.assertEqual(built, [1])
+
+    self.assertEqual(sorted(d.values()), [1, 2, 3])
+    self.assertEqual(built, [1, 2])
+
+  def testOutputLines(self):
+    # Lines split across chunks, JSON messages run together and plain text
+    chunks = ['Step 1 : FROM ub', 'untu\nSuccessfully built abc\n',
+      '{"stream": "Step 2 : RUN true\\n"}{"error": "failed"}\r\n', '{"id": "abc", "status": "Downloading"}']
+    lines = list(utils.outputLines(chunks))
+    self.assertEqual([line for line, message in lines],
+      ['Step 1 : FROM ubuntu', 'Successfully built abc', 'Step 2 : RUN true', 'failed', 'abc Downloading'])
+    self.assertEqual(lines[0][1], None)
+    self.assertEqual(lines[3][1], {'error': 'failed'})
+
+  def testLogPath(self):
+    directory = tempfile.mkdtemp()
+    os.environ['MAESTRO_CACHE_DIR'] = directory
+    try:
+      # Kept with the cache rather than wherever maestro happens to run
+      self.assertEqual(utils.logPath('pull', 'user/app:1.0'), os.path.join(directory, 'logs', 'pull-user_app_1.0.log'))
+      self.assertTrue(os.path.isdir(os.path.join(directory, 'logs')))
+    finally:
+      del os.environ['MAESTRO_CACHE_DIR']
+      shutil.rmtree(directory)
+
+  def testWaitForService(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+
+    self.assertTrue(utils.waitForService('127.0.0.1', port, 5))
+    server.close()
+
+    # Nothing is listening anymore
+    self.assertFalse(utils.waitForService('127.0.0.1', port, 0.5))
+
+  def testBannerPatternRequired(self):
+    with self.assertRaises(exceptions.ContainerError) as e:
+      utils.waitForService('127.0.0.1', 1, 5, {'probe': 'banner'})
+    self.assertEqual(str(e.exception), 'banner probe needs a banner pattern')
+
+  def testBannerProbe(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+
+    def greet():
+      for _ in range(2):
+        connection = server.accept()[0]
+        connection.sendall('+OK ready\r\n')
+        connection.close()
+
+    thread = threading.Thread(target=greet)
+    thread.daemon = True
+    thread.start()
+
+    self.assertTrue(utils.waitForService('127.0.0.1', port, 5, {'probe': 'banner', 'banner': '^\\+OK'}))
+    self.assertFalse(utils.waitForService('127.0.0.1', port, 0.1, {'probe': 'banner', 'banner': '^-ERR'}))
+    server.close()
+
+  def testHttpProbe(self):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+        self.send_response(200 if self.path == '/health' else 404)
+        self.end_headers()
+
+      def log_message(self, *args):
+        pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    self.assertTrue(utils.waitForService('127.0.0.1', port, 5, {'probe': 'http', 'path': '/health'}))
+    self.assertFalse(utils.waitForService('127.0.0.1', port, 0.1, {'probe': 'http', 'path': '/missing'}))
+    server.shutdown()
+
+if __name__ == '__main__':
+  unittest.main()